@@ -15,6 +15,10 @@
 #
 # Headers in this file shall remain intact.
 
+import time
+
+from twisted.internet import reactor
+
 from flumotion.component.base.admin_gtk import BaseAdminGtk
 from flumotion.component.base.baseadminnode import BaseAdminGtkNode
 from flumotion.component.common.avproducer.admin_gtk import AVProducerAdminGtk
@@ -151,6 +155,10 @@ class DVBChannel:
         self.programnumber = programnumber
         self.name = name
         self.whatson = ""
+        self.whatsnext = ""
+        # when the next event starts and has to be pulled again, None
+        # when it is not known to change
+        self.nextStart = 0
 
     def set_name(self, name):
         self.name = name
@@ -158,10 +166,17 @@ class DVBChannel:
     def set_whatson(self, whatson):
         self.whatson = whatson
 
+    def set_whatsnext(self, whatsnext):
+        self.whatsnext = whatsnext
+
 
 class DVBServiceInformationAdminGtkNode(BaseAdminGtkNode):
     channels = {}
     siwidget = None
+    _refreshDC = None
+
+    # seconds between looking for next events that started
+    REFRESH_INTERVAL = 60
 
     def render(self):
 
@@ -170,13 +185,16 @@ class DVBServiceInformationAdminGtkNode(BaseAdminGtkNode):
         self.siwidget = ObjectList([Column('programnumber',
             'Program Number', data_type=str),
             Column('name', data_type=str),
-            Column('whatson', 'What\'s On', data_type=str)])
-        whatsontvcolumn = self.siwidget.get_treeview_column(\
-            self.siwidget.get_column_by_name('whatson'))
+            Column('whatson', 'What\'s On', data_type=str),
+            Column('whatsnext', 'What\'s Next', data_type=str)])
         import pango
-        for renderer in whatsontvcolumn.get_cell_renderers():
-            renderer.set_property('wrap-width', 200)
-            renderer.set_property('wrap-mode', pango.WRAP_WORD)
+        for name in ('whatson', 'whatsnext'):
+            tvcolumn = self.siwidget.get_treeview_column(
+                self.siwidget.get_column_by_name(name))
+            for renderer in tvcolumn.get_cell_renderers():
+                renderer.set_property('wrap-width', 200)
+                renderer.set_property('wrap-mode', pango.WRAP_WORD)
+        self.siwidget.connect('selection-changed', self._selectionChangedCb)
         self.widget = self.siwidget
         d = BaseAdminGtkNode.render(self)
         d.addCallback(returnWidget)
@@ -202,6 +220,13 @@ class DVBServiceInformationAdminGtkNode(BaseAdminGtkNode):
         self._watcher.show()
         for chan in self.channels:
             self.siwidget.append(chan)
+        self._refreshDC = reactor.callLater(0, self._refreshWhatsNext)
+
+    def cleanup(self):
+        if self._refreshDC:
+            self._refreshDC.cancel()
+            self._refreshDC = None
+        BaseAdminGtkNode.cleanup(self)
 
     def _setChannelName(self, state, value):
         if value is None:
@@ -239,10 +264,134 @@ class DVBServiceInformationAdminGtkNode(BaseAdminGtkNode):
             if self.siwidget:
                 self.siwidget.append(chan)
 
+    def _selectionChangedCb(self, objectlist, chan):
+        if chan is not None:
+            self._pullWhatsNext(chan.programnumber)
+
+    def _refreshWhatsNext(self):
+        # the next event of a channel only changes once it starts
+        now = time.time()
+        for key, chan in self.channels.items():
+            if chan.nextStart is not None and chan.nextStart <= now:
+                self._pullWhatsNext(key)
+        self._refreshDC = reactor.callLater(self.REFRESH_INTERVAL,
+                                            self._refreshWhatsNext)
+
+    def _pullWhatsNext(self, key):
+
+        def gotNowNext((present, following)):
+            if key not in self.channels:
+                return
+            chan = self.channels[key]
+            if following:
+                start = time.strftime('%H:%M',
+                                      time.localtime(following['start']))
+                txt = "%s (%d minutes)" % (start,
+                                           following['duration'] / 60)
+                if following['name']:
+                    txt = "%s %s" % (txt, following['name'])
+                chan.nextStart = following['start']
+            else:
+                txt = ""
+            chan.set_whatsnext(txt)
+            if self.siwidget:
+                self.siwidget.update(chan)
+        if key in self.channels:
+            # not again until we know when the next event starts
+            self.channels[key].nextStart = None
+        d = self.callRemote("getNowNext", int(key))
+        d.addCallback(gotNowNext)
+        d.addErrback(self.warningFailure)
+
     def _delWhatsOnItem(self, state, key, value):
         pass
 
 
+class HealthRow:
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+class TransportStreamHealthAdminGtkNode(BaseAdminGtkNode):
+    logCategory = 'dvb'
+    # counter name -> (label, unit)
+    COUNTERS = {
+        'bitrate': ('Bitrate', 'kbit/s'),
+        'packets': ('Packets analyzed', ''),
+        'sync-losses': ('Sync losses', ''),
+        'tei-errors': ('Transport errors', ''),
+        'cc-errors': ('Continuity errors', ''),
+        'pcr-errors': ('PCR repetition errors', ''),
+        'pcr-interval-max': ('Maximum PCR interval', 'ms'),
+        'pcr-jitter-max': ('Maximum PCR jitter', 'ms'),
+        'pat-errors': ('PAT repetition errors', ''),
+        'pmt-errors': ('PMT repetition errors', '')}
+
+    def render(self):
+
+        def returnWidget(res):
+            return self.widget
+        self.rows = {}
+        self.widget = ObjectList([Column('name', 'Counter', data_type=str),
+                                  Column('value', 'Value', data_type=str)])
+        d = BaseAdminGtkNode.render(self)
+        d.addCallback(returnWidget)
+        return d
+
+    def setUIState(self, state):
+        BaseAdminGtkNode.setUIState(self, state)
+        self._watcher = _StateWatcher(state,
+           {
+                'ts-health': self._setHealth,
+                'pid-bitrates': self._setBitrates,
+           },
+           {},
+           {},
+           setitemers={
+                'ts-health': self._setHealthItem,
+                'pid-bitrates': self._setBitrateItem,
+           },
+           delitemers={
+                'pid-bitrates': self._delBitrateItem,
+           })
+        self._watcher.show()
+
+    def _setRow(self, key, name, value):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = HealthRow(name, value)
+            self.widget.append(row)
+        else:
+            row.value = value
+            self.widget.update(row)
+
+    def _setHealth(self, state, value):
+        if value is None:
+            return
+        for k, v in value.items():
+            self._setHealthItem(state, k, v)
+
+    def _setHealthItem(self, state, key, value):
+        label, unit = self.COUNTERS.get(key, (key, ''))
+        self._setRow(key, label, ("%d %s" % (value, unit)).strip())
+
+    def _setBitrates(self, state, value):
+        if value is None:
+            return
+        for k, v in value.items():
+            self._setBitrateItem(state, k, v)
+
+    def _setBitrateItem(self, state, key, value):
+        self._setRow(key, "PID %s" % key, "%d kbit/s" % value)
+
+    def _delBitrateItem(self, state, key, value):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.widget.remove(row)
+
+
 class DVBAdminGtk(AVProducerAdminGtk):
 
     def setup(self):
@@ -252,9 +401,39 @@ class DVBAdminGtk(AVProducerAdminGtk):
         channelsnode = DVBServiceInformationAdminGtkNode(self.state,
             self.admin, title="Channel Information")
         self.nodes["Channel Information"] = channelsnode
+        healthnode = TransportStreamHealthAdminGtkNode(self.state,
+            self.admin, title="Transport Stream")
+        self.nodes["Transport Stream"] = healthnode
         return AVProducerAdminGtk.setup(self)
 
 
+class DVBMultiProducerAdminGtk(BaseAdminGtk):
+
+    def setup(self):
+        dvbnode = SignalStatisticsAdminGtkNode(self.state, self.admin,
+                                  title="Signal Statistics")
+        self.nodes['Signal Statistics'] = dvbnode
+        channelsnode = DVBServiceInformationAdminGtkNode(self.state,
+            self.admin, title="Channel Information")
+        self.nodes["Channel Information"] = channelsnode
+        healthnode = TransportStreamHealthAdminGtkNode(self.state,
+            self.admin, title="Transport Stream")
+        self.nodes["Transport Stream"] = healthnode
+        return BaseAdminGtk.setup(self)
+
+
+class DVBTSProducerAdminGtk(BaseAdminGtk):
+
+    def setup(self):
+        dvbnode = SignalStatisticsAdminGtkNode(self.state, self.admin,
+                                  title="Signal Statistics")
+        self.nodes['Signal Statistics'] = dvbnode
+        healthnode = TransportStreamHealthAdminGtkNode(self.state,
+            self.admin, title="Transport Stream")
+        self.nodes["Transport Stream"] = healthnode
+        return BaseAdminGtk.setup(self)
+
+
 class MpegTSDecoderAdminGtk(AVProducerAdminGtk):
     pass
 
@@ -0,0 +1,241 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Transport stream health checks, after the first and second priority
+indicators of ETSI TR 101 290.
+"""
+
+import time
+
+from flumotion.component.producers.dvb import mpegts
+
+# TR 101 290 limits, in seconds
+PAT_INTERVAL = 0.5
+PMT_INTERVAL = 0.5
+PCR_INTERVAL = 0.04
+# PCR gaps beyond this are taken as a discontinuity, not a late PCR
+PCR_DISCONTINUITY = 1.0
+
+
+class TSAnalyzer(object):
+    """
+    I check the health of a transport stream buffer by buffer: continuity
+    counter errors, transport error indicators, PCR repetition and jitter
+    and PAT and PMT repetition, and measure the bitrate of each PID.
+
+    To stay cheap at full multiplex rates I only look at the stream for
+    window seconds every period seconds. The buffers in between are only
+    counted. The error counters are cumulative; the bitrates and the
+    PCR maxima cover the windows since the last call to L{get_stats}.
+    """
+
+    def __init__(self, window=1.0, period=1.0):
+        """
+        @param window: seconds of stream analyzed at a time
+        @param period: seconds between the start of two windows, the
+                       analyzer is always on when it equals window
+        """
+        self.window = window
+        self.period = period
+        # cumulative
+        self.packets = 0
+        self.sync_losses = 0
+        self.tei_errors = 0
+        self.cc_errors = 0
+        self.pcr_errors = 0
+        self.pat_errors = 0
+        self.pmt_errors = 0
+        self._pmtPids = set()
+        self._resetPeriod()
+        self._windowStart = None
+
+    def _resetPeriod(self):
+        self._pidPackets = {}
+        self._analyzedPackets = 0
+        self._totalBytes = 0
+        self._periodStart = None
+        self._now = None
+        self._pcrIntervalMax = 0.0
+        self._pcrJitterMax = 0.0
+
+    def _startWindow(self, now):
+        self._windowStart = now
+        self._windowBytes = 0
+        self._lastCC = {}
+        self._lastPCR = {}
+        self._lastPSI = {}
+
+    def feed(self, data, now=None):
+        """
+        @param data: a buffer of whole transport stream packets
+        @type  data: str
+        """
+        if now is None:
+            now = time.time()
+        size = len(data)
+        self._totalBytes += size
+        self._now = now
+        if self._periodStart is None:
+            self._periodStart = now
+        if self._windowStart is None or \
+               now - self._windowStart >= self.period:
+            self._startWindow(now)
+        elif now - self._windowStart >= self.window:
+            return
+        self._analyze(bytearray(data), now)
+        self._windowBytes += size
+
+    def _analyze(self, data, now):
+        pidPackets = self._pidPackets
+        lastCC = self._lastCC
+        count = 0
+        offset = 0
+        end = len(data) - mpegts.PACKET_SIZE
+        while offset <= end:
+            if data[offset] != mpegts.SYNC_BYTE:
+                self.sync_losses += 1
+                offset = mpegts.find_sync(data, offset)
+                if offset < 0 or offset > end:
+                    break
+            b1 = data[offset + 1]
+            pid = ((b1 & 0x1f) << 8) | data[offset + 2]
+            count += 1
+            pidPackets[pid] = pidPackets.get(pid, 0) + 1
+            if pid == mpegts.PID_NULL:
+                offset += mpegts.PACKET_SIZE
+                continue
+            if b1 & 0x80:
+                self.tei_errors += 1
+            b3 = data[offset + 3]
+            if b3 & 0x20:
+                self._adaptation(data, offset, pid)
+            if b3 & 0x10:
+                cc = b3 & 0x0f
+                last = lastCC.get(pid)
+                if last is not None and cc != last and \
+                       cc != (last + 1) & 0x0f:
+                    self.cc_errors += 1
+                lastCC[pid] = cc
+                if b1 & 0x40 and (pid == mpegts.PID_PAT or
+                                  pid in self._pmtPids):
+                    self._psi(data, offset, pid, now)
+            offset += mpegts.PACKET_SIZE
+        self.packets += count
+        self._analyzedPackets += count
+
+    def _adaptation(self, data, offset, pid):
+        if data[offset + 4] == 0:
+            return
+        if data[offset + 5] & 0x80:
+            # discontinuity indicator
+            self._lastCC.pop(pid, None)
+            self._lastPCR.pop(pid, None)
+            return
+        pcr = mpegts.read_pcr(data, offset)
+        if pcr is None:
+            return
+        position = self._windowBytes + offset
+        last = self._lastPCR.get(pid)
+        self._lastPCR[pid] = (pcr, position)
+        if last is None:
+            return
+        interval = ((pcr - last[0]) % (1 << 33)) / 90000.0
+        if interval > PCR_INTERVAL:
+            self.pcr_errors += 1
+        if interval > PCR_DISCONTINUITY:
+            return
+        self._pcrIntervalMax = max(self._pcrIntervalMax, interval)
+        # compare to the time the bytes in between take at the mux rate
+        rate = self._rate()
+        if rate:
+            expected = (position - last[1]) * 8 / rate
+            self._pcrJitterMax = max(self._pcrJitterMax,
+                                     abs(interval - expected))
+
+    def _psi(self, data, offset, pid, now):
+        start, end = mpegts.payload_bounds(data, offset)
+        if end - start < 9:
+            return
+        # skip the pointer field
+        p = start + 1 + data[start]
+        if p >= end:
+            return
+        table_id = data[p]
+        if pid == mpegts.PID_PAT and table_id == mpegts.TABLE_PAT:
+            self._learnPMTPids(data, p, end)
+            key, limit = 'pat', PAT_INTERVAL
+        elif table_id == mpegts.TABLE_PMT:
+            key, limit = pid, PMT_INTERVAL
+        else:
+            return
+        last = self._lastPSI.get(key)
+        self._lastPSI[key] = now
+        if last is not None and now - last > limit:
+            if key == 'pat':
+                self.pat_errors += 1
+            else:
+                self.pmt_errors += 1
+
+    def _learnPMTPids(self, data, p, end):
+        # a single packet PAT is enough to find the PMTs
+        length = ((data[p + 1] & 0x0f) << 8) | data[p + 2]
+        last = min(end, p + 3 + length - 4)
+        pids = set()
+        p += 8
+        while p + 4 <= last:
+            program_number = (data[p] << 8) | data[p + 1]
+            if program_number:
+                pids.add(((data[p + 2] & 0x1f) << 8) | data[p + 3])
+            p += 4
+        if pids:
+            self._pmtPids = pids
+
+    def _rate(self):
+        # bits per second of the whole stream
+        if self._periodStart is None or self._now <= self._periodStart:
+            return 0
+        return self._totalBytes * 8 / (self._now - self._periodStart)
+
+    def get_stats(self):
+        """
+        Return the health counters and start a new measurement period.
+
+        @returns: (dict of counter name -> value,
+                   dict of PID -> bitrate in kbit/s)
+        """
+        rate = self._rate()
+        pidPackets = self._pidPackets
+        analyzed = self._analyzedPackets
+        stats = {
+            'bitrate': int(rate / 1000),
+            'packets': self.packets,
+            'sync-losses': self.sync_losses,
+            'tei-errors': self.tei_errors,
+            'cc-errors': self.cc_errors,
+            'pcr-errors': self.pcr_errors,
+            'pat-errors': self.pat_errors,
+            'pmt-errors': self.pmt_errors,
+            'pcr-interval-max': int(self._pcrIntervalMax * 1000),
+            'pcr-jitter-max': int(self._pcrJitterMax * 1000)}
+        bitrates = {}
+        if analyzed:
+            # share the measured mux rate out by packet counts
+            for pid, count in pidPackets.items():
+                bitrates[pid] = int(rate * count / analyzed / 1000)
+        self._resetPeriod()
+        return stats, bitrates
@@ -0,0 +1,326 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Choice of the decoders for the streams of a program.
+"""
+
+import os
+import tempfile
+import time
+
+import gst
+from twisted.internet import reactor
+
+from flumotion.common import log
+from flumotion.component.producers.dvb import statedir
+
+# kinds of streams we can decode, by PMT stream type
+STREAM_TYPE_KINDS = {
+    0x01: 'mpeg2-video',
+    0x02: 'mpeg2-video',
+    0x1b: 'h264-video',
+    0x03: 'mpeg-audio',
+    0x04: 'mpeg-audio',
+    0x0f: 'aac-audio',
+    0x11: 'aac-audio',
+    0x81: 'ac3-audio'}
+
+# (parser, decoder) able to decode each kind of stream, the parser can be
+# None; the installed ones are tried in order unless benchmarked
+CANDIDATES = {
+    'mpeg2-video': (('mpegvideoparse', 'mpeg2dec'),
+                    ('mpegvideoparse', 'ffdec_mpeg2video')),
+    'h264-video': (('h264parse', 'ffdec_h264'),
+                   ('h264parse', 'fluh264dec')),
+    'mpeg-audio': ((None, 'mad'),
+                   (None, 'flump3dec'),
+                   ('mp3parse', 'ffdec_mp3')),
+    'aac-audio': (('aacparse', 'faad'),
+                  ('aacparse', 'ffdec_aac')),
+    'ac3-audio': (('ac3parse', 'a52dec'),
+                  ('ac3parse', 'ffdec_ac3'))}
+
+# pipelines encoding the sample streams decoded by the benchmark, the
+# first one whose elements are installed is used
+SAMPLES = {
+    'mpeg2-video': ('videotestsrc num-buffers=100 ! video/x-raw-yuv,'
+                    'width=720,height=576,framerate=25/1 ! ffenc_mpeg2video'
+                    ' bitrate=4000000', ),
+    'h264-video': ('videotestsrc num-buffers=100 ! video/x-raw-yuv,'
+                   'width=720,height=576,framerate=25/1 ! x264enc'
+                   ' byte-stream=true', ),
+    'mpeg-audio': ('audiotestsrc num-buffers=400 ! lamemp3enc',
+                   'audiotestsrc num-buffers=400 ! lame',
+                   'audiotestsrc num-buffers=400 ! twolame'),
+    'aac-audio': ('audiotestsrc num-buffers=400 ! faac',
+                  'audiotestsrc num-buffers=400 ! ffenc_aac'),
+    'ac3-audio': ('audiotestsrc num-buffers=400 ! ffenc_ac3', )}
+
+# benchmark results shared by the components of the worker, in the
+# directory of L{statedir}
+RANKING_FILENAME = 'decoders'
+
+# seconds a benchmark pipeline can run for
+BENCHMARK_TIMEOUT = 20
+
+
+def get_stream_kind(caps):
+    """
+    @returns: the kind of stream of a demuxer pad, from the caps it got
+              from the PMT stream type, or None if we cannot decode it
+    """
+    if not caps or caps.is_any() or caps.is_empty():
+        return None
+    s = caps[0]
+    name = s.get_name()
+    if name == 'video/mpeg' and s['mpegversion'] in (1, 2):
+        return 'mpeg2-video'
+    if name == 'video/x-h264':
+        return 'h264-video'
+    if name == 'audio/mpeg':
+        if s['mpegversion'] == 1:
+            return 'mpeg-audio'
+        return 'aac-audio'
+    if name in ('audio/x-ac3', 'audio/ac3'):
+        return 'ac3-audio'
+    return None
+
+
+def _installed(*names):
+    return not [name for name in names
+                if name and not gst.element_factory_find(name)]
+
+
+def get_candidates(kind):
+    """
+    @returns: the installed (parser, decoder) for a kind of stream, by
+              decreasing GStreamer rank of the decoder
+    """
+    candidates = [c for c in CANDIDATES.get(kind, ()) if _installed(*c)]
+    candidates.sort(key=lambda c: -gst.element_factory_find(c[1]).get_rank())
+    return candidates
+
+
+def _run(description):
+    # seconds it took to run the pipeline to EOS, or None if it failed
+    try:
+        pipeline = gst.parse_launch(description)
+    except gst.GError:
+        return None
+    bus = pipeline.get_bus()
+    start = time.time()
+    pipeline.set_state(gst.STATE_PLAYING)
+    # unlike poll, this runs no main loop, so it is safe out of the
+    # reactor thread
+    message = bus.timed_pop_filtered(BENCHMARK_TIMEOUT * gst.SECOND,
+                                     gst.MESSAGE_EOS | gst.MESSAGE_ERROR)
+    elapsed = time.time() - start
+    pipeline.set_state(gst.STATE_NULL)
+    if not message or message.type != gst.MESSAGE_EOS:
+        return None
+    return elapsed
+
+
+def benchmark(kinds=None):
+    """
+    Time the decoding of a short sample of each kind of stream with each
+    installed decoder. Kinds without a sample encoder installed keep the
+    order of L{get_candidates}.
+
+    This runs GStreamer pipelines to completion, and blocks meanwhile,
+    for minutes; call it from a thread.
+
+    @returns: dict of kind -> list of (parser, decoder, seconds or None),
+              fastest first
+    """
+    ranking = {}
+    for kind in kinds or CANDIDATES.keys():
+        candidates = get_candidates(kind)
+        timings = [(parser, decoder, None)
+                   for parser, decoder in candidates]
+        fd, filename = tempfile.mkstemp(suffix='.es')
+        os.close(fd)
+        try:
+            for sample in SAMPLES[kind]:
+                if _run('%s ! filesink location=%s'
+                        % (sample, filename)) is not None:
+                    break
+            else:
+                log.debug('dvb', 'Cannot encode a %s sample', kind)
+                ranking[kind] = timings
+                continue
+            timings = []
+            for parser, decoder in candidates:
+                chain = [e for e in ('filesrc location=%s' % filename,
+                                     parser, decoder, 'fakesink') if e]
+                elapsed = _run(' ! '.join(chain))
+                log.debug('dvb', 'Decoding a %s sample with %s took %r s',
+                          kind, decoder, elapsed)
+                if elapsed is not None:
+                    timings.append((parser, decoder, elapsed))
+            timings.sort(key=lambda t: t[2])
+            ranking[kind] = timings
+        finally:
+            os.unlink(filename)
+    return ranking
+
+
+def _getRankingFile():
+    return os.path.join(statedir.get_directory(), RANKING_FILENAME)
+
+
+def save_ranking(ranking, filename=None):
+    filename = filename or _getRankingFile()
+    tmp = filename + '.tmp'
+    f = open(tmp, 'w')
+    for kind, timings in ranking.items():
+        for parser, decoder, elapsed in timings:
+            f.write('%s %s %s %s\n' % (kind, parser or '-', decoder,
+                                       elapsed is None and '-' or elapsed))
+    f.close()
+    os.rename(tmp, filename)
+
+
+def load_ranking(filename=None):
+    """
+    The components never benchmark the decoders themselves, the
+    benchmarkDecoders worker check does.
+
+    @returns: the ranking saved by L{save_ranking}, or None
+    """
+    try:
+        f = open(filename or _getRankingFile())
+    except EnvironmentError:
+        return None
+    ranking = {}
+    for line in f:
+        try:
+            kind, parser, decoder, elapsed = line.split()
+        except ValueError:
+            continue
+        ranking.setdefault(kind, []).append(
+            (parser != '-' and parser or None, decoder,
+             elapsed != '-' and float(elapsed) or None))
+    f.close()
+    return ranking
+
+
+def choose(kind, ranking=None):
+    """
+    @returns: the (parser, decoder) to use for a kind of stream, the
+              fastest installed one, or without a ranking the first of
+              L{get_candidates}, or None
+    """
+    for parser, decoder, elapsed in (ranking or {}).get(kind, ()):
+        if _installed(parser, decoder):
+            return parser, decoder
+    candidates = get_candidates(kind)
+    if candidates:
+        return candidates[0]
+    return None
+
+
+class AutoDecoder(log.Loggable):
+    """
+    I link the first audio and video streams a demuxer adds to the
+    <branch>queue<suffix> queues, through the best decoder for their kind
+    of stream, on to the <branch>id<suffix> elements.
+
+    The decoder is named <branch>decoder<suffix>. When a new demuxer
+    gives out another kind of stream, I replace the decoder.
+    """
+    logCategory = 'dvb'
+
+    def __init__(self, pipeline, branches, suffix='', audio_pid=0,
+                 ranking=None, plugged_cb=None):
+        """
+        @param branches:   branches to decode, among 'audio' and 'video'
+        @param audio_pid:  audio stream to decode instead of the first
+        @param plugged_cb: called from the reactor with the name of the
+                           decoder once it is linked
+        """
+        self._pipeline = pipeline
+        self.branches = branches
+        self._suffix = suffix
+        self._audioPid = audio_pid
+        self._ranking = ranking
+        self._pluggedCb = plugged_cb
+        self._kinds = {}
+        self._elements = {}
+
+    def attach(self, demux):
+        demux.connect('pad-added', self._padAddedCb)
+
+    def _padAddedCb(self, demux, pad):
+        # called from the streaming thread
+        name = pad.get_name()
+        branch = name.split('_')[0]
+        if branch not in self.branches:
+            return
+        if branch == 'audio' and self._audioPid and \
+               name != 'audio_%04x' % self._audioPid:
+            return
+        queue = self._pipeline.get_by_name('%squeue%s' % (branch,
+                                                          self._suffix))
+        if queue.get_pad('sink').is_linked():
+            return
+        kind = get_stream_kind(pad.get_caps())
+        if kind != self._kinds.get(branch) and not self._plug(branch, kind):
+            return
+        self.debug("Linking %s to %s", name, queue.get_name())
+        pad.link(queue.get_pad('sink'))
+
+    def _plug(self, branch, kind):
+        chain = kind and choose(kind, self._ranking)
+        if not chain:
+            self.warning("No decoder installed for the %s stream (%s)",
+                         branch, kind)
+            return False
+        self._unplug(branch)
+        parser, decoder = chain
+        name = '%sdecoder%s' % (branch, self._suffix)
+        elements = [gst.element_factory_make(decoder, name)]
+        if parser:
+            elements.insert(0, gst.element_factory_make(parser))
+        self.info("Decoding %s with %s", kind, decoder)
+        queue = self._pipeline.get_by_name('%squeue%s' % (branch,
+                                                          self._suffix))
+        sink = self._pipeline.get_by_name('%sid%s' % (branch, self._suffix))
+        self._pipeline.add(*elements)
+        gst.element_link_many(queue, *(elements + [sink]))
+        for element in elements:
+            element.sync_state_with_parent()
+        self._kinds[branch] = kind
+        self._elements[branch] = elements
+        if self._pluggedCb:
+            reactor.callFromThread(self._pluggedCb, name)
+        return True
+
+    def _unplug(self, branch):
+        elements = self._elements.pop(branch, [])
+        if not elements:
+            return
+        queue = self._pipeline.get_by_name('%squeue%s' % (branch,
+                                                          self._suffix))
+        sink = self._pipeline.get_by_name('%sid%s' % (branch, self._suffix))
+        queue.unlink(elements[0])
+        elements[-1].unlink(sink)
+        for element in elements:
+            element.set_state(gst.STATE_NULL)
+            self._pipeline.remove(element)
+        del self._kinds[branch]
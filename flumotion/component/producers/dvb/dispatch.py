@@ -0,0 +1,68 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import time
+
+
+class MessageDispatcher(object):
+    """
+    I hand each element message structure to the handler registered for
+    its name, and keep track of how many times each handler was called
+    and how long it took.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._stats = {}
+
+    def register(self, name, handler):
+        """
+        Call handler(structure) for the messages called name.
+        """
+        self._handlers[name] = handler
+        self._stats[name] = [0, 0.0, 0.0]
+
+    def dispatch(self, structure):
+        """
+        @returns: whether a handler was registered for the structure
+        @rtype:   bool
+        """
+        name = structure.get_name()
+        handler = self._handlers.get(name)
+        if handler is None:
+            return False
+        start = time.time()
+        try:
+            handler(structure)
+        finally:
+            elapsed = time.time() - start
+            stats = self._stats[name]
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+        return True
+
+    def get_stats(self):
+        """
+        @returns: dict of message name -> dict with the number of
+                  calls, and the total and maximum time spent in seconds
+        """
+        result = {}
+        for name, (calls, total, maximum) in self._stats.items():
+            result[name] = dict(calls=calls, total=total, max=maximum)
+        return result
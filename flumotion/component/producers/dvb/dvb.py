@@ -16,69 +16,216 @@
 # Headers in this file shall remain intact.
 
 
+import os
+import time
+
 import gst
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
 
-from flumotion.common import errors
+from flumotion.common import errors, messages
 from flumotion.common.i18n import N_, gettexter
 from flumotion.component import feedcomponent
 from flumotion.component.common.avproducer import avproducer
+from flumotion.component.producers.dvb import analyzer, decoders, dispatch
+from flumotion.component.producers.dvb import epg
+from flumotion.component.producers.dvb import frontend, mpegts
+from flumotion.component.producers.dvb import pidfilter, queues, statedir
+from flumotion.component.producers.dvb import timeshift, timestamps, tsfile
+from flumotion.component.producers.dvb import tunerpool
 
 
 T_ = gettexter('flumotion')
 
 
-def get_decode_pipeline_string(props):
-    has_video = props.get('has-video', True)
+# maximum number of programs a dvb-multi-producer can decode, each one has
+# its own audio-N and video-N feeders declared in the registry
+MAX_PROGRAMS = 8
+
+# source of the transport stream pushed from python, by a PacedFilePusher
+# or a RingFollower
+APPSRC_TEMPLATE = """appsrc name=src is-live=true
+            caps="video/mpegts,systemstream=(boolean)true,packetsize=(int)188"
+            ! mpegtsparse name=tsparse program-numbers=%s"""
+
+
+def get_decode_pipeline_string(props, program_number=None, suffix='',
+                               audio_only=False):
+    """
+    Return the pipeline template decoding one program out of a transport
+    stream.
+
+    The branches whose decoder property is auto, the default, are left
+    unlinked between their queue and their identity for an
+    L{decoders.AutoDecoder} to plug the decoder for the stream the
+    demuxer gives out.
+
+    @param program_number: program to decode, defaults to the
+                           program-number property
+    @param suffix:         appended to the names of the elements and the
+                           feeders, so that several decode branches can
+                           live in the same pipeline
+    @param audio_only:     whether to only decode the audio and feed it,
+                           without any video feeder
+    """
+    has_video = props.get('has-video', True) and not audio_only
     video_parser = props.get('video-parser', 'mpegvideoparse')
-    video_decoder = props.get('video-decoder', 'mpeg2dec')
-    audio_decoder = props.get('audio-decoder', 'mad')
+    video_decoder = props.get('video-decoder', 'auto')
+    audio_decoder = props.get('audio-decoder', 'auto')
     demuxer = props.get('demuxer', 'flutsdemux')
-    program_number = props.get('program-number')
+    if program_number is None:
+        program_number = props.get('program-number')
     audio_pid = props.get('audio-pid', 0)
-    # identity to check for imperfect timestamps also for
-    # use to sync to the clock when we use a file
-    idsync_template = "identity check-imperfect-timestamp=true silent=true"
+    # where the decoded streams join the rest of the pipeline, their
+    # timestamps are sampled there by a TimestampMonitor
+    idsync_template = "identity silent=true"
     audio_pid_template = ""
     if audio_pid > 0:
         # transport stream demuxer expects this as 4 digit hex
         audio_pid_template = "audio_%04x " % audio_pid
-    template = '%(demuxer)s name=demux program-number=%(program_number)d' \
-        ' demux.%(audiopid)s ! ' \
-        ' queue max-size-buffers=0 max-size-time=0' \
-        ' ! %(audiodec)s name=audiodecoder' \
-        ' ! %(identity)s name=audioid' \
-        ' ! audioconvert ! level name=volumelevel '\
-        ' ! volume name=setvolume' \
-        ' ! tee name=t ! @feeder:audio@' % dict(
+    audioqueue = queues.get_queue_string(props, 'decode',
+                                         'audioqueue' + suffix)
+    if audio_decoder == 'auto':
+        audio_template = '%s ' % audioqueue
+    else:
+        audio_template = 'demux%(s)s.%(audiopid)s ! %(audioqueue)s' \
+            ' ! %(audiodec)s name=audiodecoder%(s)s !' % dict(
             audiopid=audio_pid_template,
+            audioqueue=audioqueue,
             audiodec=audio_decoder,
+            s=suffix)
+    template = '%(demuxer)s name=demux%(s)s' \
+        ' program-number=%(program_number)d' \
+        ' %(audio)s %(identity)s name=audioid%(s)s' \
+        ' ! audioconvert ! level name=volumelevel%(s)s '\
+        ' ! volume name=setvolume%(s)s' \
+        ' ! %(tee)s@feeder:audio%(s)s@' % dict(
+            audio=audio_template,
+            tee=not audio_only and 'tee name=t%s ! ' % suffix or '',
             demuxer=demuxer,
             identity=idsync_template,
-            program_number=program_number)
+            program_number=program_number,
+            s=suffix)
     if has_video:
-        template = ('%(template)s demux. ! ' \
-                    ' queue max-size-buffers=0 max-size-time=0 ' \
-                    '! %(videoparse)s ! %(videodec)s name=videodecoder' \
-                    '    ! %(identity)s name=videoid ' \
-                    '    !  @feeder:video@' % dict(template=template,
+        videoqueue = queues.get_queue_string(props, 'decode',
+                                             'videoqueue' + suffix)
+        if video_decoder == 'auto':
+            video_template = '%s ' % videoqueue
+        else:
+            video_template = 'demux%(s)s. ! %(videoqueue)s' \
+                ' ! %(videoparse)s ! %(videodec)s' \
+                ' name=videodecoder%(s)s !' % dict(
+                videoqueue=videoqueue,
+                videoparse=video_parser,
+                videodec=video_decoder,
+                s=suffix)
+        template = ('%(template)s %(video)s' \
+                    '    %(identity)s name=videoid%(s)s ' \
+                    '    !  @feeder:video%(s)s@' % dict(template=template,
                             identity=idsync_template,
-                            videoparse=video_parser,
-                            videodec=video_decoder))
-    else:
-        template = '%s t. ! queue ! @feeder:video@' % template
+                            video=video_template,
+                            s=suffix))
+    elif not audio_only:
+        # the registry declares a video feeder, feed it the audio
+        template = '%s t%s. ! queue ! @feeder:video%s@' % (
+            template, suffix, suffix)
     return template
 
 
-# Statistics we get from DVB are:
-# signal: signal strength (0 - 65535)
-# snr: signal to noise ratio (0 - 65535)
-# ber: bit error rate (seems to be driver specific scale)
-# unc: uncorrected bits (should be cumulative but drivers do not follow spec)
-# lock: locked to signal (boolean)
+def get_auto_decoded(props, audio_only=False):
+    """
+    @returns: the branches whose decoder is chosen from the stream
+    """
+    branches = []
+    if props.get('audio-decoder', 'auto') == 'auto':
+        branches.append('audio')
+    if not audio_only and props.get('has-video', True) and \
+           props.get('video-decoder', 'auto') == 'auto':
+        branches.append('video')
+    return branches
+
+
+def make_timestamp_monitor(pipeline, props, uiState, suffixes=('', )):
+    """
+    Return a started monitor of the timestamps of the decoded streams of
+    the programs decoded with suffixes, or None if the
+    timestamp-sample-period property disables it.
+    """
+    period = props.get('timestamp-sample-period', 10.0)
+    if period <= 0:
+        return None
+    monitor = timestamps.TimestampMonitor(uiState, period,
+        props.get('timestamp-sample-size', 50))
+    for suffix in suffixes:
+        for kind in ('audio', 'video'):
+            element = pipeline.get_by_name('%sid%s' % (kind, suffix))
+            if element:
+                monitor.attach(element.get_pad('src'), kind + suffix)
+    monitor.start()
+    return monitor
+
+
+class DVBTSProducerMedium(feedcomponent.FeedComponentMedium):
+
+    def remote_getNowNext(self, serviceId):
+        return self.comp.getNowNext(serviceId)
+
+    def remote_getSchedule(self, serviceId, start=None, end=None):
+        return self.comp.getSchedule(serviceId, start, end)
+
+    def remote_getMessageStats(self):
+        return self.comp.getMessageStats()
+
+    def remote_getTimeShiftRange(self):
+        return self.comp.getTimeShiftRange()
+
+    def remote_findTimeShiftOffset(self, timestamp):
+        return self.comp.findTimeShiftOffset(timestamp)
+
+    def remote_readTimeShift(self, offset, size):
+        return self.comp.readTimeShift(offset, size)
+
+    def remote_setProgram(self, programNumber):
+        return self.comp.setProgram(programNumber)
 
 
 class DVBTSProducer(feedcomponent.ParseLaunchComponent):
+    componentMediumClass = DVBTSProducerMedium
+    _stats = None
+    _epg = None
+    _countersDC = None
+    _filePusher = None
+    _fileReader = None
+    _pidFilter = None
+    _queues = None
+    _analyzer = None
+    _timeShift = None
+    _tunerPool = None
+    _tunerClaim = None
+    _tunerRing = None
+    _tunerPollDC = None
+    _tunedPrograms = None
+    _ringFollower = None
+    _watchdog = None
+    _timestamps = None
+
+    # seconds between updates of the counters in the uiState
+    COUNTERS_INTERVAL = 10
+
+    # bus messages carrying PSI/SI tables, which the mux keeps repeating
+    PSI_MESSAGES = ('pat', 'pmt', 'nit', 'sdt', 'eit')
+
+    # maximum number of bytes of the time-shift buffer returned at once
+    TIMESHIFT_MAX_READ = 256 * 1024
+
+    # queues whose levels and overruns are published in the uiState
+    MONITORED_QUEUES = ('mpegtsqueue', 'decodequeue', 'audioqueue',
+                        'videoqueue')
+
+    # seconds between looks at the other users of a shared frontend
+    TUNER_POLL_INTERVAL = 2
+
+    # whether the registry declares no video feeder
+    AUDIO_ONLY = False
 
     def init(self):
         self.uiState.addKey('signal', 0)
@@ -86,8 +233,36 @@ class DVBTSProducer(feedcomponent.ParseLaunchComponent):
         self.uiState.addKey('ber', 0)
         self.uiState.addKey('unc', 0)
         self.uiState.addKey('lock', False)
+        self.uiState.addDictKey('tuner')
+        self.uiState.addDictKey('recovery')
+        self.uiState.addDictKey('timestamps')
+        self.init_tables()
+
+    def init_tables(self):
         self.uiState.addDictKey('channelnames')
         self.uiState.addDictKey('whatson')
+        self.uiState.addKey('sections-processed', 0)
+        self.uiState.addKey('sections-skipped', 0)
+        self.uiState.addDictKey('message-stats')
+        self.uiState.addDictKey('queues')
+        self.uiState.addDictKey('ts-health')
+        self.uiState.addDictKey('pid-bitrates')
+        self._sections = mpegts.SectionCache()
+        self._dispatcher = dispatch.MessageDispatcher()
+        self.register_message_handlers()
+
+    def register_message_handlers(self):
+        """
+        Register the handlers of the element messages posted on the bus.
+        Subclasses can extend this to handle more messages.
+        """
+        register = self._dispatcher.register
+        register('dvb-frontend-stats', self._handleFrontendStats)
+        register('dvb-read-failure', self._handleReadFailure)
+        register('pat', self._handlePAT)
+        register('pmt', self._handlePMT)
+        register('sdt', self._handleSDT)
+        register('eit', self._handleEIT)
 
     def do_check_dvb(self):
         props = self.config['properties']
@@ -112,6 +287,19 @@ class DVBTSProducer(feedcomponent.ParseLaunchComponent):
                 self.debug("No property %s for dvb-%s", param, dvb_type)
                 return defer.fail(errors.ConfigError(msg))
 
+        msg = queues.check_properties(props)
+        if msg:
+            return defer.fail(errors.ConfigError(msg))
+
+        if dvb_type != 'FILE' and props.get('tuner-pool', False):
+            try:
+                self.acquire_tuner(props)
+            except tunerpool.TunerPoolFull, e:
+                return defer.fail(errors.ConfigError(str(e)))
+            except EnvironmentError, e:
+                msg = "Could not use the tuner pool: %s" % e
+                return defer.fail(errors.ConfigError(msg))
+
         dvbbasebin_element = gst.element_factory_make("dvbbasebin")
         if not dvbbasebin_element:
             msg = "You do not have the dvbbasebin element. " \
@@ -121,13 +309,53 @@ class DVBTSProducer(feedcomponent.ParseLaunchComponent):
     def do_check(self):
         return self.do_check_dvb()
 
+    def acquire_tuner(self, props):
+        """
+        Get a frontend of our type tuned to our multiplex from the tuner
+        pool of the worker, tuning it ourselves if nobody else uses it.
+        """
+        program_numbers = props.get('program-numbers') or \
+                          "%d" % props.get('program-number')
+        tuning = tunerpool.tuning_key(props.get('dvb-type'),
+            props.get('frequency'), props.get('polarity'),
+            props.get('symbol-rate'), props.get('satellite-number', 0))
+        self._tunerPool = tunerpool.TunerPool(
+            props.get('tuner-pool-directory', None))
+        self._tunerClaim = self._tunerPool.acquire(self.name, tuning,
+            [int(n) for n in program_numbers.split(':') if n])
+        self.info("Using frontend %d of adapter %d as %s",
+                  self._tunerClaim.frontend, self._tunerClaim.adapter,
+                  self._tunerClaim.master and "master" or "sharer")
+
+    def is_sharing_tuner(self):
+        """
+        @returns: whether another component tunes our frontend and we read
+                  the transport stream from its ring file
+        """
+        claim = self._tunerClaim
+        return bool(claim and not claim.master)
+
+    def get_tuned_programs(self):
+        """
+        @returns: the program numbers the source has to give out: ours,
+                  or those of all its users when we tune a shared frontend
+        """
+        claim = self._tunerClaim
+        if claim and claim.master:
+            return self._tunerPool.get_programs(claim.adapter,
+                                                claim.frontend)
+        return [int(n) for n in self.program_numbers]
+
     def get_dvbsrc_pipeline_string(self, props):
         dvbsrc_template = ""
         program_numbers = props.get('program-numbers')
         if not program_numbers:
             program_numbers = "%d" % props.get('program-number')
         self.program_numbers = program_numbers.split(":")
-        if self.dvb_type == "T":
+        if self.is_sharing_tuner():
+            # the transport stream is pushed by a RingFollower
+            dvbsrc_template = APPSRC_TEMPLATE % program_numbers
+        elif self.dvb_type == "T":
             modulation = props.get('modulation')
             trans_mode = props.get('trans-mode')
             if trans_mode == 2 or trans_mode == 8:
@@ -144,7 +372,7 @@ dvbbasebin modulation="QAM %(modulation)d"
  trans-mode=%(trans_mode)s
 bandwidth=%(bandwidth)d code-rate-lp=%(code_rate_lp)s
 code-rate-hp=%(code_rate_hp)s guard=%(guard)d
-hierarchy=%(hierarchy)d stats-reporting-interval=5000''' % dict(
+hierarchy=%(hierarchy)d''' % dict(
                  modulation=modulation, trans_mode=trans_mode,
                 bandwidth=bandwidth, code_rate_lp=code_rate_lp,
                 code_rate_hp=code_rate_hp,
@@ -162,14 +390,26 @@ dvbbasebin polarity=%(polarity)s symbol-rate=%(symbol_rate)s
             if code_rate_hp:
                 dvbsrc_template = "%s code-rate-hp=%s " % (dvbsrc_template,
                     code_rate_hp)
+        elif self.dvb_type == "FILE" and self.is_file_paced(props):
+            # the file is mmapped and pushed by a PacedFilePusher
+            dvbsrc_template = APPSRC_TEMPLATE % program_numbers
         elif self.dvb_type == "FILE":
             filename = props.get('filename')
             dvbsrc_template = """filesrc location=%s name=src
-            ! mpegtsparse program-numbers=%s""" % (filename, program_numbers)
-        if self.dvb_type == "S" or self.dvb_type == "T":
+            ! mpegtsparse name=tsparse program-numbers=%s""" % (
+                filename, program_numbers)
+        if self.dvb_type in ("S", "T") and not self.is_sharing_tuner():
             freq = props.get('frequency')
+            if self._tunerClaim:
+                # give out what the components sharing the frontend want
+                program_numbers = ':'.join(
+                    ['%d' % n for n in self.get_tuned_programs()])
             dvbsrc_template = "%s frequency=%d program-numbers=%s name=src" % (
                 dvbsrc_template, freq, program_numbers)
+            # start reporting fast, the stats publisher slows it down once
+            # the frontend is stable
+            dvbsrc_template = "%s stats-reporting-interval=%d" % (
+                dvbsrc_template, props.get('stats-interval-unlocked', 1000))
             adapter = props.get('adapter', 0)
             frontend = props.get('frontend', 0)
             device = props.get('device', None)
@@ -179,91 +419,539 @@ dvbbasebin polarity=%(polarity)s symbol-rate=%(symbol_rate)s
                     if str(adapnum) in device:
                         adapter = adapnum
                 # FIXME: add a warning here
+            if self._tunerClaim:
+                adapter, frontend = self._tunerClaim.tuner()
             dvbsrc_template = "%s adapter=%d frontend=%d" % (
                 dvbsrc_template, adapter, frontend)
         dvbsrc_template = "%s .src%%d" % dvbsrc_template
         return dvbsrc_template
 
+    def is_file_paced(self, props):
+        return props.get('file-paced', False) or props.get('file-loop', False)
+
+    def get_program_pad_template(self, program_number):
+        """
+        Return the pad of the source bin giving out the single program
+        transport stream of program_number.
+        """
+        if self.dvb_type == "FILE" or self.is_sharing_tuner():
+            return "tsparse.program_%d" % program_number
+        return "src.program_%d" % program_number
+
     def get_pipeline_string(self, props):
         dvbsrc_template = self.get_dvbsrc_pipeline_string(props)
-        template = ('%(dvbsrc)s ! @feeder:default@'
+        template = ('%(dvbsrc)s ! tee name=mpegtst ! @feeder:default@'
                     % dict(dvbsrc=dvbsrc_template))
         return template
 
     def configure_pipeline(self, pipeline, properties):
         self.debug("Connecting to bus message handling")
+        file_pids = ()
         bus = pipeline.get_bus()
         bus.add_signal_watch()
         bus.connect('message::element', self._bus_message_received_cb)
 
+        self._epg = epg.EPGStore(
+            past=properties.get('epg-past', 3600),
+            future=properties.get('epg-future', 7 * 86400),
+            max_events=properties.get('epg-max-events', 1000))
+
+        if self.is_sharing_tuner():
+            self._followRing()
+        elif properties.get('dvb-type') in ('T', 'S'):
+            self._stats = frontend.FrontendStatsPublisher(self.uiState,
+                pipeline.get_by_name('src'),
+                threshold=properties.get('stats-threshold', 1.0),
+                min_interval=properties.get('stats-min-interval', 1000) /
+                    1000.0,
+                fast_interval=properties.get('stats-interval-unlocked',
+                                             1000),
+                slow_interval=properties.get('stats-interval-locked', 5000))
+        elif properties.get('dvb-type') == 'FILE' and \
+                 self.is_file_paced(properties):
+            file_pids = [int(pid, 0) for pid in
+                         properties.get('file-pids', '').split(':') if pid]
+            try:
+                reader = tsfile.TSFileReader(properties['filename'],
+                    program_number=int(self.program_numbers[0]),
+                    loop=properties.get('file-loop', False),
+                    pids=file_pids)
+            except (IOError, ValueError), e:
+                self.addMessage(messages.Error(T_(N_(
+                    "Could not play out the TS file '%s': %s"),
+                    properties['filename'], e), mid='file'))
+                raise errors.ComponentSetupHandledError()
+            self._fileReader = reader
+            self._filePusher = tsfile.PacedFilePusher(
+                pipeline.get_by_name('src'), reader,
+                speed=properties.get('file-speed', 1.0))
+
+        if properties.get('pid-filter', False):
+            if self.dvb_type == 'FILE' and not self._fileReader:
+                self.warning("PID filtering needs a paced FILE source")
+            elif self.is_sharing_tuner():
+                self.warning("PID filtering of a shared frontend is done "
+                             "by the component tuning it")
+            else:
+                self._pidFilter = pidfilter.PIDFilter(
+                    self.get_tuned_programs(),
+                    audio_pid=properties.get('audio-pid', 0),
+                    video=properties.get('has-video', True) and
+                          not self.AUDIO_ONLY,
+                    extra_pids=file_pids)
+
+        self._queues = queues.QueueMonitor()
+        for element in pipeline.elements():
+            name = element.get_name()
+            if element.get_factory().get_name() == 'queue' and \
+                   name.split('-')[0] in self.MONITORED_QUEUES:
+                self._queues.attach(element, name)
+
+        # analyze the whole transport stream where it enters the tee or
+        # the queue of the mpegts feeder
+        element = pipeline.get_by_name('mpegtst') or \
+                  pipeline.get_by_name('mpegtsqueue')
+        if element and properties.get('analyzer', True):
+            self._analyzer = analyzer.TSAnalyzer(
+                window=properties.get('analyzer-window', 1.0),
+                period=properties.get('analyzer-period', 1.0))
+            element.get_pad('sink').add_buffer_probe(self._analyzerProbeCb)
+
+        size = properties.get('timeshift-size', 0)
+        if element and size > 0:
+            filename = 'flumotion-timeshift-%s.ts' % self.name
+            try:
+                directory = properties.get('timeshift-directory') or \
+                            statedir.get_directory('timeshift')
+                filename = os.path.join(directory, filename)
+                # left behind by an earlier run that did not stop cleanly
+                if os.path.lexists(filename):
+                    os.unlink(filename)
+                self._timeShift = timeshift.TimeShiftBuffer(filename,
+                    size * 1024 * 1024)
+            except (EnvironmentError, ValueError), e:
+                self.addMessage(messages.Error(T_(N_(
+                    "Could not create the time-shift buffer '%s': %s"),
+                    filename, e), mid='timeshift'))
+                raise errors.ComponentSetupHandledError()
+            self.debug("Time-shifting %d MB in %s", size, filename)
+            element.get_pad('sink').add_buffer_probe(self._timeShiftProbeCb)
+
+        claim = self._tunerClaim
+        if element and claim and claim.master:
+            filename = self._tunerPool.ring_filename(claim.adapter,
+                                                     claim.frontend)
+            try:
+                # components still following a previous ring keep reading
+                # the unlinked file
+                if os.path.exists(filename):
+                    os.unlink(filename)
+                self._tunerRing = timeshift.TimeShiftBuffer(filename,
+                    properties.get('tuner-pool-ring-size', 16) * 1024 * 1024)
+            except (EnvironmentError, ValueError), e:
+                self.addMessage(messages.Error(T_(N_(
+                    "Could not create the ring file '%s' of the shared "
+                    "frontend: %s"), filename, e), mid='tuner-pool'))
+                raise errors.ComponentSetupHandledError()
+            element.get_pad('sink').add_buffer_probe(self._tunerRingProbeCb)
+            self._tunedPrograms = self.get_tuned_programs()
+        if claim:
+            self._pollTunerPool()
+
+        if element and self._stats and properties.get('watchdog', True):
+            self._watchdog = frontend.LockWatchdog(self._retune,
+                timeout=properties.get('watchdog-timeout', 5.0),
+                max_backoff=properties.get('watchdog-max-backoff', 60.0))
+            element.get_pad('sink').add_buffer_probe(self._watchdogProbeCb)
+            self._watchdog.start()
+
+        self._updateCounters()
+
+    def do_stop(self):
+        if self._stats:
+            self._stats.stop()
+        if self._filePusher:
+            self._filePusher.stop()
+            self._filePusher = None
+            self._fileReader = None
+        if self._countersDC:
+            self._countersDC.cancel()
+            self._countersDC = None
+        if self._timeShift:
+            self._timeShift.close()
+            self._timeShift = None
+        if self._watchdog:
+            self._watchdog.stop()
+            self._watchdog = None
+        if self._timestamps:
+            self._timestamps.stop()
+            self._timestamps = None
+        if self._tunerPollDC:
+            self._tunerPollDC.cancel()
+            self._tunerPollDC = None
+        if self._ringFollower:
+            self._ringFollower.stop()
+            self._ringFollower = None
+        if self._tunerRing:
+            self._tunerRing.close()
+            self._tunerRing = None
+        if self._tunerClaim:
+            self._tunerPool.release(self.name)
+            self._tunerClaim = None
+        return feedcomponent.ParseLaunchComponent.do_stop(self)
+
+    def _updateCounters(self):
+        for key, value in (('sections-processed', self._sections.processed),
+                           ('sections-skipped', self._sections.skipped)):
+            if self.uiState.get(key) != value:
+                self.uiState.set(key, value)
+        published = self.uiState.get('message-stats')
+        for name, stats in self._dispatcher.get_stats().items():
+            if published.get(name) != stats:
+                self.uiState.setitem('message-stats', name, stats)
+        published = self.uiState.get('queues')
+        for name, stats in self._queues.get_stats().items():
+            if published.get(name) != stats:
+                self.uiState.setitem('queues', name, stats)
+        if self._analyzer:
+            self._updateHealth()
+        if self._watchdog:
+            published = self.uiState.get('recovery')
+            for key, value in self._watchdog.get_stats().items():
+                if published.get(key) != value:
+                    self.uiState.setitem('recovery', key, value)
+        self._countersDC = reactor.callLater(self.COUNTERS_INTERVAL,
+                                             self._updateCounters)
+
+    def _updateHealth(self):
+        stats, bitrates = self._analyzer.get_stats()
+        published = self.uiState.get('ts-health')
+        for key, value in stats.items():
+            if published.get(key) != value:
+                self.uiState.setitem('ts-health', key, value)
+        # uiState keys are strings
+        bitrates = dict([('0x%04x' % pid, rate)
+                         for pid, rate in bitrates.items()])
+        published = self.uiState.get('pid-bitrates')
+        for key in published.keys():
+            if key not in bitrates:
+                self.uiState.delitem('pid-bitrates', key)
+        for key, value in bitrates.items():
+            if published.get(key) != value:
+                self.uiState.setitem('pid-bitrates', key, value)
+
+    def _analyzerProbeCb(self, pad, buffer):
+        # called from the streaming thread
+        self._analyzer.feed(buffer.data)
+        return True
+
+    def _timeShiftProbeCb(self, pad, buffer):
+        # called from the streaming thread
+        timeShift = self._timeShift
+        if timeShift:
+            timeShift.write(buffer.data)
+        return True
+
+    def _watchdogProbeCb(self, pad, buffer):
+        # called from the streaming thread
+        watchdog = self._watchdog
+        if watchdog:
+            watchdog.data_received()
+        return True
+
+    def _retune(self):
+        # tuning blocks until the frontend locks or gives up, so do it
+        # out of the reactor; the feeders keep running meanwhile
+        for element in self.pipeline.get_by_name('src').elements():
+            if element.get_factory().get_name() == 'dvbsrc':
+                return threads.deferToThread(element.emit, 'tune')
+
+    def _tunerRingProbeCb(self, pad, buffer):
+        # called from the streaming thread
+        ring = self._tunerRing
+        if ring:
+            ring.write(buffer.data)
+        return True
+
+    def _followRing(self):
+        claim = self._tunerClaim
+        filename = self._tunerPool.ring_filename(claim.adapter,
+                                                 claim.frontend)
+        try:
+            reader = timeshift.RingReader(filename)
+        except (EnvironmentError, ValueError), e:
+            # the master may not be streaming yet, try again on next poll
+            self.debug("Cannot follow %s yet: %s", filename, e)
+            return
+        self.debug("Following %s", filename)
+        self._ringFollower = tsfile.RingFollower(
+            self.pipeline.get_by_name('src'), reader)
+
+    def _pollTunerPool(self):
+        self._tunerPollDC = None
+        claims = self._tunerPool.get_claims()
+        mine = [c for c in claims if c.owner == self.name]
+        if mine:
+            promoted = mine[0].master and not self._tunerClaim.master
+            self._tunerClaim = mine[0]
+            if promoted:
+                self._giveUpFrontend()
+                return
+        claim = self._tunerClaim
+        if self._tunerRing:
+            programs = self.get_tuned_programs()
+            if programs != self._tunedPrograms:
+                self._setTunedPrograms(programs)
+        else:
+            follower = self._ringFollower
+            if follower and follower.stalled:
+                # the master may have restarted with a new ring file
+                follower.stop()
+                self._ringFollower = None
+            if not self._ringFollower:
+                self._followRing()
+        users = len([c for c in claims if c.tuner() == claim.tuner()])
+        for key, value in (('adapter', claim.adapter),
+                           ('frontend', claim.frontend),
+                           ('master', claim.master),
+                           ('users', users)):
+            if self.uiState.get('tuner').get(key) != value:
+                self.uiState.setitem('tuner', key, value)
+        self._tunerPollDC = reactor.callLater(self.TUNER_POLL_INTERVAL,
+                                              self._pollTunerPool)
+
+    def _giveUpFrontend(self):
+        # the master went away and the pool made us master, but we read
+        # its ring file and cannot tune the frontend; release it so that
+        # nobody joins a multiplex nobody tunes, and go sad to be
+        # restarted, tuning it then
+        self.warning("The master of the shared frontend stopped")
+        if self._ringFollower:
+            self._ringFollower.stop()
+            self._ringFollower = None
+        self._tunerPool.release(self.name)
+        self._tunerClaim = None
+        self.addMessage(messages.Error(T_(N_(
+            "The component tuning the shared frontend stopped. "
+            "Restart this component to tune it instead.")),
+            mid='tuner-pool'))
+
+    def _setTunedPrograms(self, programs):
+        self.debug("Programs of the shared frontend: %r", programs)
+        self._tunedPrograms = programs
+        self.pipeline.get_by_name('src').set_property('program-numbers',
+            ':'.join(['%d' % n for n in programs]))
+        if self._pidFilter:
+            self._pidFilter.set_programs(programs)
+            self._applyPIDFilter()
+
     def _bus_message_received_cb(self, bus, message):
         """
         @param bus: the message bus sending the message
         @param message: the message received
         """
-        self.log("Bus message received %r", message)
-        if message.structure.get_name() == 'dvb-frontend-stats':
-            # we have frontend stats, lets update ui state
-            s = message.structure
-            self.uiState.set('signal', s["signal"])
-            self.uiState.set('snr', s["snr"])
-            self.uiState.set('ber', s["ber"])
-            self.uiState.set('unc', s["unc"])
-            self.uiState.set('lock', s["lock"])
-        elif message.structure.get_name() == 'pat':
-            self.log("PAT info received")
-            s = message.structure
-            for prog in s["programs"]:
-                self.log("PAT: Program %d on PID 0x%04x",
-                    prog["program-number"], prog["pid"])
-        elif message.structure.get_name() == 'pmt':
-            s = message.structure
-            self.log("PMT info received for program %d", s["program-number"])
-            for stream in s["streams"]:
-                self.log("PMT: Stream on pid 0x%04x of type: %d",
-                    stream["pid"],
-                    stream["stream-type"])
-        elif message.structure.get_name() == "sdt":
-            s = message.structure
-            actual = s["actual-transport-stream"]
-            if actual:
-                services = s["services"]
-                for service in services:
-                    name = service.get_name()
-                    sid = name[8:]
-                    if service.has_field("name"):
-                        name = service["name"]
-                    if sid in self.program_numbers:
-                        self.log("Setting channel %s to have name %s",
-                            sid, name)
-                        self.uiState.setitem('channelnames', sid, name)
-        elif message.structure.get_name() == "eit":
-            s = message.structure
-            self.log("eit received for sid %d", s["service-id"])
-            if str(s["service-id"]) in self.program_numbers:
-                events = s["events"]
-                for e in events:
-                    if e["running-status"] == 4:
-                        txt = "%d/%d/%d %d:%d (%d minutes)" % (
-                            e["day"], e["month"], e["year"], e["hour"],
-                            e["minute"], e["duration"] / 60)
-                        if e.has_field("name"):
-                            txt = "%s %s" % (txt, e["name"])
-                        if e.has_field("description"):
-                            txt = "%s: %s" % (txt, e["description"])
-                        self.log("Now on channel %s: %s",
-                            str(s["service-id"]), txt)
-                        self.uiState.setitem('whatson', str(s["service-id"]),
-                            txt)
-                    name = "None"
-                    if e.has_field("name"):
-                        name = e["name"]
-                    self.log("event %s of running status: %d",
-                        name,
-                        e["running-status"])
+        s = message.structure
+        if s.get_name() in self.PSI_MESSAGES and \
+               self._sections.structure_seen(s):
+            # a repetition of a section we already handled
+            return
+        self._dispatcher.dispatch(s)
+
+    def _handleFrontendStats(self, s):
+        # we have frontend stats, lets update ui state
+        if self._stats:
+            self._stats.update(dict([(k, s[k])
+                for k in frontend.STATS_KEYS if s.has_field(k)]))
+        if self._watchdog and s.has_field('lock'):
+            self._watchdog.update_lock(s['lock'])
+
+    def _handleReadFailure(self, s):
+        self.warning("Reading from the DVR device failed")
+        if self._watchdog:
+            self._watchdog.read_failed()
+
+    def _handlePAT(self, s):
+        self.log("PAT received with %d programs", len(s["programs"]))
+        if self._pidFilter:
+            self._pidFilter.update_pat(dict([(p["program-number"], p["pid"])
+                                             for p in s["programs"]]))
+            self._applyPIDFilter()
+
+    def _handlePMT(self, s):
+        self.log("PMT received for program %d with %d streams",
+            s["program-number"], len(s["streams"]))
+        if self._pidFilter:
+            pcr_pid = mpegts.PID_NULL
+            if s.has_field("pcr-pid"):
+                pcr_pid = s["pcr-pid"]
+            self._pidFilter.update_pmt(s["program-number"], pcr_pid,
+                [(stream["pid"], stream["stream-type"])
+                 for stream in s["streams"]])
+            self._applyPIDFilter()
+
+    def _applyPIDFilter(self):
+        pids = self._pidFilter.get_pids()
+        if pids is None:
+            return
+        if self._fileReader:
+            self._fileReader.set_pids(pids)
+            return
+        # dvbbasebin rebuilds the filter of its dvbsrc from the PAT and
+        # PMTs before posting them, so set ours again after each one
+        for element in self.pipeline.get_by_name('src').elements():
+            if element.get_factory().get_name() == 'dvbsrc':
+                value = ':'.join(['%d' % pid for pid in pids])
+                if element.get_property('pids') != value:
+                    self.debug("Filtering PIDs %s", value)
+                    element.set_property('pids', value)
+                return
+
+    def _handleSDT(self, s):
+        actual = s["actual-transport-stream"]
+        if not actual:
+            return
+        services = s["services"]
+        for service in services:
+            name = service.get_name()
+            sid = name[8:]
+            if service.has_field("name"):
+                name = service["name"]
+            if sid in self.program_numbers and \
+                   self.uiState.get('channelnames').get(sid) != name:
+                self.log("Setting channel %s to have name %s",
+                    sid, name)
+                self.uiState.setitem('channelnames', sid, name)
+
+    def _handleEIT(self, s):
+        self.log("eit received for sid %d", s["service-id"])
+        sid = str(s["service-id"])
+        if sid not in self.program_numbers or not self._epg:
+            return
+        if not self._epg.add_eit(epg.eit_from_structure(s)):
+            return
+        present, _ = self._epg.get_now_next(s["service-id"])
+        if present is None:
+            return
+        txt = epg.format_event(present)
+        if self.uiState.get('whatson').get(sid) != txt:
+            self.log("Now on channel %s: %s", sid, txt)
+            self.uiState.setitem('whatson', sid, txt)
+
+    # Remote methods
+
+    def getNowNext(self, serviceId):
+        """
+        @returns: (present, following) event dicts of serviceId, either
+                  can be None
+        """
+        if not self._epg:
+            return None, None
+        present, following = self._epg.get_now_next(serviceId)
+        return (present and epg.event_to_dict(present),
+                following and epg.event_to_dict(following))
+
+    def getSchedule(self, serviceId, start=None, end=None):
+        """
+        @returns: list of event dicts of serviceId overlapping
+                  [start, end), defaulting to the whole EPG window
+        """
+        if not self._epg:
+            return []
+        now = time.time()
+        if start is None:
+            start = now - self._epg.past
+        if end is None:
+            end = now + self._epg.future
+        return [epg.event_to_dict(e)
+                for e in self._epg.get_schedule(serviceId, start, end)]
+
+    def getMessageStats(self):
+        """
+        @returns: dict of bus message name -> dict with the number of
+                  calls and the total and maximum handling time
+        """
+        return self._dispatcher.get_stats()
+
+    def getTimeShiftRange(self):
+        """
+        @returns: (first time, last time, first offset, end offset) of the
+                  stream kept in the time-shift buffer; times are in
+                  seconds since the epoch, offsets in bytes
+        """
+        if not self._timeShift:
+            return None, None, 0, 0
+        first, last = self._timeShift.get_range()
+        return first, last, self._timeShift.oldest(), self._timeShift.written
+
+    def findTimeShiftOffset(self, timestamp):
+        """
+        @returns: the offset to read from to get the stream from timestamp
+                  on, starting at a random access point if possible, or
+                  None
+        """
+        if not self._timeShift:
+            return None
+        return self._timeShift.find(timestamp)
+
+    def readTimeShift(self, offset, size):
+        """
+        @returns: up to size bytes of the stream kept in the time-shift
+                  buffer, starting at offset, or None if they are not
+                  there any more
+        """
+        if not self._timeShift:
+            return None
+        return self._timeShift.read(offset, min(size, self.TIMESHIFT_MAX_READ))
+
+    def setProgram(self, programNumber):
+        """
+        Switch to another program of the multiplex without retuning.
+
+        @returns: a deferred firing with the program number once the
+                  pipeline produces the new program
+        """
+        programNumber = int(programNumber)
+        self.info("Switching to program %d", programNumber)
+        self.select_program(programNumber)
+        return defer.succeed(programNumber)
+
+    def select_program(self, programNumber):
+        """
+        Make the source give out programNumber instead of the current
+        programs, keeping the PSI already known.
+        """
+        self.program_numbers = [str(programNumber)]
+        # handle the tables repeated for the new program again
+        self._sections.reset()
+        if self._tunerClaim:
+            self._tunerPool.set_programs(self.name, [programNumber])
+        if self._tunerRing:
+            # keep giving out the programs of the other users too
+            self._setTunedPrograms(self.get_tuned_programs())
+            return
+        parser = self.pipeline.get_by_name('tsparse') or \
+                 self.pipeline.get_by_name('src')
+        parser.set_property('program-numbers', str(programNumber))
+        if self._pidFilter:
+            self._pidFilter.set_programs([programNumber])
+            if self._pidFilter.get_pids() is None and self._fileReader:
+                self._fileReader.set_pids(None)
+            self._applyPIDFilter()
 
 
 class DVB(DVBTSProducer, avproducer.AVProducerBase):
+    _autoDecoder = None
+    _lazyDecode = False
+    _decodeParked = False
+    _parkDC = None
+
+    # feeders whose eaters need the decode branch
+    DECODE_FEEDERS = ('audio', 'video')
+    # seconds to keep decoding after the last eater of the decoded feeders
+    # left, so that reconnecting eaters do not wait for the decoders
+    PARK_DELAY = 10
+    # seconds setProgram waits for the data going to the demuxer to stop
+    SWITCH_TIMEOUT = 10
 
     def do_check(self):
         d = avproducer.AVProducerBase.do_check(self)
@@ -271,22 +959,38 @@ class DVB(DVBTSProducer, avproducer.AVProducerBase):
         return d
 
     def get_raw_video_element(self):
-        return self.pipeline.get_by_name('videodecoder')
+        # the decoder is only there once the stream is known when chosen
+        # automatically, the identity after it gives out the same
+        return self.pipeline.get_by_name('videodecoder') or \
+               self.pipeline.get_by_name('videoid')
 
     def check_properties(self, props, addMessage):
         if props.get('scaled-width', None) is not None:
             self.warnDeprecatedProperties(['scaled-width'])
         if 'deinterlacer' in props:
             self.warnDeprecatedProperties(['deinterlacer'])
+        if props.get('lazy-decode', False) and \
+               props.get('dvb-type') == 'FILE' and \
+               not self.is_file_paced(props):
+            # a parked decode branch starves the feeders of the buffers
+            # they need to preroll from a source that is not live
+            msg = messages.Error(T_(N_(
+                "Property 'lazy-decode' needs a live source, set "
+                "'file-paced' to play out the file in real time.")),
+                mid='lazy-decode')
+            addMessage(msg)
         avproducer.AVProducerBase.check_properties(self, props, addMessage)
 
     def get_pipeline_template(self, props):
         dvbsrc_template = self.get_dvbsrc_pipeline_string(props)
-        decode_template = get_decode_pipeline_string(props)
-        template = "%s ! tee name=mpegtst ! " \
-            "queue max-size-time=0 max-size-buffers=0 ! %s" \
-            " mpegtst. ! queue max-size-time=0 max-size-buffers=0 ! " \
-            "@feeder:mpegts@" % (dvbsrc_template, decode_template)
+        decode_template = get_decode_pipeline_string(props,
+            audio_only=self.AUDIO_ONLY)
+        template = "%s ! tee name=mpegtst ! %s ! %s" \
+            " mpegtst. ! %s ! @feeder:mpegts@" % (
+            dvbsrc_template,
+            queues.get_queue_string(props, 'decode', 'decodequeue'),
+            decode_template,
+            queues.get_queue_string(props, 'mpegts', 'mpegtsqueue'))
         return template
 
     def get_pipeline_string(self, props):
@@ -296,23 +1000,278 @@ class DVB(DVBTSProducer, avproducer.AVProducerBase):
         DVBTSProducer.configure_pipeline(self, pipeline, props)
         avproducer.AVProducerBase.configure_pipeline(self, pipeline, props)
 
+        branches = get_auto_decoded(props, self.AUDIO_ONLY)
+        if branches:
+            self._autoDecoder = decoders.AutoDecoder(pipeline, branches,
+                audio_pid=props.get('audio-pid', 0),
+                ranking=decoders.load_ranking(),
+                plugged_cb=self._decoderPluggedCb)
+            self._autoDecoder.attach(pipeline.get_by_name('demux'))
+        self._attachDecoderMonitors()
+        self._timestamps = make_timestamp_monitor(pipeline, props,
+                                                  self.uiState)
+
+        self._lazyDecode = props.get('lazy-decode', False)
+        if self._lazyDecode:
+            self._decodeEaters = dict([(name, set())
+                                       for name in self.DECODE_FEEDERS])
+            # drop the transport stream going to the demuxer while
+            # parked, the mpegts feeder keeps flowing from the tee
+            queue = pipeline.get_by_name('decodequeue')
+            queue.get_pad('sink').add_buffer_probe(self._decodeProbeCb)
+            self._parkDecode()
+
+    def do_stop(self):
+        if self._parkDC:
+            self._parkDC.cancel()
+            self._parkDC = None
+        return DVBTSProducer.do_stop(self)
+
+    def feedToFD(self, feedName, fd, cleanup, eaterId=None):
+        ret = DVBTSProducer.feedToFD(self, feedName, fd, cleanup, eaterId)
+        if ret and self._lazyDecode and feedName in self.DECODE_FEEDERS:
+            self._decodeEaters[feedName].add(fd)
+            self._unparkDecode()
+        return ret
+
+    def removeClientCallback(self, sink, fd):
+        DVBTSProducer.removeClientCallback(self, sink, fd)
+        if self._lazyDecode:
+            # called from the streaming thread
+            feedName = ':'.join(sink.get_name().split(':')[1:])
+            reactor.callFromThread(self._decodeEaterRemoved, feedName, fd)
+
+    def _decodeEaterRemoved(self, feedName, fd):
+        if feedName not in self.DECODE_FEEDERS:
+            return
+        self._decodeEaters[feedName].discard(fd)
+        if not [fds for fds in self._decodeEaters.values() if fds] and \
+               not self._parkDC and not self._decodeParked:
+            self.debug("No eaters left for the decoded feeders, parking "
+                       "the decode branch in %d seconds", self.PARK_DELAY)
+            self._parkDC = reactor.callLater(self.PARK_DELAY,
+                                             self._parkDecode)
+
+    def _decodeProbeCb(self, pad, buffer):
+        return not self._decodeParked
+
+    def _parkDecode(self):
+        self._parkDC = None
+        self.info("Parking the decode branch")
+        self._decodeParked = True
+        # no data flows out of the decoders until an eater comes
+        self._detachDecoderMonitors()
+
+    def _unparkDecode(self):
+        if self._parkDC:
+            self._parkDC.cancel()
+            self._parkDC = None
+        if not self._decodeParked:
+            return
+        self.info("Resuming the decode branch")
+        self._decodeParked = False
+        self._attachDecoderMonitors()
+
+    def setProgram(self, programNumber):
+        programNumber = int(programNumber)
+        self.info("Switching to program %d", programNumber)
+        queue = self.pipeline.get_by_name('decodequeue')
+        pad = queue.get_pad('src')
+        d = defer.Deferred()
+
+        def blocked(pad, isBlocked):
+            # called from the streaming thread
+            if isBlocked:
+                reactor.callFromThread(swap)
+
+        def swap():
+            if timeoutDC.active():
+                timeoutDC.cancel()
+                # the source only changes program once the demuxer can
+                # follow, a timeout leaves both on the old one
+                self.select_program(programNumber)
+                self._swapDemuxer(queue, programNumber, d)
+
+        def timedOut():
+            pad.set_blocked_async(False, lambda *args: None)
+            self.warning("No data went to the demuxer for %d seconds, "
+                         "could not switch to program %d",
+                         self.SWITCH_TIMEOUT, programNumber)
+            d.errback(errors.ComponentError(
+                "Timed out switching to program %d" % programNumber))
+
+        timeoutDC = reactor.callLater(self.SWITCH_TIMEOUT, timedOut)
+        if self._decodeParked:
+            # nothing flows to the demuxer, the pad would never block
+            swap()
+            return d
+        # stop the data going to the demuxer, then replace it with one
+        # demuxing the new program; the source stays tuned meanwhile
+        pad.set_blocked_async(True, blocked)
+        return d
+
+    def _swapDemuxer(self, queue, programNumber, d):
+        old = self.pipeline.get_by_name('demux')
+        factory = old.get_factory().get_name()
+        old.set_state(gst.STATE_NULL)
+        self.pipeline.remove(old)
+
+        demux = gst.element_factory_make(factory, 'demux')
+        demux.set_property('program-number', programNumber)
+        if self._autoDecoder:
+            # it links the branches chosen from the stream, and changes
+            # their decoder when the new program needs another one
+            self._autoDecoder.attach(demux)
+        demux.connect('pad-added', self._demuxPadAddedCb)
+        self.pipeline.add(demux)
+        queue.link(demux)
+        demux.sync_state_with_parent()
+        queue.get_pad('src').set_blocked_async(False, lambda *args: None)
+        self.debug("Demuxing program %d", programNumber)
+        d.callback(programNumber)
+
+    def _demuxPadAddedCb(self, demux, pad):
+        # link the first audio and video streams of the new program to
+        # the decode branches, as the parse-launch pipeline did
+        name = pad.get_name()
+        for kind in ('audio', 'video'):
+            if not name.startswith(kind) or \
+                   self._autoDecoder and kind in self._autoDecoder.branches:
+                continue
+            queue = self.pipeline.get_by_name('%squeue' % kind)
+            if queue and not queue.get_pad('sink').is_linked():
+                self.debug("Linking %s to %s", name, queue.get_name())
+                pad.link(queue.get_pad('sink'))
+
+    def _decoderPluggedCb(self, name):
+        # the monitor of a replaced decoder watches a pad that is gone
+        if name in self._pad_monitors:
+            self._pad_monitors.remove(name)
+        if not self._decodeParked:
+            self._attachDecoderMonitors()
+
+    def _attachDecoderMonitors(self):
         # attach pad monitors to make sure we know when there is no
         # audio or video coming out
-        audiodecoder = pipeline.get_by_name('audiodecoder')
-        videodecoder = pipeline.get_by_name('videodecoder')
-        if audiodecoder:
-            self._pad_monitors.attach(audiodecoder.get_pad('src'),
-                "audiodecoder")
-        if videodecoder:
-            self._pad_monitors.attach(videodecoder.get_pad('src'),
-                "videodecoder")
+        for name in ('audiodecoder', 'videodecoder'):
+            decoder = self.pipeline.get_by_name(name)
+            if decoder and name not in self._pad_monitors:
+                self._pad_monitors.attach(decoder.get_pad('src'), name)
+
+    def _detachDecoderMonitors(self):
+        for name in ('audiodecoder', 'videodecoder'):
+            if name in self._pad_monitors:
+                self._pad_monitors.remove(name)
+
+
+class DVBAudio(DVB):
+    """
+    I decode only the audio of a program, for radio services, and feed
+    it besides the transport stream, without a video feeder.
+    """
+    AUDIO_ONLY = True
+    DECODE_FEEDERS = ('audio', )
+
+
+class DVBMultiProducer(DVBTSProducer):
+    """
+    I tune once and decode every program in program-numbers, each one
+    through its own decode branch fed from the single program pads of
+    the source bin, so the mux is demultiplexed only once.
+    Program N of the list is fed on audio-N and video-N.
+    """
+
+    def check_properties(self, props, addMessage):
+        programs = [p for p in props.get('program-numbers').split(':') if p]
+        if not programs:
+            msg = messages.Error(T_(N_(
+                "Property 'program-numbers' needs at least one program.")),
+                mid='program-numbers')
+            addMessage(msg)
+        elif len(programs) > MAX_PROGRAMS:
+            msg = messages.Error(T_(N_(
+                "A dvb-multi-producer can decode at most %d programs, "
+                "but %d were requested."), MAX_PROGRAMS, len(programs)),
+                mid='program-numbers')
+            addMessage(msg)
+
+    def get_pipeline_string(self, props):
+        dvbsrc_template = self.get_dvbsrc_pipeline_string(props)
+        template = "%s ! %s ! @feeder:mpegts@" % (
+            dvbsrc_template,
+            queues.get_queue_string(props, 'mpegts', 'mpegtsqueue'))
+        for i in range(MAX_PROGRAMS):
+            suffix = '-%d' % (i + 1)
+            if i < len(self.program_numbers):
+                program_number = int(self.program_numbers[i])
+                template = "%s %s ! %s ! %s" % (
+                    template, self.get_program_pad_template(program_number),
+                    queues.get_queue_string(props, 'decode',
+                                            'decodequeue' + suffix),
+                    get_decode_pipeline_string(props, program_number,
+                                               suffix))
+            else:
+                # the registry declares a fixed set of feeders, unused
+                # ones are fed an immediate EOS
+                template = "%s fakesrc num-buffers=0 ! @feeder:audio%s@" \
+                    " fakesrc num-buffers=0 ! @feeder:video%s@" % (
+                    template, suffix, suffix)
+        return template
+
+    def setProgram(self, programNumber):
+        return defer.fail(errors.PropertyError(
+            "A dvb-multi-producer decodes a fixed set of programs"))
+
+    def _decoderPluggedCb(self, name):
+        if name in self._pad_monitors:
+            self._pad_monitors.remove(name)
+        decoder = self.pipeline.get_by_name(name)
+        self._pad_monitors.attach(decoder.get_pad('src'), name)
+
+    def configure_pipeline(self, pipeline, props):
+        DVBTSProducer.configure_pipeline(self, pipeline, props)
+
+        branches = get_auto_decoded(props)
+        if branches:
+            ranking = decoders.load_ranking()
+            for i in range(len(self.program_numbers)):
+                suffix = '-%d' % (i + 1)
+                decoder = decoders.AutoDecoder(pipeline, branches, suffix,
+                    audio_pid=props.get('audio-pid', 0), ranking=ranking,
+                    plugged_cb=self._decoderPluggedCb)
+                decoder.attach(pipeline.get_by_name('demux' + suffix))
+        self._timestamps = make_timestamp_monitor(pipeline, props,
+            self.uiState, ['-%d' % (i + 1)
+                           for i in range(len(self.program_numbers))])
+
+        # attach pad monitors to make sure we know when there is no
+        # audio or video coming out of any of the programs
+        for i in range(len(self.program_numbers)):
+            for kind in ('audio', 'video'):
+                name = '%sdecoder-%d' % (kind, i + 1)
+                decoder = pipeline.get_by_name(name)
+                if decoder:
+                    self._pad_monitors.attach(decoder.get_pad('src'), name)
 
 
 class MpegTSSplitter(DVBTSProducer):
+    """
+    I split a transport stream into single program transport streams,
+    parsing it only once whatever the number of programs.
+    Program N of program-numbers is fed on program-N, and the first one
+    on default too. Each feeder is linked once its program shows up in
+    the PAT.
+    """
+    _feederPad = None
+    _programPadDeferred = None
+    _switchDC = None
+
+    # seconds setProgram waits for the new program to show up in the PAT
+    SWITCH_TIMEOUT = 10
 
     def init(self):
-        self.uiState.addDictKey('channelnames')
-        self.uiState.addDictKey('whatson')
+        self.uiState.addDictKey('programs')
+        self.init_tables()
 
     def do_check_dvb(self):
         tsparse_element = gst.element_factory_make("mpegtsparse")
@@ -321,17 +1280,144 @@ class MpegTSSplitter(DVBTSProducer):
                 "Please upgrade to at least gst-plugins-bad 0.10.6."
             return defer.fail(errors.ConfigError(msg))
 
+    def check_properties(self, props, addMessage):
+        programs = [p for p in props.get('program-numbers', '').split(':')
+                    if p]
+        if not programs and props.get('program-number') is None:
+            msg = messages.Error(T_(N_(
+                "Property 'program-number' or 'program-numbers' is "
+                "needed.")), mid='program-numbers')
+            addMessage(msg)
+        elif len(programs) > MAX_PROGRAMS:
+            msg = messages.Error(T_(N_(
+                "A mpeg-ts-splitter can split at most %d programs, "
+                "but %d were requested."), MAX_PROGRAMS, len(programs)),
+                mid='program-numbers')
+            addMessage(msg)
+
     def get_pipeline_string(self, props):
-        program_number = props.get("program-number")
-        template = "mpegtsparse program-numbers=%d .program_%d" % (
-            program_number, program_number)
+        program_numbers = props.get('program-numbers')
+        if not program_numbers:
+            program_numbers = "%d" % props.get("program-number")
+        self.program_numbers = [p for p in program_numbers.split(':') if p]
+        template = "@eater:default@ ! mpegtsparse name=tsparse" \
+            " program-numbers=%s" % ':'.join(self.program_numbers)
+        for i in range(MAX_PROGRAMS):
+            feeder = 'program-%d' % (i + 1)
+            if i >= len(self.program_numbers):
+                # the registry declares a fixed set of feeders, unused
+                # ones are fed an immediate EOS
+                template = "%s fakesrc num-buffers=0 ! @feeder:%s@" % (
+                    template, feeder)
+                continue
+            template = "%s tsparse.program_%s" % (
+                template, self.program_numbers[i])
+            if i == 0:
+                template = "%s ! tee name=programt ! @feeder:default@" \
+                    " programt." % template
+            template = "%s ! @feeder:%s@" % (template, feeder)
         return template
 
+    def configure_pipeline(self, pipeline, properties):
+        DVBTSProducer.configure_pipeline(self, pipeline, properties)
+        parser = pipeline.get_by_name('tsparse')
+        parser.connect('pad-added', self._parserPadAddedCb)
+
+    def setProgram(self, programNumber):
+        if len(self.program_numbers) > 1:
+            return defer.fail(errors.PropertyError(
+                "A mpeg-ts-splitter splitting several programs cannot "
+                "switch programs"))
+        if self._programPadDeferred:
+            return defer.fail(errors.ComponentError(
+                "Already switching to another program"))
+        programNumber = int(programNumber)
+        previous = int(self.program_numbers[0])
+        self.info("Switching to program %d", programNumber)
+        parser = self.pipeline.get_by_name('tsparse')
+        pad = parser.get_pad('program_%d' % previous)
+        if pad and pad.is_linked():
+            self._feederPad = pad.get_peer()
+        d = self._programPadDeferred = defer.Deferred()
+        self._switchDC = reactor.callLater(self.SWITCH_TIMEOUT,
+                                           self._switchTimedOut,
+                                           programNumber, previous)
+        # mpegtsparse removes the old program pad and adds the new one
+        # once it sees the PMT of the new program
+        self.select_program(programNumber)
+        return d
+
+    def _switchTimedOut(self, programNumber, previous):
+        self._switchDC = None
+        d = self._programPadDeferred
+        self._programPadDeferred = None
+        self.warning("Program %d did not show up in %d seconds, going "
+                     "back to program %d", programNumber,
+                     self.SWITCH_TIMEOUT, previous)
+        if self._feederPad and self._feederPad.is_linked():
+            # the old program pad was never removed
+            self._feederPad = None
+        # the feeder is linked again when the old program pad is back
+        self.select_program(previous)
+        d.errback(errors.ComponentError(
+            "Timed out switching to program %d" % programNumber))
+
+    def _parserPadAddedCb(self, parser, pad):
+        # called from the streaming thread
+        name = pad.get_name()
+        programNumber = name[len('program_'):]
+        if programNumber in self.program_numbers:
+            reactor.callFromThread(self._programAdded, programNumber)
+        feederPad = self._feederPad
+        if name != 'program_%s' % self.program_numbers[0] or \
+               not feederPad or feederPad.is_linked():
+            return
+        pad.link(feederPad)
+        self._feederPad = None
+        reactor.callFromThread(self._programLinked, int(programNumber))
+
+    def _programLinked(self, programNumber):
+        d = self._programPadDeferred
+        if not d:
+            return
+        self._programPadDeferred = None
+        if self._switchDC:
+            self._switchDC.cancel()
+            self._switchDC = None
+        d.callback(programNumber)
+
+    def _programAdded(self, programNumber):
+        if programNumber not in self.program_numbers:
+            return
+        feeder = 'program-%d' % (self.program_numbers.index(programNumber)
+                                 + 1)
+        self.debug("Program %s is in the PAT, feeding it on %s",
+                   programNumber, feeder)
+        # a program switched from is not fed any more
+        for number in self.uiState.get('programs').keys():
+            if number not in self.program_numbers:
+                self.uiState.delitem('programs', number)
+        self.uiState.setitem('programs', programNumber, feeder)
+
+    def do_stop(self):
+        if self._switchDC:
+            self._switchDC.cancel()
+            self._switchDC = None
+        return DVBTSProducer.do_stop(self)
+
 
 class MpegTSDecoder(avproducer.AVProducerBase):
+    _timestamps = None
+
+    # whether the registry declares no video feeder
+    AUDIO_ONLY = False
+
+    def init(self):
+        self.uiState.addDictKey('timestamps')
 
     def get_raw_video_element(self):
-        return self.pipeline.get_by_name('videodecoder')
+        return self.pipeline.get_by_name('videodecoder') or \
+               self.pipeline.get_by_name('videoid')
 
     def check_properties(self, props, addMessage):
         if props.get('scaled-width', None) is not None:
@@ -341,11 +1427,22 @@ class MpegTSDecoder(avproducer.AVProducerBase):
         avproducer.AVProducerBase.check_properties(self, props, addMessage)
 
     def get_pipeline_template(self, props):
-        return get_decode_pipeline_string(props)
+        return get_decode_pipeline_string(props,
+            audio_only=self.AUDIO_ONLY)
 
     def configure_pipeline(self, pipeline, props):
         avproducer.AVProducerBase.configure_pipeline(self, pipeline, props)
 
+        branches = get_auto_decoded(props, self.AUDIO_ONLY)
+        if branches:
+            decoder = decoders.AutoDecoder(pipeline, branches,
+                audio_pid=props.get('audio-pid', 0),
+                ranking=decoders.load_ranking(),
+                plugged_cb=self._decoderPluggedCb)
+            decoder.attach(pipeline.get_by_name('demux'))
+        self._timestamps = make_timestamp_monitor(pipeline, props,
+                                                  self.uiState)
+
         # attach pad monitors to make sure we know when there is no
         # audio or video coming out
         audiodecoder = pipeline.get_by_name('audiodecoder')
@@ -356,3 +1453,23 @@ class MpegTSDecoder(avproducer.AVProducerBase):
         if videodecoder:
             self._pad_monitors.attach(videodecoder.get_pad('src'),
                                   "videodecoder")
+
+    def _decoderPluggedCb(self, name):
+        if name in self._pad_monitors:
+            self._pad_monitors.remove(name)
+        decoder = self.pipeline.get_by_name(name)
+        self._pad_monitors.attach(decoder.get_pad('src'), name)
+
+    def do_stop(self):
+        if self._timestamps:
+            self._timestamps.stop()
+            self._timestamps = None
+        return avproducer.AVProducerBase.do_stop(self)
+
+
+class MpegTSAudioDecoder(MpegTSDecoder):
+    """
+    I decode only the audio of a program out of a transport stream,
+    without a video feeder.
+    """
+    AUDIO_ONLY = True
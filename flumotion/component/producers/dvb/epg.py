@@ -0,0 +1,248 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+In-memory electronic program guide built from EIT tables.
+"""
+
+import bisect
+import calendar
+import time
+
+from flumotion.component.producers.dvb import mpegts
+
+RUNNING = 4
+
+
+def eit_from_structure(s):
+    """
+    Convert an eit message structure posted by mpegtsparse into an
+    L{mpegts.EIT} record.
+    """
+    events = []
+    for e in s["events"]:
+        second = 0
+        if e.has_field("second"):
+            second = e["second"]
+        start = calendar.timegm((e["year"], e["month"], e["day"],
+                                 e["hour"], e["minute"], second, 0, 0, 0))
+        event = mpegts.Event(event_id=None, start=start,
+                             duration=e["duration"],
+                             running_status=e["running-status"],
+                             name=None, description=None, language=None)
+        for field, attr in (("event-id", "event_id"), ("name", "name"),
+                            ("description", "description")):
+            if e.has_field(field):
+                setattr(event, attr, e[field])
+        if event.event_id is None:
+            # old mpegtsparse, the start time identifies the event well
+            # enough on a single service
+            event.event_id = start
+        events.append(event)
+
+    def field(name, default=None):
+        if s.has_field(name):
+            return s[name]
+        return default
+    return mpegts.EIT(table_id=field("table-id"),
+                      service_id=s["service-id"],
+                      transport_stream_id=field("transport-stream-id"),
+                      version=field("version-number"),
+                      section_number=field("section-number", 0),
+                      present_following=field("present-following", False),
+                      actual=field("actual-transport-stream", True),
+                      events=events)
+
+
+def event_to_dict(event):
+    """
+    Return a dict describing event that can be sent over PB.
+    """
+    return dict(event_id=event.event_id, start=event.start,
+                duration=event.duration,
+                running_status=event.running_status, name=event.name,
+                description=event.description, language=event.language)
+
+
+def format_event(event):
+    """
+    Return the "what's on" text shown for event in the admin.
+    """
+    # EIT times are UTC
+    t = time.gmtime(event.start)
+    txt = "%d/%d/%d %d:%d (%d minutes)" % (
+        t.tm_mday, t.tm_mon, t.tm_year, t.tm_hour, t.tm_min,
+        event.duration / 60)
+    if event.name:
+        txt = "%s %s" % (txt, event.name)
+    if event.description:
+        txt = "%s: %s" % (txt, event.description)
+    return txt
+
+
+class _Schedule(object):
+    """
+    Events of one service, by event id and ordered by start time.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.versions = {}
+        self.starts = []
+
+    def add(self, event, version):
+        old = self.events.get(event.event_id)
+        if old is not None:
+            if self.versions[event.event_id] == version and \
+                   old.running_status == event.running_status:
+                return False
+            self.remove(event.event_id)
+        self.events[event.event_id] = event
+        self.versions[event.event_id] = version
+        bisect.insort(self.starts, (event.start, event.event_id))
+        return True
+
+    def remove(self, event_id):
+        event = self.events.pop(event_id)
+        del self.versions[event_id]
+        i = bisect.bisect_left(self.starts, (event.start, event_id))
+        if i < len(self.starts) and self.starts[i] == (event.start, event_id):
+            del self.starts[i]
+
+    def between(self, start, end):
+        # events starting before start may still be running
+        i = bisect.bisect_left(self.starts, (start, -1))
+        while i > 0:
+            event = self.events[self.starts[i - 1][1]]
+            if event.start + event.duration <= start:
+                break
+            i -= 1
+        j = bisect.bisect_left(self.starts, (end, -1))
+        return [self.events[eid] for _, eid in self.starts[i:j]]
+
+
+class EPGStore(object):
+    """
+    I keep the events of each service announced in the EIT, within a time
+    window around now.
+
+    @ivar sections: number of EIT sections offered to me
+    @ivar skipped:  number of those that were already known
+    """
+
+    def __init__(self, past=3600, future=7 * 86400, max_events=1000,
+                 expire_interval=60):
+        """
+        @param past:       keep events that ended at most this many
+                           seconds ago
+        @param future:     keep events starting at most this many seconds
+                           from now
+        @param max_events: maximum number of events kept per service
+        """
+        self.past = past
+        self.future = future
+        self.max_events = max_events
+        self.expire_interval = expire_interval
+        self.sections = 0
+        self.skipped = 0
+        self._schedules = {}
+        self._sectionVersions = {}
+        self._lastExpire = 0
+
+    def add_eit(self, eit, now=None):
+        """
+        Add the events of an EIT section.
+
+        @type  eit: L{mpegts.EIT}
+        @returns: whether anything changed
+        """
+        if now is None:
+            now = time.time()
+        self.sections += 1
+        key = (eit.service_id, eit.table_id, eit.section_number)
+        if eit.version is not None and \
+               self._sectionVersions.get(key) == eit.version:
+            self.skipped += 1
+            return False
+        self._sectionVersions[key] = eit.version
+
+        if now - self._lastExpire >= self.expire_interval:
+            self.expire(now)
+
+        schedule = self._schedules.get(eit.service_id)
+        if schedule is None:
+            schedule = self._schedules[eit.service_id] = _Schedule()
+        changed = False
+        for event in eit.events:
+            if event.start is None or not self._inWindow(event, now):
+                continue
+            if schedule.add(event, eit.version):
+                changed = True
+        while len(schedule.events) > self.max_events:
+            # drop the furthest event in the future
+            schedule.remove(schedule.starts[-1][1])
+        return changed
+
+    def expire(self, now=None):
+        """
+        Drop the events outside the time window.
+        """
+        if now is None:
+            now = time.time()
+        self._lastExpire = now
+        for schedule in self._schedules.values():
+            for event in schedule.events.values():
+                if not self._inWindow(event, now):
+                    schedule.remove(event.event_id)
+
+    def get_services(self):
+        return self._schedules.keys()
+
+    def get_now_next(self, service_id, now=None):
+        """
+        @returns: (present event, following event); either can be None
+        """
+        if now is None:
+            now = time.time()
+        schedule = self._schedules.get(service_id)
+        if not schedule:
+            return None, None
+        present = following = None
+        # the running status is authoritative, the clock only a fallback
+        for event in schedule.between(now - self.past, now + self.future):
+            if event.start > now:
+                following = event
+                break
+            if event.running_status == RUNNING or \
+                   (event.start + event.duration > now and
+                    (present is None or present.running_status != RUNNING)):
+                present = event
+        return present, following
+
+    def get_schedule(self, service_id, start, end):
+        """
+        @returns: the events of service_id overlapping [start, end),
+                  ordered by start time
+        """
+        schedule = self._schedules.get(service_id)
+        if not schedule:
+            return []
+        return schedule.between(start, end)
+
+    def _inWindow(self, event, now):
+        return (event.start + event.duration >= now - self.past and
+                event.start <= now + self.future)
@@ -0,0 +1,304 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import random
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.common import log
+
+# Statistics we get from DVB are:
+# signal: signal strength (0 - 65535)
+# snr: signal to noise ratio (0 - 65535)
+# ber: bit error rate (seems to be driver specific scale)
+# unc: uncorrected bits (should be cumulative but drivers do not follow spec)
+# lock: locked to signal (boolean)
+STATS_KEYS = ('signal', 'snr', 'ber', 'unc', 'lock')
+STATS_SCALE = 65535
+
+
+class FrontendStatsPublisher(log.Loggable):
+    """
+    I mirror the dvb-frontend-stats messages into the uiState, only
+    setting the values that changed by more than a threshold and at most
+    once every min_interval seconds, so connected admins are not flooded.
+
+    I also adapt the reporting interval of the source: fast while the
+    frontend is not locked, slow once the values are stable.
+    """
+    logCategory = 'dvb'
+
+    # number of reports without a significant change before the frontend
+    # is considered stable
+    STABLE_REPORTS = 3
+
+    def __init__(self, uiState, element=None, threshold=1.0,
+                 min_interval=1.0, fast_interval=1000, slow_interval=5000):
+        """
+        @param uiState:       the uiState to publish to
+        @param element:       the source element reporting the statistics
+        @param threshold:     percentage a value has to change by to be
+                              published
+        @param min_interval:  minimum time between publications, in seconds
+        @param fast_interval: reporting interval while unlocked or
+                              unstable, in milliseconds
+        @param slow_interval: reporting interval once stable, in
+                              milliseconds
+        """
+        self._uiState = uiState
+        self._element = element
+        self._threshold = threshold
+        self._minInterval = min_interval
+        self._fastInterval = fast_interval
+        self._slowInterval = slow_interval
+        self._published = dict([(k, uiState.get(k)) for k in STATS_KEYS])
+        self._pending = {}
+        self._lastFlush = 0
+        self._flushDC = None
+        self._stableReports = 0
+        self._interval = None
+        self.received = 0
+        self.published = 0
+
+        self._setInterval(self._fastInterval)
+
+    def stop(self):
+        if self._flushDC:
+            self._flushDC.cancel()
+            self._flushDC = None
+
+    def update(self, stats):
+        """
+        @param stats: dict of statistic name -> value
+        """
+        self.received += 1
+        changed = False
+        for key in STATS_KEYS:
+            if key not in stats:
+                continue
+            value = stats[key]
+            if self._significant(key, self._published[key], value):
+                self._pending[key] = value
+                changed = True
+            elif key in self._pending:
+                # back to the published value before we got to flush it
+                del self._pending[key]
+
+        locked = stats.get('lock', self._published['lock'])
+        if changed or not locked:
+            self._stableReports = 0
+            self._setInterval(self._fastInterval)
+        else:
+            self._stableReports += 1
+            if self._stableReports >= self.STABLE_REPORTS:
+                self._setInterval(self._slowInterval)
+
+        if not self._pending:
+            return
+        elapsed = time.time() - self._lastFlush
+        if 'lock' in self._pending or elapsed >= self._minInterval:
+            self._flush()
+        elif not self._flushDC:
+            self._flushDC = reactor.callLater(self._minInterval - elapsed,
+                                              self._flush)
+
+    def _significant(self, key, old, new):
+        if old == new:
+            return False
+        if key == 'lock' or old is None:
+            return True
+        if key in ('signal', 'snr'):
+            return abs(new - old) * 100.0 / STATS_SCALE >= self._threshold
+        # ber and unc do not have a well defined scale
+        if not old or not new:
+            return True
+        return abs(new - old) * 100.0 / max(old, new) >= self._threshold
+
+    def _flush(self):
+        if self._flushDC and self._flushDC.active():
+            self._flushDC.cancel()
+        self._flushDC = None
+        self._lastFlush = time.time()
+        for key, value in self._pending.items():
+            self._uiState.set(key, value)
+            self._published[key] = value
+            self.published += 1
+        self._pending = {}
+
+    def _setInterval(self, interval):
+        if interval == self._interval or not self._element:
+            return
+        self.debug("Setting stats reporting interval to %d ms", interval)
+        self._interval = interval
+        self._element.set_property('stats-reporting-interval', interval)
+
+
+class LockWatchdog(log.Loggable):
+    """
+    I notice when the frontend loses the lock, stops giving out data or
+    fails to be read, and have it retuned, waiting exponentially longer
+    between attempts, with some jitter, while the outage lasts.
+
+    I keep track of the outages, how long they lasted and how many of
+    them a retune got us out of.
+    """
+    logCategory = 'dvb'
+
+    def __init__(self, retune, timeout=5.0, min_backoff=1.0,
+                 max_backoff=60.0, jitter=0.2, check_interval=1.0):
+        """
+        @param retune:         called to retune the frontend, can return
+                               a deferred firing once done
+        @param timeout:        seconds without lock or without data before
+                               it is an outage
+        @param min_backoff:    seconds between the first two retunes of an
+                               outage, doubled after each one
+        @param max_backoff:    maximum seconds between two retunes
+        @param jitter:         fraction of the delay between retunes
+                               randomly added or taken away
+        @param check_interval: seconds between checks
+        """
+        self._retune = retune
+        self._timeout = timeout
+        self._minBackoff = min_backoff
+        self._maxBackoff = max_backoff
+        self._jitter = jitter
+        self._checkInterval = check_interval
+        self._checkDC = None
+        self._retuning = False
+        now = time.time()
+        # the frontend gets timeout seconds to lock when we start
+        self._unlockedSince = now
+        self.lastData = now
+        self._readFailed = False
+        self._outageStart = None
+        self._outageRetunes = 0
+        self._nextRetune = None
+        self._backoff = min_backoff
+        self.outages = 0
+        self.retunes = 0
+        self.recoveries = 0
+        self.last_outage = 0.0
+        self.longest_outage = 0.0
+        self.total_outage = 0.0
+
+    def start(self):
+        self._checkDC = reactor.callLater(self._checkInterval, self._check)
+
+    def stop(self):
+        if self._checkDC:
+            self._checkDC.cancel()
+            self._checkDC = None
+
+    def update_lock(self, locked):
+        if not locked and self._unlockedSince is None:
+            self._unlockedSince = time.time()
+        elif locked:
+            self._unlockedSince = None
+
+    def data_received(self):
+        # called from the streaming thread, keep it cheap
+        self.lastData = time.time()
+
+    def read_failed(self):
+        self._readFailed = True
+
+    def _check(self):
+        self._checkDC = None
+        now = time.time()
+        reason = self._getFailure(now)
+        if reason and self._outageStart is None:
+            self.warning("Frontend outage: %s", reason)
+            self.outages += 1
+            self._outageStart = now
+            self._outageRetunes = 0
+            self._backoff = self._minBackoff
+            self._nextRetune = now
+        elif not reason and self._outageStart is not None:
+            self._endOutage(now)
+        if self._outageStart is not None and not self._retuning and \
+               now >= self._nextRetune:
+            self._doRetune(now)
+        self._checkDC = reactor.callLater(self._checkInterval, self._check)
+
+    def _getFailure(self, now):
+        lockTimeout = dataTimeout = self._timeout
+        if self._outageStart is not None:
+            # recovering takes both the lock and the data back
+            lockTimeout = 0
+            dataTimeout = self._checkInterval
+        if self._readFailed:
+            return "reading the DVR device failed"
+        if self._unlockedSince is not None and \
+               now - self._unlockedSince >= lockTimeout:
+            return "no lock for %.1f seconds" % (now - self._unlockedSince)
+        if now - self.lastData >= dataTimeout:
+            return "no data for %.1f seconds" % (now - self.lastData)
+        return None
+
+    def _endOutage(self, now):
+        duration = now - self._outageStart
+        self._outageStart = None
+        self.last_outage = duration
+        self.longest_outage = max(self.longest_outage, duration)
+        self.total_outage += duration
+        if self._outageRetunes:
+            self.recoveries += 1
+        self.info("Frontend recovered after %.1f seconds and %d retunes",
+                  duration, self._outageRetunes)
+
+    def _doRetune(self, now):
+        self.retunes += 1
+        self._outageRetunes += 1
+        self._readFailed = False
+        delay = self._backoff * (1 + random.uniform(-self._jitter,
+                                                    self._jitter))
+        self._nextRetune = now + delay
+        self._backoff = min(self._backoff * 2, self._maxBackoff)
+        self.info("Retuning the frontend, attempt %d, next one in %.1f "
+                  "seconds", self._outageRetunes, delay)
+        self._retuning = True
+
+        def done(result):
+            self._retuning = False
+
+        def failed(failure):
+            self.warning("Retuning failed: %s",
+                         failure.getErrorMessage())
+        d = defer.maybeDeferred(self._retune)
+        d.addErrback(failed)
+        d.addCallback(done)
+
+    def get_stats(self):
+        """
+        @returns: dict with the number of outages, retunes and outages
+                  recovered from by retuning, and the durations of the
+                  current, last and longest outage and of all of them,
+                  in seconds
+        """
+        current = 0.0
+        if self._outageStart is not None:
+            current = time.time() - self._outageStart
+        return {
+            'outages': self.outages,
+            'retunes': self.retunes,
+            'recoveries': self.recoveries,
+            'outage-current': round(current, 1),
+            'outage-last': round(self.last_outage, 1),
+            'outage-longest': round(self.longest_outage, 1),
+            'outage-total': round(self.total_outage + current, 1)}
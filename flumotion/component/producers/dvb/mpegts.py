@@ -0,0 +1,967 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+MPEG transport stream packet walking and PSI/SI section parsing.
+
+This module does not depend on GStreamer so it can be shared between the
+DVB components and the worker checks. Buffers are walked in place: a
+bytearray is never copied, packets are addressed by offset and sections
+that fit in a single packet are parsed straight out of the buffer. Only
+sections spanning several packets are reassembled into their own
+bytearray.
+"""
+
+import calendar
+
+PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+
+PID_PAT = 0x0000
+PID_CAT = 0x0001
+PID_NIT = 0x0010
+PID_SDT = 0x0011
+PID_EIT = 0x0012
+PID_TDT = 0x0014
+PID_NULL = 0x1fff
+
+TABLE_PAT = 0x00
+TABLE_PMT = 0x02
+TABLE_NIT_ACTUAL = 0x40
+TABLE_NIT_OTHER = 0x41
+TABLE_SDT_ACTUAL = 0x42
+TABLE_SDT_OTHER = 0x46
+TABLE_EIT_FIRST = 0x4e
+TABLE_EIT_LAST = 0x6f
+
+# stream types we know how to name, from ISO/IEC 13818-1 and ETSI EN 300 468
+STREAM_TYPES = {
+    0x01: 'mpeg1-video',
+    0x02: 'mpeg2-video',
+    0x03: 'mpeg1-audio',
+    0x04: 'mpeg2-audio',
+    0x06: 'private-pes',
+    0x0f: 'aac-adts',
+    0x11: 'aac-latm',
+    0x1b: 'h264-video',
+    0x81: 'ac3-audio',
+}
+VIDEO_STREAM_TYPES = (0x01, 0x02, 0x1b)
+AUDIO_STREAM_TYPES = (0x03, 0x04, 0x0f, 0x11, 0x81)
+
+_CODE_RATES = ["1/2", "2/3", "3/4", "5/6", "7/8"]
+_POLARIZATIONS = ["horizontal", "vertical", "left", "right"]
+
+
+def _make_crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            if crc & 0x80000000:
+                crc = ((crc << 1) ^ 0x04c11db7) & 0xffffffff
+            else:
+                crc = (crc << 1) & 0xffffffff
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _make_crc_table()
+
+
+def crc32(data, start=0, end=None):
+    """
+    Compute the MPEG-2 CRC32 of data[start:end].
+    Running it over a complete section, CRC included, yields 0.
+
+    @type  data: bytearray
+    @rtype: int
+    """
+    if end is None:
+        end = len(data)
+    crc = 0xffffffff
+    table = _CRC_TABLE
+    for i in xrange(start, end):
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ data[i]]
+    return crc
+
+
+def as_buffer(data):
+    """
+    Return data as a bytearray. A bytearray is returned as is; str,
+    buffer and memoryview objects are copied once.
+    """
+    if isinstance(data, bytearray):
+        return data
+    return bytearray(data)
+
+
+def find_sync(data, offset=0):
+    """
+    Find the offset of the first packet boundary at or after offset,
+    requiring two consecutive sync bytes when the buffer allows it.
+
+    @returns: offset, or -1 if there is no sync byte
+    """
+    end = len(data)
+    while offset < end:
+        if data[offset] == SYNC_BYTE:
+            nxt = offset + PACKET_SIZE
+            if nxt >= end or data[nxt] == SYNC_BYTE:
+                return offset
+        offset += 1
+    return -1
+
+
+def iter_packets(data, offset=0):
+    """
+    Yield the offset of each complete packet in data, resynchronising
+    on garbage.
+
+    @type  data: bytearray
+    """
+    end = len(data) - PACKET_SIZE
+    while offset <= end:
+        if data[offset] != SYNC_BYTE:
+            offset = find_sync(data, offset)
+            if offset < 0 or offset > end:
+                return
+        yield offset
+        offset += PACKET_SIZE
+
+
+def packet_pid(data, offset):
+    return ((data[offset + 1] & 0x1f) << 8) | data[offset + 2]
+
+
+def payload_bounds(data, offset):
+    """
+    Return (start, end) of the payload of the packet at offset, or
+    (end, end) if it carries no payload.
+    """
+    end = offset + PACKET_SIZE
+    afc = (data[offset + 3] >> 4) & 0x3
+    if not afc & 0x1:
+        return end, end
+    start = offset + 4
+    if afc & 0x2:
+        start += 1 + data[start]
+    if start > end:
+        start = end
+    return start, end
+
+
+def read_pcr(data, offset):
+    """
+    Return the PCR base (90kHz units) carried in the adaptation field of
+    the packet at offset, or None.
+    """
+    afc = (data[offset + 3] >> 4) & 0x3
+    if not afc & 0x2 or data[offset + 4] < 7:
+        return None
+    if not data[offset + 5] & 0x10:
+        return None
+    p = offset + 6
+    return ((data[p] << 25) | (data[p + 1] << 17) | (data[p + 2] << 9) |
+            (data[p + 3] << 1) | (data[p + 4] >> 7))
+
+
+def decode_text(data, start, end):
+    """
+    Decode a DVB text field (ETSI EN 300 468 annex A) to unicode.
+    """
+    if start >= end:
+        return u''
+    encoding = 'iso6937'
+    first = data[start]
+    if first < 0x20:
+        if 0x01 <= first <= 0x0b:
+            encoding = 'iso8859-%d' % (first + 4)
+            start += 1
+        elif first == 0x10 and end - start >= 3:
+            encoding = 'iso8859-%d' % data[start + 2]
+            start += 3
+        elif first == 0x11:
+            encoding = 'utf-16-be'
+            start += 1
+        elif first == 0x15:
+            encoding = 'utf-8'
+            start += 1
+        else:
+            start += 1
+    raw = str(data[start:end])
+    # strip emphasis control codes
+    raw = raw.replace('\x86', '').replace('\x87', '')
+    if encoding == 'iso6937':
+        # python has no codec for it, latin-1 covers the common subset
+        encoding = 'latin-1'
+    try:
+        return raw.decode(encoding, 'replace')
+    except LookupError:
+        return raw.decode('latin-1')
+
+
+def _bcd(value, digits):
+    result = 0
+    for shift in range((digits - 1) * 4, -1, -4):
+        result = result * 10 + ((value >> shift) & 0xf)
+    return result
+
+
+def _bcd_bytes(data, start, count):
+    value = 0
+    for i in range(count):
+        value = (value << 8) | data[start + i]
+    return _bcd(value, count * 2)
+
+
+def _iter_descriptors(data, start, end):
+    while start + 2 <= end:
+        tag = data[start]
+        length = data[start + 1]
+        dstart = start + 2
+        dend = dstart + length
+        if dend > end:
+            return
+        yield tag, dstart, dend
+        start = dend
+
+
+class Section(object):
+    """
+    A complete PSI/SI section living in data[start:end].
+
+    @ivar table_id:       table id
+    @ivar extension:      table id extension (program number,
+                          transport stream id, service id, ...)
+    @ivar version:        version number
+    @ivar section_number: section number
+    """
+    __slots__ = ('data', 'start', 'end', 'pid', 'table_id', 'long',
+                 'extension', 'version', 'current', 'section_number',
+                 'last_section_number')
+
+    def __init__(self, data, start, end, pid=None):
+        self.data = data
+        self.start = start
+        self.end = end
+        self.pid = pid
+        self.table_id = data[start]
+        self.long = bool(data[start + 1] & 0x80)
+        if self.long and end - start >= 12:
+            self.extension = (data[start + 3] << 8) | data[start + 4]
+            self.version = (data[start + 5] >> 1) & 0x1f
+            self.current = bool(data[start + 5] & 0x1)
+            self.section_number = data[start + 6]
+            self.last_section_number = data[start + 7]
+        else:
+            self.long = False
+            self.extension = self.version = None
+            self.current = True
+            self.section_number = self.last_section_number = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def crc_ok(self):
+        if not self.long:
+            return True
+        return crc32(self.data, self.start, self.end) == 0
+
+    def key(self):
+        """
+        Return the tuple identifying this section's content.
+        """
+        return (self.table_id, self.extension, self.version,
+                self.section_number)
+
+    def body(self):
+        """
+        Return the (start, end) offsets of the section payload, after the
+        long header and before the CRC.
+        """
+        if self.long:
+            return self.start + 8, self.end - 4
+        return self.start + 3, self.end
+
+
+class SectionAssembler(object):
+    """
+    Reassemble PSI sections from the payloads of the packets of each PID.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._cc = {}
+
+    def reset(self, pid=None):
+        if pid is None:
+            self._pending.clear()
+            self._cc.clear()
+        else:
+            self._pending.pop(pid, None)
+            self._cc.pop(pid, None)
+
+    def push(self, data, offset):
+        """
+        Push the packet at offset and return the list of sections it
+        completes.
+
+        @rtype: list of L{Section}
+        """
+        pid = ((data[offset + 1] & 0x1f) << 8) | data[offset + 2]
+        pusi = data[offset + 1] & 0x40
+        cc = data[offset + 3] & 0x0f
+        start, end = payload_bounds(data, offset)
+        if start >= end:
+            return []
+
+        sections = []
+        pending = self._pending.get(pid)
+        last = self._cc.get(pid)
+        self._cc[pid] = cc
+        if pending is not None and last is not None and \
+               cc != ((last + 1) & 0x0f):
+            # lost a packet in the middle of a section
+            pending = None
+            del self._pending[pid]
+
+        if not pusi:
+            if pending is not None:
+                pending.extend(data[start:end])
+                self._flush(pid, pending, sections)
+            return sections
+
+        pointer = data[start]
+        start += 1
+        if pending is not None:
+            pending.extend(data[start:min(start + pointer, end)])
+            self._flush(pid, pending, sections)
+            self._pending.pop(pid, None)
+        start += pointer
+
+        while start + 3 <= end and data[start] != 0xff:
+            length = (((data[start + 1] & 0x0f) << 8) | data[start + 2]) + 3
+            if start + length <= end:
+                sections.append(Section(data, start, start + length, pid))
+                start += length
+            else:
+                self._pending[pid] = bytearray(data[start:end])
+                return sections
+        if start < end and data[start] != 0xff:
+            self._pending[pid] = bytearray(data[start:end])
+        return sections
+
+    def _flush(self, pid, pending, sections):
+        if len(pending) < 3:
+            return
+        length = (((pending[1] & 0x0f) << 8) | pending[2]) + 3
+        if len(pending) >= length:
+            sections.append(Section(pending, 0, length, pid))
+            del self._pending[pid]
+
+
+class _Record(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ' '.join(
+            ['%s=%r' % item for item in sorted(self.__dict__.items())]))
+
+
+class PAT(_Record):
+    """
+    @ivar transport_stream_id: transport stream id
+    @ivar version:             version number
+    @ivar programs:            dict of program number -> PMT PID
+    @ivar network_pid:         PID of the NIT, or None
+    """
+
+
+class PMTStream(_Record):
+    """
+    @ivar pid:         elementary stream PID
+    @ivar stream_type: stream type from the PMT
+    @ivar language:    ISO 639 language code, or None
+    """
+
+
+class PMT(_Record):
+    """
+    @ivar program_number: program number
+    @ivar version:        version number
+    @ivar pcr_pid:        PID carrying the PCR
+    @ivar streams:        list of L{PMTStream}
+    """
+
+
+class Service(_Record):
+    """
+    @ivar service_id:     service id (program number)
+    @ivar name:           service name, or None
+    @ivar provider:       provider name, or None
+    @ivar service_type:   service type from the service descriptor
+    @ivar running_status: running status
+    @ivar scrambled:      whether the free CA mode flag is set
+    """
+
+
+class SDT(_Record):
+    """
+    @ivar actual:              whether it describes the actual mux
+    @ivar transport_stream_id: transport stream id
+    @ivar original_network_id: original network id
+    @ivar version:             version number
+    @ivar services:            list of L{Service}
+    """
+
+
+class Transport(_Record):
+    """
+    @ivar transport_stream_id: transport stream id
+    @ivar original_network_id: original network id
+    @ivar delivery:            dict of tuning parameters, or None
+    @ivar channels:            dict of service id -> logical channel number
+    """
+
+
+class NIT(_Record):
+    """
+    @ivar actual:     whether it describes the actual network
+    @ivar network_id: network id
+    @ivar name:       network name, or None
+    @ivar version:    version number
+    @ivar transports: list of L{Transport}
+    """
+
+
+class Event(_Record):
+    """
+    @ivar event_id:       event id
+    @ivar start:          start time in seconds since the epoch (UTC),
+                          or None if undefined
+    @ivar duration:       duration in seconds
+    @ivar running_status: running status (4 is running)
+    @ivar name:           event name, or None
+    @ivar description:    short description, or None
+    @ivar language:       ISO 639 language of the texts, or None
+    """
+
+
+class EIT(_Record):
+    """
+    @ivar table_id:            table id
+    @ivar service_id:          service id
+    @ivar transport_stream_id: transport stream id
+    @ivar version:             version number
+    @ivar section_number:      section number
+    @ivar present_following:   whether it is a present/following table
+    @ivar actual:              whether it describes the actual mux
+    @ivar events:              list of L{Event}
+    """
+
+
+def parse_pat(section):
+    data = section.data
+    start, end = section.body()
+    programs = {}
+    network_pid = None
+    while start + 4 <= end:
+        number = (data[start] << 8) | data[start + 1]
+        pid = ((data[start + 2] & 0x1f) << 8) | data[start + 3]
+        if number == 0:
+            network_pid = pid
+        else:
+            programs[number] = pid
+        start += 4
+    return PAT(transport_stream_id=section.extension,
+               version=section.version, programs=programs,
+               network_pid=network_pid)
+
+
+def parse_pmt(section):
+    data = section.data
+    start, end = section.body()
+    pcr_pid = ((data[start] & 0x1f) << 8) | data[start + 1]
+    info_length = ((data[start + 2] & 0x0f) << 8) | data[start + 3]
+    start += 4 + info_length
+    streams = []
+    while start + 5 <= end:
+        stream_type = data[start]
+        pid = ((data[start + 1] & 0x1f) << 8) | data[start + 2]
+        es_length = ((data[start + 3] & 0x0f) << 8) | data[start + 4]
+        dstart = start + 5
+        language = None
+        for tag, ds, de in _iter_descriptors(data, dstart, dstart + es_length):
+            if tag == 0x0a and de - ds >= 3:
+                language = str(data[ds:ds + 3])
+        streams.append(PMTStream(pid=pid, stream_type=stream_type,
+                                 language=language))
+        start = dstart + es_length
+    return PMT(program_number=section.extension, version=section.version,
+               pcr_pid=pcr_pid, streams=streams)
+
+
+def parse_sdt(section):
+    data = section.data
+    start, end = section.body()
+    onid = (data[start] << 8) | data[start + 1]
+    start += 3
+    services = []
+    while start + 5 <= end:
+        sid = (data[start] << 8) | data[start + 1]
+        running_status = data[start + 3] >> 5
+        scrambled = bool(data[start + 3] & 0x10)
+        loop_length = ((data[start + 3] & 0x0f) << 8) | data[start + 4]
+        dstart = start + 5
+        service = Service(service_id=sid, name=None, provider=None,
+                          service_type=None, running_status=running_status,
+                          scrambled=scrambled)
+        for tag, ds, de in _iter_descriptors(data, dstart,
+                                             dstart + loop_length):
+            if tag == 0x48 and de - ds >= 2:
+                service.service_type = data[ds]
+                plen = data[ds + 1]
+                service.provider = decode_text(data, ds + 2, ds + 2 + plen)
+                nstart = ds + 2 + plen
+                if nstart < de:
+                    nlen = data[nstart]
+                    service.name = decode_text(data, nstart + 1,
+                                               nstart + 1 + nlen)
+        services.append(service)
+        start = dstart + loop_length
+    return SDT(actual=section.table_id == TABLE_SDT_ACTUAL,
+               transport_stream_id=section.extension,
+               original_network_id=onid, version=section.version,
+               services=services)
+
+
+def _terrestrial_delivery(data, ds):
+    bandwidths = {0: 8, 1: 7, 2: 6, 3: 5}
+    constellations = {0: "QPSK", 1: "QAM16", 2: "QAM64"}
+    hierarchies = {0: 0, 1: 1, 2: 2, 3: 4}
+    guards = {0: 32, 1: 16, 2: 8, 3: 4}
+    modes = {0: "2k", 1: "8k", 2: "4k"}
+
+    def code_rate(value):
+        if value < len(_CODE_RATES):
+            return _CODE_RATES[value]
+        return "reserved"
+    freq = ((data[ds] << 24) | (data[ds + 1] << 16) | (data[ds + 2] << 8) |
+            data[ds + 3]) * 10
+    b4, b5, b6 = data[ds + 4], data[ds + 5], data[ds + 6]
+    return {"type": "terrestrial",
+            "frequency": freq,
+            "bandwidth": bandwidths.get(b4 >> 5, 0),
+            "constellation": constellations.get(b5 >> 6, "reserved"),
+            "hierarchy": hierarchies.get((b5 >> 3) & 0x3, 0),
+            "code-rate-hp": code_rate(b5 & 0x7),
+            "code-rate-lp": code_rate(b6 >> 5),
+            "guard-interval": guards[(b6 >> 3) & 0x3],
+            "transmission-mode": modes.get((b6 >> 1) & 0x3, "reserved")}
+
+
+def _fec(value):
+    fecs = {0: "none", 1: "1/2", 2: "2/3", 3: "3/4", 4: "5/6", 5: "7/8",
+            6: "8/9", 7: "3/5", 8: "4/5", 9: "9/10", 15: "none"}
+    return fecs.get(value, "reserved")
+
+
+def _satellite_delivery(data, ds):
+    freq = _bcd_bytes(data, ds, 4) * 10
+    flags = data[ds + 6]
+    symbol_rate = _bcd(((data[ds + 7] << 20) | (data[ds + 8] << 12) |
+                        (data[ds + 9] << 4) | (data[ds + 10] >> 4)), 7) / 10
+    return {"type": "satellite",
+            "frequency": freq,
+            "orbital-position": _bcd_bytes(data, ds + 4, 2) / 10.0,
+            "west-east": flags & 0x80 and "east" or "west",
+            "polarization": _POLARIZATIONS[(flags >> 5) & 0x3],
+            "modulation": flags & 0x3,
+            "symbol-rate": symbol_rate,
+            "inner-fec": _fec(data[ds + 10] & 0x0f)}
+
+
+def _cable_delivery(data, ds):
+    modulations = {1: "QAM16", 2: "QAM32", 3: "QAM64", 4: "QAM128",
+                   5: "QAM256"}
+    freq = _bcd_bytes(data, ds, 4) * 100
+    symbol_rate = _bcd(((data[ds + 7] << 20) | (data[ds + 8] << 12) |
+                        (data[ds + 9] << 4) | (data[ds + 10] >> 4)), 7) / 10
+    return {"type": "cable",
+            "frequency": freq,
+            "modulation": modulations.get(data[ds + 6], "reserved"),
+            "symbol-rate": symbol_rate,
+            "inner-fec": _fec(data[ds + 10] & 0x0f)}
+
+
+def parse_nit(section):
+    data = section.data
+    start, end = section.body()
+    name = None
+    desc_length = ((data[start] & 0x0f) << 8) | data[start + 1]
+    start += 2
+    for tag, ds, de in _iter_descriptors(data, start, start + desc_length):
+        if tag == 0x40:
+            name = decode_text(data, ds, de)
+    start += desc_length
+    loop_end = start + 2 + (((data[start] & 0x0f) << 8) | data[start + 1])
+    start += 2
+    transports = []
+    while start + 6 <= min(loop_end, end):
+        tsid = (data[start] << 8) | data[start + 1]
+        onid = (data[start + 2] << 8) | data[start + 3]
+        tlen = ((data[start + 4] & 0x0f) << 8) | data[start + 5]
+        dstart = start + 6
+        transport = Transport(transport_stream_id=tsid,
+                              original_network_id=onid, delivery=None,
+                              channels={})
+        for tag, ds, de in _iter_descriptors(data, dstart, dstart + tlen):
+            if tag == 0x5a and de - ds >= 11:
+                transport.delivery = _terrestrial_delivery(data, ds)
+            elif tag == 0x43 and de - ds >= 11:
+                transport.delivery = _satellite_delivery(data, ds)
+            elif tag == 0x44 and de - ds >= 11:
+                transport.delivery = _cable_delivery(data, ds)
+            elif tag == 0x83:
+                for i in range(ds, de - 3, 4):
+                    sid = (data[i] << 8) | data[i + 1]
+                    lcn = ((data[i + 2] & 0x03) << 8) | data[i + 3]
+                    transport.channels[sid] = lcn
+        transports.append(transport)
+        start = dstart + tlen
+    return NIT(actual=section.table_id == TABLE_NIT_ACTUAL,
+               network_id=section.extension, name=name,
+               version=section.version, transports=transports)
+
+
+def _mjd_utc(data, p):
+    mjd = (data[p] << 8) | data[p + 1]
+    if mjd == 0xffff:
+        return None
+    # ETSI EN 300 468 annex C
+    yp = int((mjd - 15078.2) / 365.25)
+    mp = int((mjd - 14956.1 - int(yp * 365.25)) / 30.6001)
+    day = mjd - 14956 - int(yp * 365.25) - int(mp * 30.6001)
+    k = mp in (14, 15) and 1 or 0
+    year = 1900 + yp + k
+    month = mp - 1 - k * 12
+    hour = _bcd(data[p + 2], 2)
+    minute = _bcd(data[p + 3], 2)
+    second = _bcd(data[p + 4], 2)
+    return calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+
+
+def parse_eit(section):
+    data = section.data
+    start, end = section.body()
+    tsid = (data[start] << 8) | data[start + 1]
+    start += 6
+    events = []
+    while start + 12 <= end:
+        event_id = (data[start] << 8) | data[start + 1]
+        event_start = _mjd_utc(data, start + 2)
+        duration = (_bcd(data[start + 7], 2) * 3600 +
+                    _bcd(data[start + 8], 2) * 60 +
+                    _bcd(data[start + 9], 2))
+        running_status = data[start + 10] >> 5
+        loop_length = ((data[start + 10] & 0x0f) << 8) | data[start + 11]
+        dstart = start + 12
+        event = Event(event_id=event_id, start=event_start,
+                      duration=duration, running_status=running_status,
+                      name=None, description=None, language=None)
+        for tag, ds, de in _iter_descriptors(data, dstart,
+                                             dstart + loop_length):
+            if tag == 0x4d and de - ds >= 4:
+                event.language = str(data[ds:ds + 3])
+                nlen = data[ds + 3]
+                event.name = decode_text(data, ds + 4, ds + 4 + nlen)
+                tstart = ds + 4 + nlen
+                if tstart < de:
+                    tlen = data[tstart]
+                    event.description = decode_text(data, tstart + 1,
+                                                    tstart + 1 + tlen)
+        events.append(event)
+        start = dstart + loop_length
+    table_id = section.table_id
+    return EIT(table_id=table_id, service_id=section.extension,
+               transport_stream_id=tsid, version=section.version,
+               section_number=section.section_number,
+               present_following=table_id in (0x4e, 0x4f),
+               actual=table_id == 0x4e or 0x50 <= table_id <= 0x5f,
+               events=events)
+
+
+def table_name(table_id):
+    """
+    Return the name used for a table id, matching the names of the bus
+    messages posted by mpegtsparse.
+    """
+    if table_id == TABLE_PAT:
+        return 'pat'
+    elif table_id == TABLE_PMT:
+        return 'pmt'
+    elif table_id in (TABLE_NIT_ACTUAL, TABLE_NIT_OTHER):
+        return 'nit'
+    elif table_id in (TABLE_SDT_ACTUAL, TABLE_SDT_OTHER):
+        return 'sdt'
+    elif TABLE_EIT_FIRST <= table_id <= TABLE_EIT_LAST:
+        return 'eit'
+    return None
+
+_PARSERS = {
+    'pat': parse_pat,
+    'pmt': parse_pmt,
+    'nit': parse_nit,
+    'sdt': parse_sdt,
+    'eit': parse_eit,
+}
+
+
+def parse_section(section):
+    """
+    Parse a section into its typed record.
+
+    @returns: (table name, record), or (None, None) for tables we do not
+              know about
+    """
+    name = table_name(section.table_id)
+    if name is None:
+        return None, None
+    return name, _PARSERS[name](section)
+
+
+class SectionCache(object):
+    """
+    I remember which sections of each table version have been seen, so
+    that the sections a mux keeps repeating can be dropped after a single
+    comparison.
+
+    @ivar processed: number of new sections
+    @ivar skipped:   number of repeated sections
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self.processed = 0
+        self.skipped = 0
+
+    def reset(self):
+        self._tables.clear()
+
+    def seen(self, key, version, fingerprint, remember=True):
+        """
+        Check whether a section was seen already, and remember it if not.
+
+        @param key:         identifies the table
+        @param version:     version of the table
+        @param fingerprint: identifies the section within the version
+        @param remember:    whether to remember an unseen section
+        @rtype: bool
+        """
+        entry = self._tables.get(key)
+        if entry is not None and entry[0] == version and \
+               fingerprint in entry[1]:
+            self.skipped += 1
+            return True
+        if remember:
+            if entry is None or entry[0] != version:
+                entry = self._tables[key] = (version, set())
+            entry[1].add(fingerprint)
+            self.processed += 1
+        return False
+
+    def section_seen(self, section, remember=True):
+        """
+        @type section: L{Section}
+        """
+        if not section.long:
+            if remember:
+                self.processed += 1
+            return False
+        return self.seen((section.table_id, section.extension),
+                         section.version, section.section_number, remember)
+
+    def structure_seen(self, structure):
+        """
+        Same as L{section_seen} for the table messages posted by
+        mpegtsparse.
+        """
+        name = structure.get_name()
+        key = [name]
+        for field in _STRUCTURE_KEY_FIELDS.get(name, ()):
+            if structure.has_field(field):
+                key.append(structure[field])
+            else:
+                key.append(None)
+        if structure.has_field("version-number"):
+            version = structure["version-number"]
+        else:
+            version = None
+        if structure.has_field("section-number") and version is not None:
+            fingerprint = structure["section-number"]
+        else:
+            # we cannot tell the sections apart, compare their contents
+            fingerprint = hash(structure.to_string())
+        return self.seen(tuple(key), version, fingerprint)
+
+# fields of the mpegtsparse messages identifying the table they carry
+_STRUCTURE_KEY_FIELDS = {
+    'pat': ("transport-stream-id", ),
+    'pmt': ("program-number", ),
+    'sdt': ("transport-stream-id", "actual-transport-stream"),
+    'nit': ("network-id", "actual-network"),
+    'eit': ("service-id", "transport-stream-id", "table-id",
+            "present-following"),
+}
+
+
+class TSParser(object):
+    """
+    I walk transport stream buffers, follow the PAT to find the PMTs and
+    hand out typed tables to the handlers connected to each table name.
+
+    @ivar packets:     number of packets walked
+    @ivar sections:    number of sections parsed
+    @ivar cache:       the L{SectionCache} of the sections parsed
+    @ivar crc_errors:  number of sections dropped because of a bad CRC
+    @ivar sync_losses: number of times we had to resynchronise
+    """
+
+    def __init__(self, check_crc=True, pids=None):
+        """
+        @param check_crc: whether to drop sections with a bad CRC
+        @param pids:      PIDs to parse besides PAT, NIT, SDT, EIT and
+                          the PMTs announced in the PAT
+        """
+        self.check_crc = check_crc
+        self.assembler = SectionAssembler()
+        self.cache = SectionCache()
+        self.psi_pids = set([PID_PAT, PID_NIT, PID_SDT, PID_EIT])
+        if pids:
+            self.psi_pids.update(pids)
+        self.pmt_pids = {}
+        self.handlers = {}
+        self._patVersion = None
+        self._patSections = {} # section number -> programs
+        self.packets = 0
+        self.sections = 0
+        self.crc_errors = 0
+        self.sync_losses = 0
+        self._remainder = None
+
+    def connect(self, name, handler):
+        """
+        Call handler(record) for each table called name ('pat', 'pmt',
+        'nit', 'sdt' or 'eit').
+        """
+        self.handlers.setdefault(name, []).append(handler)
+
+    def reset(self):
+        self.assembler.reset()
+        self.cache.reset()
+        self.pmt_pids.clear()
+        self._patVersion = None
+        self._patSections.clear()
+        self._remainder = None
+
+    def feed(self, data):
+        """
+        Walk all complete packets in data, keeping a trailing partial
+        packet for the next call.
+        """
+        data = as_buffer(data)
+        if self._remainder:
+            need = PACKET_SIZE - len(self._remainder)
+            self._remainder.extend(data[:need])
+            packet = self._remainder
+            if len(packet) == PACKET_SIZE and packet[0] == SYNC_BYTE:
+                pid = ((packet[1] & 0x1f) << 8) | packet[2]
+                if pid in self.psi_pids or pid in self.pmt_pids:
+                    self._packet(packet, 0)
+                else:
+                    self.packets += 1
+            self._remainder = None
+            if len(packet) < PACKET_SIZE:
+                self._remainder = packet
+                return
+            offset = need
+        else:
+            offset = 0
+
+        end = len(data) - PACKET_SIZE
+        psi_pids = self.psi_pids
+        pmt_pids = self.pmt_pids
+        while offset <= end:
+            if data[offset] != SYNC_BYTE:
+                self.sync_losses += 1
+                offset = find_sync(data, offset)
+                if offset < 0:
+                    return
+                continue
+            pid = ((data[offset + 1] & 0x1f) << 8) | data[offset + 2]
+            if pid in psi_pids or pid in pmt_pids:
+                self._packet(data, offset)
+            else:
+                self.packets += 1
+            offset += PACKET_SIZE
+        if offset < len(data):
+            self._remainder = bytearray(data[offset:])
+
+    def _packet(self, data, offset):
+        self.packets += 1
+        if data[offset + 1] & 0x80:
+            # transport error indicator
+            return
+        for section in self.assembler.push(data, offset):
+            self._section(section)
+
+    def _updatePMTPids(self, section, record):
+        # a PAT can span several sections, each listing some programs
+        if section.version != self._patVersion:
+            self._patVersion = section.version
+            self._patSections.clear()
+        self._patSections[section.section_number] = record.programs
+        self.pmt_pids.clear()
+        for programs in self._patSections.values():
+            for number, pid in programs.items():
+                self.pmt_pids[pid] = number
+
+    def _section(self, section):
+        # look the section up first, repeated sections are not worth a CRC
+        if not section.current or \
+               self.cache.section_seen(section, remember=False):
+            return
+        if self.check_crc and not section.crc_ok():
+            self.crc_errors += 1
+            return
+        self.cache.section_seen(section)
+        try:
+            name, record = parse_section(section)
+        except IndexError:
+            # truncated or corrupted section that passed the CRC check
+            self.crc_errors += 1
+            return
+        if name is None:
+            return
+        self.sections += 1
+        if name == 'pat':
+            self._updatePMTPids(section, record)
+        for handler in self.handlers.get(name, ()):
+            handler(record)
+
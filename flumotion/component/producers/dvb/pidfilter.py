@@ -0,0 +1,120 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Selection of the PIDs a component needs out of a multiplex.
+"""
+
+from flumotion.component.producers.dvb import mpegts
+
+# service information tables the components read besides the PAT and PMTs
+SI_PIDS = (mpegts.PID_NIT, mpegts.PID_SDT, mpegts.PID_EIT, mpegts.PID_TDT)
+
+
+class PIDFilter(object):
+    """
+    I work out the PIDs needed to play a set of programs from the PAT
+    and their PMTs: the PSI and SI tables, the PCR, the first video
+    stream and one audio stream of each program. Teletext, subtitles,
+    data and other audio languages are left out.
+    """
+
+    def __init__(self, program_numbers, audio_pid=0, video=True,
+                 extra_pids=()):
+        """
+        @param program_numbers: programs to keep
+        @param audio_pid:       audio stream to keep instead of the first
+                                one, if the program has it
+        @param video:           whether to keep the video stream
+        @param extra_pids:      PIDs to keep whatever the PMT says
+        """
+        self._programs = set(program_numbers)
+        self._audioPid = audio_pid
+        self._video = video
+        self._extra = set(extra_pids)
+        self._pmtPids = {}
+        self._streams = {}
+        self._pids = None
+
+    def set_programs(self, program_numbers):
+        """
+        Keep other programs from now on, using the PAT and PMTs seen so
+        far if they were announced already.
+
+        @returns: whether the set of PIDs changed
+        """
+        self._programs = set(program_numbers)
+        if [n for n in self._programs
+            if n not in self._pmtPids or n not in self._streams]:
+            # let everything through until the PMTs arrive
+            changed = self._pids is not None
+            self._pids = None
+            return changed
+        return self._update()
+
+    def update_pat(self, programs):
+        """
+        @param programs: dict of program number -> PMT PID
+        @returns: whether the set of PIDs changed
+        """
+        self._pmtPids = dict(programs)
+        return self._update()
+
+    def update_pmt(self, program_number, pcr_pid, streams):
+        """
+        @param streams: list of (PID, stream type) in PMT order
+        @returns: whether the set of PIDs changed
+        """
+        pids = set()
+        if pcr_pid != mpegts.PID_NULL:
+            pids.add(pcr_pid)
+        video = [pid for pid, stream_type in streams
+                 if stream_type in mpegts.VIDEO_STREAM_TYPES]
+        audio = [pid for pid, stream_type in streams
+                 if stream_type in mpegts.AUDIO_STREAM_TYPES]
+        if video and self._video:
+            pids.add(video[0])
+        if self._audioPid in audio:
+            pids.add(self._audioPid)
+        elif audio:
+            pids.add(audio[0])
+        self._streams[program_number] = pids
+        return self._update()
+
+    def get_pids(self):
+        """
+        @returns: sorted list of the PIDs to keep, or None until the PMTs
+                  of all the programs are known
+        """
+        if self._pids is None:
+            return None
+        return sorted(self._pids)
+
+    def _update(self):
+        programs = [n for n in self._programs if n in self._pmtPids]
+        if not programs or [n for n in programs if n not in self._streams]:
+            return False
+        pids = set(SI_PIDS)
+        pids.add(mpegts.PID_PAT)
+        pids.update(self._extra)
+        for program_number in programs:
+            pids.add(self._pmtPids[program_number])
+            pids.update(self._streams[program_number])
+        if pids == self._pids:
+            return False
+        self._pids = pids
+        return True
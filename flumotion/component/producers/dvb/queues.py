@@ -0,0 +1,99 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Bounded queues for the branches of the DVB pipelines.
+"""
+
+import gst
+
+from flumotion.common import log
+
+# branches whose queues can be configured separately: mpegts is the
+# transport stream feeder, decode the demuxers and decoders
+BRANCHES = ('mpegts', 'decode')
+# values of the queue leaky property, no means the queue blocks when full
+LEAKY = ('no', 'upstream', 'downstream')
+
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+# milliseconds
+DEFAULT_MAX_TIME = 3000
+
+
+def get_queue_string(props, branch, name):
+    """
+    Return a queue element for branch, limited in bytes and time by the
+    queue-max-bytes and queue-max-time properties, that leaks or blocks
+    when full as told by the <branch>-queue-leaky property.
+    """
+    return 'queue name=%s max-size-buffers=0 max-size-bytes=%d ' \
+        'max-size-time=%d leaky=%s' % (
+        name, props.get('queue-max-bytes', DEFAULT_MAX_BYTES),
+        props.get('queue-max-time', DEFAULT_MAX_TIME) * gst.MSECOND,
+        props.get('%s-queue-leaky' % branch, 'no'))
+
+
+def check_properties(props):
+    """
+    @returns: a description of the first invalid queue property, or None
+    """
+    for branch in BRANCHES:
+        leaky = props.get('%s-queue-leaky' % branch, 'no')
+        if leaky not in LEAKY:
+            return "Property %s-queue-leaky can only be one of %s." % (
+                branch, ', '.join(LEAKY))
+    for key in ('queue-max-bytes', 'queue-max-time'):
+        if props.get(key, 1) <= 0:
+            return "Property %s has to be positive." % key
+    return None
+
+
+class QueueMonitor(log.Loggable):
+    """
+    I keep track of how full the queues of a pipeline are and of how many
+    times they overran.
+    """
+    logCategory = 'dvb'
+
+    def __init__(self):
+        self._queues = {}
+        self._overruns = {}
+
+    def attach(self, queue, name):
+        self._queues[name] = queue
+        self._overruns[name] = 0
+        # emitted from the streaming thread, only count
+        queue.connect('overrun', self._overrunCb, name)
+
+    def _overrunCb(self, queue, name):
+        self._overruns[name] += 1
+
+    def get_stats(self):
+        """
+        @returns: dict of queue name -> dict with the current level in
+                  bytes, buffers and milliseconds and the number of
+                  overruns
+        """
+        result = {}
+        for name, queue in self._queues.items():
+            result[name] = dict(
+                bytes=queue.get_property('current-level-bytes'),
+                buffers=queue.get_property('current-level-buffers'),
+                time=queue.get_property('current-level-time') /
+                    gst.MSECOND,
+                overruns=self._overruns[name])
+        return result
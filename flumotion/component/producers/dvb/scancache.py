@@ -0,0 +1,410 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Results of the channel scans of a worker, kept on disk so that a rescan
+only has to look at the multiplexes that changed.
+"""
+
+import os
+import urllib
+
+from flumotion.component.producers.dvb import statedir
+
+CACHE_FILENAME = 'scan-cache'
+
+
+def tuning_key(tuning):
+    """
+    @returns: what tells the multiplexes of a network apart
+    """
+    return tuning["frequency"], tuning.get("polarization")
+
+
+# the values are written with a letter for their type, so that they
+# are read back as they were: i for integers, b for booleans, s for
+# strings and u for unicode, in UTF-8; '-' is None
+FORMAT = 2
+
+
+def _encode(value):
+    if value is None:
+        return '-'
+    if isinstance(value, bool):
+        return 'b%d' % value
+    if isinstance(value, (int, long)):
+        return 'i%d' % value
+    if isinstance(value, unicode):
+        return 'u' + urllib.quote(value.encode('utf-8'), safe='')
+    if isinstance(value, str):
+        return 's' + urllib.quote(value, safe='')
+    raise TypeError("cannot keep %r in the scan cache" % (value, ))
+
+
+def _decode(text):
+    if text == '-':
+        return None
+    kind, text = text[0], text[1:]
+    if kind == 'i':
+        return int(text)
+    elif kind == 'b':
+        return bool(int(text))
+    elif kind == 's':
+        return urllib.unquote(text)
+    elif kind == 'u':
+        return urllib.unquote(text).decode('utf-8')
+    raise ValueError("unknown type %r in the scan cache" % (kind, ))
+
+
+class Mux(object):
+    """
+    A multiplex of a network, as found by the last scan of it.
+
+    @ivar tuning:      tuning parameters, as given to the scanner
+    @ivar tsid:        transport stream id, or None if never scanned
+    @ivar nit_version: version of the NIT of its network, or None
+    @ivar sdt_version: version of its SDT, or None
+    @ivar channels:    service id -> channel data, as the scanner
+                       gives it
+    """
+
+    def __init__(self, tuning, tsid=None, network_id=None, nit_version=None,
+                 sdt_version=None, channels=None):
+        self.tuning = tuning
+        self.tsid = tsid
+        self.network_id = network_id
+        self.nit_version = nit_version
+        self.sdt_version = sdt_version
+        self.channels = channels or {}
+
+    def is_complete(self):
+        """
+        @returns: whether the versions of its tables are known, so it
+                  can be skipped while they do not change
+        """
+        return None not in (self.tsid, self.network_id, self.nit_version,
+                            self.sdt_version)
+
+
+class Network(object):
+    """
+    The multiplexes found from a tuning file with one type of adapter.
+    """
+
+    def __init__(self, adapter_type, tuning_file):
+        self.adapter_type = adapter_type
+        self.tuning_file = tuning_file
+        self.muxes = {}
+
+    def get_mux(self, tuning):
+        return self.muxes.get(tuning_key(tuning))
+
+    def set_mux(self, mux):
+        self.muxes[tuning_key(mux.tuning)] = mux
+
+    def remove_mux(self, tuning):
+        self.muxes.pop(tuning_key(tuning), None)
+
+    def get_result(self):
+        """
+        @returns: (channels, transport_streams) of the scanned multiplexes,
+                  as a scan returns them
+        """
+        channels = {}
+        transport_streams = {}
+        for mux in self.muxes.values():
+            if mux.tsid is None:
+                continue
+            transport_streams[mux.tsid] = mux.tuning
+            for sid, channel in mux.channels.items():
+                channels.setdefault(sid, {}).update(channel)
+        return channels, transport_streams
+
+    def export_channels_conf(self):
+        """
+        @returns: the lines of a channels.conf, in the format of the zap
+                  utilities
+        """
+        lines = []
+        muxes = self.muxes.items()
+        muxes.sort()
+        for key, mux in muxes:
+            tuning = _toZap(self.adapter_type, mux.tuning)
+            if tuning is None:
+                continue
+            services = mux.channels.items()
+            services.sort()
+            for sid, channel in services:
+                if 'name' not in channel:
+                    continue
+                video = channel.get('video-streams') or [0]
+                audio = channel.get('audio-streams') or [(None, 0)]
+                name = channel['name']
+                if isinstance(name, unicode):
+                    name = name.encode('utf-8')
+                fields = [name.replace(':', ' ')] + tuning + \
+                         [str(video[0]), str(audio[0][1]), str(sid)]
+                lines.append(':'.join(fields) + '\n')
+        return lines
+
+    def import_channels_conf(self, lines):
+        """
+        Add the multiplexes and channels listed in a channels.conf. They
+        are scanned again the next time, to get what the file lacks.
+
+        @returns: the number of channels imported
+        """
+        imported = 0
+        for line in lines:
+            fields = line.strip().split(':')
+            if not line.strip() or line.startswith('#') or len(fields) < 5:
+                continue
+            try:
+                tuning = _fromZap(self.adapter_type, fields[1:-3])
+                vpid, apid, sid = [int(f) for f in fields[-3:]]
+            except (ValueError, KeyError, IndexError):
+                continue
+            if tuning is None:
+                continue
+            mux = self.get_mux(tuning)
+            if mux is None:
+                mux = Mux(tuning)
+                self.set_mux(mux)
+            channel = mux.channels.setdefault(sid, {})
+            channel['name'] = fields[0]
+            if vpid and vpid not in channel.setdefault('video-streams', []):
+                channel['video-streams'].append(vpid)
+            audio = channel.setdefault('audio-streams', [])
+            if apid and apid not in [pid for lang, pid in audio]:
+                audio.append(('pid-%d' % apid, apid))
+            # the versions of the tables of the multiplex are unknown
+            mux.nit_version = mux.sdt_version = None
+            imported += 1
+        return imported
+
+
+class ScanCache(object):
+    """
+    I keep the networks scanned on a worker in a file, one for each
+    adapter type and tuning file.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._networks = {}
+        self.load()
+
+    def get_network(self, adapter_type, tuning_file):
+        """
+        @rtype: L{Network}
+        """
+        key = adapter_type, tuning_file
+        if key not in self._networks:
+            self._networks[key] = Network(adapter_type, tuning_file)
+        return self._networks[key]
+
+    def _getFilename(self):
+        return self.filename or os.path.join(statedir.get_directory(),
+                                             CACHE_FILENAME)
+
+    def load(self):
+        try:
+            f = open(self._getFilename())
+        except EnvironmentError:
+            return
+        # a cache written in another format is scanned again
+        if f.readline().split() != ['format', str(FORMAT)]:
+            f.close()
+            return
+        network = mux = None
+        for line in f:
+            fields = line.split()
+            try:
+                if fields[0] == 'network':
+                    network = self.get_network(_decode(fields[1]),
+                                               _decode(fields[2]))
+                    mux = None
+                elif fields[0] == 'mux' and network:
+                    tuning = {}
+                    for item in fields[5].split(','):
+                        name, value = item.split('=', 1)
+                        tuning[name] = _decode(value)
+                    mux = Mux(tuning, *[_decode(v) for v in fields[1:5]])
+                    network.set_mux(mux)
+                elif fields[0] == 'channel' and mux:
+                    mux.channels[int(fields[1])] = _decodeChannel(fields[2:])
+            except (IndexError, ValueError, UnicodeDecodeError):
+                continue
+        f.close()
+
+    def save(self):
+        filename = self._getFilename()
+        tmp = filename + '.tmp'
+        # do not follow a link left where the new file goes
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        flags |= getattr(os, 'O_NOFOLLOW', 0)
+        f = os.fdopen(os.open(tmp, flags, 0600), 'w')
+        f.write('format %d\n' % FORMAT)
+        for network in self._networks.values():
+            f.write('network %s %s\n' % (_encode(network.adapter_type),
+                                         _encode(network.tuning_file)))
+            for mux in network.muxes.values():
+                tuning = ','.join(['%s=%s' % (name, _encode(value))
+                                   for name, value in mux.tuning.items()])
+                f.write('mux %s %s %s %s %s\n' % (
+                    _encode(mux.tsid), _encode(mux.network_id),
+                    _encode(mux.nit_version), _encode(mux.sdt_version),
+                    tuning))
+                for sid, channel in mux.channels.items():
+                    f.write('channel %d %s\n' % (sid,
+                                                 _encodeChannel(channel)))
+        f.close()
+        os.rename(tmp, filename)
+
+
+def _encodeChannel(channel):
+    video = ':'.join([str(pid) for pid in channel.get('video-streams', [])])
+    audio = ':'.join(['%s/%d' % (_encode(lang), pid)
+                      for lang, pid in channel.get('audio-streams', [])])
+    return ' '.join([_encode(channel.get('name')),
+                     _encode(channel.get('transport-stream-id')),
+                     _encode(channel.get('pmt-pid')),
+                     _encode(channel.get('logical-channel-number')),
+                     video or '-', audio or '-'])
+
+
+def _decodeChannel(fields):
+    name, tsid, pmt, lcn, video, audio = fields
+    channel = {}
+    for key, value in (('name', name), ('transport-stream-id', tsid),
+                       ('pmt-pid', pmt), ('logical-channel-number', lcn)):
+        if value != '-':
+            channel[key] = _decode(value)
+    if video != '-':
+        channel['video-streams'] = [int(pid) for pid in video.split(':')]
+    if audio != '-':
+        channel['audio-streams'] = []
+        for stream in audio.split(':'):
+            lang, pid = stream.split('/')
+            channel['audio-streams'].append((_decode(lang), int(pid)))
+    return channel
+
+
+# channels.conf, as written by the scan utility of dvb-apps for the zap
+# utilities, has a line per channel: name, tuning fields, video PID,
+# audio PID and service id, separated by colons
+
+def _zapCodeRate(rate):
+    if rate in (None, 'reserved', 'none', 'NONE'):
+        return 'FEC_NONE'
+    return 'FEC_' + str(rate).upper().replace('/', '_')
+
+
+def _zapModulation(modulation):
+    modulation = str(modulation).upper()
+    if modulation.startswith('QAM') and modulation[3:].strip().isdigit():
+        return 'QAM_' + modulation[3:].strip()
+    if modulation in ('QPSK', '8VSB', '16VSB'):
+        return modulation
+    return 'QAM_AUTO'
+
+
+def _toZap(adapter_type, tuning):
+    if adapter_type == 'DVB-T':
+        mode = str(tuning['transmission-mode']).upper()
+        if mode not in ('2K', '8K'):
+            mode = 'AUTO'
+        bandwidth = tuning['bandwidth']
+        if bandwidth not in (6, 7, 8):
+            bandwidth = 'AUTO'
+        guard = tuning['guard-interval']
+        if guard in (4, 8, 16, 32):
+            guard = '1_%d' % guard
+        else:
+            guard = 'AUTO'
+        hierarchy = str(tuning['hierarchy']).upper()
+        if hierarchy in ('0', 'RESERVED'):
+            hierarchy = 'NONE'
+        return [str(tuning['frequency']), 'INVERSION_AUTO',
+                'BANDWIDTH_%s_MHZ' % bandwidth,
+                _zapCodeRate(tuning['code-rate-hp']),
+                _zapCodeRate(tuning['code-rate-lp']),
+                _zapModulation(tuning['constellation']),
+                'TRANSMISSION_MODE_' + mode, 'GUARD_INTERVAL_' + guard,
+                'HIERARCHY_' + hierarchy]
+    elif adapter_type == 'DVB-S':
+        # the frequency in MHz, the symbol rate in kilosymbols
+        return [str(tuning['frequency'] / 1000),
+                tuning['polarization'][0].lower(), '0',
+                str(tuning['symbol-rate'])]
+    elif adapter_type == 'DVB-C':
+        # the symbol rate in symbols
+        return [str(tuning['frequency']), 'INVERSION_AUTO',
+                str(tuning['symbol-rate'] * 1000),
+                _zapCodeRate(tuning['inner-fec']),
+                _zapModulation(tuning['modulation'])]
+    return None
+
+
+def _fromZapCodeRate(rate):
+    rate = rate[len('FEC_'):]
+    if rate in ('NONE', 'AUTO'):
+        return rate
+    return rate.replace('_', '/')
+
+
+def _fromZapModulation(modulation):
+    if modulation == 'QAM_AUTO':
+        return 'AUTO'
+    return modulation.replace('_', '')
+
+
+def _fromZap(adapter_type, fields):
+    if adapter_type == 'DVB-T' and len(fields) == 9:
+        bandwidth = fields[2].split('_')[1]
+        if bandwidth.isdigit():
+            bandwidth = int(bandwidth)
+        mode = fields[6][len('TRANSMISSION_MODE_'):]
+        if mode in ('2K', '8K'):
+            mode = mode.lower()
+        guard = fields[7][len('GUARD_INTERVAL_'):]
+        if guard.startswith('1_'):
+            guard = int(guard[2:])
+        return {"frequency": int(fields[0]),
+                "bandwidth": bandwidth,
+                "code-rate-hp": _fromZapCodeRate(fields[3]),
+                "code-rate-lp": _fromZapCodeRate(fields[4]),
+                "constellation": _fromZapModulation(fields[5]),
+                "transmission-mode": mode,
+                "guard-interval": guard,
+                "hierarchy": fields[8][len('HIERARCHY_'):]}
+    elif adapter_type == 'DVB-S' and len(fields) == 4:
+        polarization = "horizontal"
+        if fields[1].lower() == 'v':
+            polarization = "vertical"
+        return {"frequency": int(fields[0]) * 1000,
+                "polarization": polarization,
+                "symbol-rate": int(fields[3]),
+                "inner-fec": "AUTO"}
+    elif adapter_type == 'DVB-C' and len(fields) == 5:
+        return {"frequency": int(fields[0]),
+                "symbol-rate": int(fields[2]) / 1000,
+                "inner-fec": _fromZapCodeRate(fields[3]),
+                "modulation": _fromZapModulation(fields[4])}
+    return None
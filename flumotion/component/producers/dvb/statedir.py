@@ -0,0 +1,60 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+The directory the DVB components and checks of a worker keep their
+state in, shared between them and private to the user running them.
+"""
+
+import errno
+import os
+import stat
+
+from flumotion.configure import configure
+
+
+def _makePrivate(directory):
+    try:
+        os.mkdir(directory, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError(errno.EPERM, "%s is not a directory of ours"
+                      % directory)
+    if stat.S_IMODE(st.st_mode) != 0700:
+        os.chmod(directory, 0700)
+
+
+def get_directory(name=None):
+    """
+    Get the dvb directory of the flumotion cache, or the directory name
+    in it, creating them with mode 0700.
+
+    @returns: the path of the directory
+    @raises OSError: when it cannot be created, or is not a directory
+                     owned by the user running the worker
+    """
+    if not os.path.isdir(configure.cachedir):
+        os.makedirs(configure.cachedir)
+    directory = os.path.join(configure.cachedir, 'dvb')
+    _makePrivate(directory)
+    if name:
+        directory = os.path.join(directory, name)
+        _makePrivate(directory)
+    return directory
@@ -0,0 +1,259 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Disk-backed time-shift buffer of a transport stream.
+"""
+
+import collections
+import mmap
+import os
+import struct
+import time
+
+from flumotion.component.producers.dvb import mpegts
+
+# the ring files start with a magic string and the number of bytes
+# written so far, so that other processes can follow them
+_HEADER = struct.Struct('<8sQ')
+_MAGIC = 'FLUTSRNG'
+# most bytes written to the ring before the header is updated; readers
+# take what is that close to being overwritten as lost already
+MAX_WRITE = 348 * mpegts.PACKET_SIZE
+
+
+class IndexEntry(object):
+    """
+    A packet of the stream worth starting from.
+
+    @ivar offset: position of the packet in the stream, in bytes since
+                  the buffer was created
+    @ivar time:   time it arrived at, in seconds since the epoch
+    @ivar pcr:    PCR it carries, in 90kHz units, or None
+    @ivar random_access: whether the random access indicator is set
+    """
+    __slots__ = ('offset', 'time', 'pcr', 'random_access')
+
+    def __init__(self, offset, time, pcr, random_access):
+        self.offset = offset
+        self.time = time
+        self.pcr = pcr
+        self.random_access = random_access
+
+
+class _Ring(object):
+    """
+    A transport stream ring in a memory mapped file.
+    """
+    size = 0
+    written = 0
+    _map = None
+
+    def oldest(self):
+        """
+        @returns: offset of the oldest byte still in the buffer
+        """
+        return max(0, self.written - self.size)
+
+    def _getMaxWrite(self):
+        return max(1, min(MAX_WRITE, self.size / 2))
+
+    def _getPublished(self):
+        return _HEADER.unpack(self._map[:_HEADER.size])[1]
+
+    def read(self, offset, size):
+        """
+        @returns: up to size bytes of the stream starting at offset, or
+                  None if they are no longer in the buffer
+        @rtype:   str
+        """
+        end = min(offset + size, self.written)
+        if offset < self.oldest() or offset >= end:
+            return None
+        start = offset % self.size
+        length = end - offset
+        first = min(length, self.size - start)
+        base = _HEADER.size
+        data = self._map[base + start:base + start + first]
+        if first < length:
+            data += self._map[base:base + length - first]
+        # the writer may have overtaken us while copying, and may be
+        # overwriting up to one write past what it published
+        if offset < self._getPublished() - self.size + self._getMaxWrite():
+            return None
+        return data
+
+
+class TimeShiftBuffer(_Ring):
+    """
+    I keep the last size bytes of a transport stream in a memory mapped
+    file, and an index of the packets carrying a PCR or a random access
+    point so readers can start from a given time.
+
+    Writes are done from the streaming thread and reads from the reactor;
+    reads of data overwritten meanwhile are detected and fail.
+
+    @ivar written: bytes written since the buffer was created
+    """
+
+    def __init__(self, filename, size):
+        """
+        @param size: size of the buffer in bytes, rounded down to whole
+                     packets
+        """
+        self.size = size - size % mpegts.PACKET_SIZE
+        if self.size <= 0:
+            raise ValueError("A time-shift buffer needs at least one packet")
+        self.filename = filename
+        self.written = 0
+        # never write through a file or a link planted there
+        self._file = os.fdopen(os.open(filename, os.O_RDWR | os.O_CREAT |
+                                       os.O_EXCL, 0600), 'w+b')
+        self._file.truncate(_HEADER.size + self.size)
+        self._map = mmap.mmap(self._file.fileno(), _HEADER.size + self.size)
+        self._map[:_HEADER.size] = _HEADER.pack(_MAGIC, 0)
+        self._index = collections.deque()
+        # bytes of an incomplete packet at the end of the last write
+        self._remainder = ''
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+        os.unlink(self.filename)
+
+    def write(self, data, now=None):
+        """
+        Append data to the buffer, overwriting the oldest bytes.
+
+        @type data: str
+        """
+        if now is None:
+            now = time.time()
+        self._indexPackets(data, now)
+        if len(data) > self.size:
+            self.written += len(data) - self.size
+            data = data[-self.size:]
+            self._publish()
+        maxWrite = self._getMaxWrite()
+        base = _HEADER.size
+        for pos in range(0, len(data), maxWrite):
+            chunk = data[pos:pos + maxWrite]
+            start = self.written % self.size
+            first = min(len(chunk), self.size - start)
+            self._map[base + start:base + start + first] = chunk[:first]
+            if first < len(chunk):
+                self._map[base:base + len(chunk) - first] = chunk[first:]
+            self.written += len(chunk)
+            self._publish()
+        self._prune()
+
+    def _publish(self):
+        self._map[:_HEADER.size] = _HEADER.pack(_MAGIC, self.written)
+
+    def _indexPackets(self, data, now):
+        base = self.written - len(self._remainder)
+        if self._remainder:
+            data = self._remainder + data
+        buf = bytearray(data)
+        end = len(buf) - mpegts.PACKET_SIZE
+        offset = mpegts.find_sync(buf)
+        while 0 <= offset <= end:
+            if buf[offset] != mpegts.SYNC_BYTE:
+                offset = mpegts.find_sync(buf, offset)
+                continue
+            # only packets with an adaptation field are of interest
+            if buf[offset + 3] & 0x20 and buf[offset + 4]:
+                flags = buf[offset + 5]
+                if flags & 0x50:
+                    pcr = None
+                    if flags & 0x10:
+                        pcr = mpegts.read_pcr(buf, offset)
+                    self._index.append(IndexEntry(base + offset, now, pcr,
+                                                  bool(flags & 0x40)))
+            offset += mpegts.PACKET_SIZE
+        if offset < 0:
+            self._remainder = ''
+        else:
+            self._remainder = data[offset:]
+
+    def _prune(self):
+        oldest = self.oldest()
+        index = self._index
+        while index and index[0].offset < oldest:
+            index.popleft()
+
+    def get_range(self):
+        """
+        @returns: (time of the oldest, time of the newest indexed packet),
+                  or (None, None) if nothing was indexed yet
+        """
+        index = self._index
+        if not index:
+            return None, None
+        return index[0].time, index[-1].time
+
+    def find(self, timestamp):
+        """
+        Find where to start reading to get the stream from timestamp on,
+        preferring random access points.
+
+        @returns: the offset of the first suitable packet at or after
+                  timestamp, or None
+        """
+        candidate = None
+        oldest = self.oldest()
+        for entry in list(self._index):
+            if entry.offset < oldest or entry.time < timestamp:
+                continue
+            if entry.random_access:
+                return entry.offset
+            if candidate is None:
+                candidate = entry.offset
+        return candidate
+
+
+class RingReader(_Ring):
+    """
+    I follow a L{TimeShiftBuffer} written by another process.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        length = os.fstat(self._file.fileno()).st_size
+        if length <= _HEADER.size:
+            raise ValueError("%s is not a transport stream ring" % filename)
+        self._map = mmap.mmap(self._file.fileno(), length,
+                              access=mmap.ACCESS_READ)
+        magic, _ = _HEADER.unpack(self._map[:_HEADER.size])
+        if magic != _MAGIC:
+            self.close()
+            raise ValueError("%s is not a transport stream ring" % filename)
+        self.size = length - _HEADER.size
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def update(self):
+        """
+        Catch up with the writer.
+
+        @returns: bytes written to the ring so far
+        """
+        self.written = self._getPublished()
+        return self.written
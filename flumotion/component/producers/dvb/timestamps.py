@@ -0,0 +1,166 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Sampled checks of the continuity of the timestamps of decoded streams.
+"""
+
+import time
+
+import gst
+from twisted.internet import reactor
+
+from flumotion.common import log
+
+# differences between the end of a buffer and the start of the next one
+# smaller than this are not gaps nor overlaps
+TOLERANCE = gst.MSECOND
+
+
+class _Stream(object):
+
+    def __init__(self, name, pad):
+        self.name = name
+        self.pad = pad
+        self.probe = None
+        self.remaining = 0
+        self.lastEnd = None
+        # timestamp of the last sampled buffer minus when it arrived
+        self.offset = None
+        self.sampled = 0
+        self.gaps = 0
+        self.overlaps = 0
+        self.discontinuities = 0
+        self.maxGap = 0
+        self.maxOverlap = 0
+
+
+class TimestampMonitor(log.Loggable):
+    """
+    I look at the timestamps of a few consecutive buffers of each stream
+    every period seconds, instead of at every buffer, and count the gaps,
+    overlaps and discontinuities in them. I also estimate the drift
+    between the audio and video streams of a program from how far their
+    timestamps are from the time they arrive at.
+
+    The counters are cumulative, and published in the uiState.
+    """
+    logCategory = 'dvb'
+
+    def __init__(self, uiState, period=10.0, size=50):
+        """
+        @param uiState: the uiState to publish the statistics to, in the
+                        timestamps dict, at the start of each sample
+        @param period:  seconds between the start of two samples
+        @param size:    number of consecutive buffers in a sample
+        """
+        self._uiState = uiState
+        self._period = period
+        self._size = size
+        self._streams = {}
+        self._sampleDC = None
+
+    def attach(self, pad, name):
+        """
+        Watch the buffers going through pad; the audio<suffix> and
+        video<suffix> streams are compared for drift.
+        """
+        self._streams[name] = _Stream(name, pad)
+
+    def start(self):
+        self._sample()
+
+    def stop(self):
+        if self._sampleDC:
+            self._sampleDC.cancel()
+            self._sampleDC = None
+        for stream in self._streams.values():
+            self._stopSampling(stream)
+
+    def _sample(self):
+        published = self._uiState.get('timestamps')
+        for name, stats in self.get_stats().items():
+            if published.get(name) != stats:
+                self._uiState.setitem('timestamps', name, stats)
+        for stream in self._streams.values():
+            if stream.probe is None:
+                # the end of the previous sample says nothing of this one
+                stream.lastEnd = None
+                stream.remaining = self._size
+                stream.probe = stream.pad.add_buffer_probe(self._probeCb,
+                                                           stream)
+        self._sampleDC = reactor.callLater(self._period, self._sample)
+
+    def _stopSampling(self, stream):
+        if stream.probe is not None:
+            stream.pad.remove_buffer_probe(stream.probe)
+            stream.probe = None
+
+    def _probeCb(self, pad, buffer, stream):
+        # called from the streaming thread
+        if stream.remaining <= 0:
+            return True
+        stream.remaining -= 1
+        if not stream.remaining:
+            reactor.callFromThread(self._stopSampling, stream)
+        stream.sampled += 1
+        if buffer.flag_is_set(gst.BUFFER_FLAG_DISCONT):
+            stream.discontinuities += 1
+            stream.lastEnd = None
+        timestamp = buffer.timestamp
+        if timestamp == gst.CLOCK_TIME_NONE:
+            return True
+        stream.offset = timestamp - int(time.time() * gst.SECOND)
+        if stream.lastEnd is not None:
+            delta = timestamp - stream.lastEnd
+            if delta > TOLERANCE:
+                stream.gaps += 1
+                stream.maxGap = max(stream.maxGap, delta)
+            elif delta < -TOLERANCE:
+                stream.overlaps += 1
+                stream.maxOverlap = max(stream.maxOverlap, -delta)
+        if buffer.duration != gst.CLOCK_TIME_NONE:
+            stream.lastEnd = timestamp + buffer.duration
+        else:
+            stream.lastEnd = None
+        return True
+
+    def get_stats(self):
+        """
+        @returns: dict of stream name -> dict with the number of buffers
+                  sampled, gaps, overlaps and discontinuities, and the
+                  longest gap and overlap in milliseconds; video streams
+                  also get the drift of their timestamps from those of
+                  the audio in milliseconds, positive when ahead
+        """
+        result = {}
+        for name, stream in self._streams.items():
+            stats = {
+                'sampled': stream.sampled,
+                'gaps': stream.gaps,
+                'overlaps': stream.overlaps,
+                'discontinuities': stream.discontinuities,
+                'max-gap': int(stream.maxGap / gst.MSECOND),
+                'max-overlap': int(stream.maxOverlap / gst.MSECOND)}
+            if name.startswith('video'):
+                audio = self._streams.get('audio' + name[len('video'):])
+                if audio and audio.offset is not None and \
+                       stream.offset is not None:
+                    stats['av-drift'] = int((stream.offset - audio.offset)
+                                            / gst.MSECOND)
+            result[name] = stats
+        return result
@@ -0,0 +1,382 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Real-time playout of recorded transport stream files.
+"""
+
+import mmap
+import os
+import time
+
+import gst
+from twisted.internet import reactor
+
+from flumotion.common import log
+from flumotion.component.producers.dvb import mpegts
+
+# PCR, PTS and DTS are 33 bit counters of a 90kHz clock
+TS_CLOCK = 90000
+TS_WRAP = 1 << 33
+
+
+def _read_timestamp(data, p):
+    return (((data[p] >> 1) & 0x07) << 30 | data[p + 1] << 22 |
+            (data[p + 2] >> 1) << 15 | data[p + 3] << 7 | data[p + 4] >> 1)
+
+
+def _write_timestamp(data, p, value):
+    # keep the prefix nibble and the marker bits
+    data[p] = (data[p] & 0xf1) | ((value >> 29) & 0x0e)
+    data[p + 1] = (value >> 22) & 0xff
+    data[p + 2] = (data[p + 2] & 0x01) | ((value >> 14) & 0xfe)
+    data[p + 3] = (value >> 7) & 0xff
+    data[p + 4] = (data[p + 4] & 0x01) | ((value << 1) & 0xfe)
+
+
+def _write_pcr(data, p, base):
+    data[p] = (base >> 25) & 0xff
+    data[p + 1] = (base >> 17) & 0xff
+    data[p + 2] = (base >> 9) & 0xff
+    data[p + 3] = (base >> 1) & 0xff
+    data[p + 4] = ((base & 0x1) << 7) | (data[p + 4] & 0x7f)
+
+
+class TSFileReader(object):
+    """
+    I read a transport stream file through mmap, a chunk of packets at a
+    time, and tell the position of each chunk in the stream from the PCR
+    of the program. When looping, I rebase the PCR, PTS and DTS of the
+    following passes so the stream stays continuous.
+
+    @ivar loops:  number of times the file was started over
+    @ivar discont: whether the last chunk read starts a new pass, where
+                   the continuity counters jump
+    """
+
+    # how much of the file to look at to find the PAT, PMT and PCRs
+    PROBE_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, filename, program_number=None, loop=False, pids=None,
+                 chunk_packets=348):
+        """
+        @param program_number: program whose PCR paces the file, defaults
+                               to the first one in the PAT
+        @param loop:           whether to start over at the end of the file
+        @param pids:           if given, only let these PIDs, the PAT and
+                               the PMT of the program through
+        """
+        self.loop = loop
+        self.loops = 0
+        self.discont = False
+        self._chunkSize = chunk_packets * mpegts.PACKET_SIZE
+        self._file = open(filename, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < mpegts.PACKET_SIZE:
+            raise ValueError("%s is too small to be a transport stream"
+                             % filename)
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        start = mpegts.find_sync(bytearray(
+            self._map[:min(size, mpegts.PACKET_SIZE * 8)]))
+        if start < 0:
+            raise ValueError("%s is not a transport stream" % filename)
+        self._start = start
+        self._end = start + (size - start) / mpegts.PACKET_SIZE * \
+                    mpegts.PACKET_SIZE
+        self._pos = self._start
+
+        self.pmt_pid, self.pcr_pid, self.es_pids = self._probe(
+            program_number)
+        self._firstPCR, self._duration = self._probePCR()
+        self._offset = 0
+        self._lastPCR = self._firstPCR
+        # PIDs given a discontinuity indicator since the last pass started
+        self._marked = None
+        self.set_pids(pids)
+
+    def set_pids(self, pids):
+        """
+        Only let these PIDs, the PAT and the PMT of the program through
+        from now on, or all of them if pids is None.
+        """
+        self._pids = None
+        if pids:
+            self._pids = set(pids)
+            self._pids.update([mpegts.PID_PAT, self.pmt_pid, self.pcr_pid])
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _probe(self, program_number):
+        probe = bytearray(self._map[self._start:
+                                    min(self._end,
+                                        self._start + self.PROBE_SIZE)])
+        parser = mpegts.TSParser()
+        pats = []
+        pmts = {}
+        parser.connect('pat', pats.append)
+        parser.connect('pmt', lambda pmt: pmts.setdefault(
+            pmt.program_number, pmt))
+        parser.feed(probe)
+        if not pats:
+            raise ValueError("No PAT found in the transport stream")
+        programs = pats[0].programs
+        if program_number is None:
+            program_number = min(programs.keys())
+        if program_number not in programs or program_number not in pmts:
+            raise ValueError("Program %d not found in the transport stream"
+                             % program_number)
+        pmt = pmts[program_number]
+        return (programs[program_number], pmt.pcr_pid,
+                set([s.pid for s in pmt.streams]))
+
+    def _findPCRs(self, start, end):
+        data = bytearray(self._map[start:end])
+        pcrs = []
+        for offset in mpegts.iter_packets(data):
+            if mpegts.packet_pid(data, offset) == self.pcr_pid:
+                pcr = mpegts.read_pcr(data, offset)
+                if pcr is not None:
+                    pcrs.append(pcr)
+        return pcrs
+
+    def _probePCR(self):
+        head = self._findPCRs(self._start,
+                              min(self._end, self._start + self.PROBE_SIZE))
+        tail = self._findPCRs(max(self._start, self._end - self.PROBE_SIZE),
+                              self._end)
+        if not head or not tail:
+            raise ValueError("No PCR found for PID 0x%04x" % self.pcr_pid)
+        # loop one PCR interval after the last one
+        interval = 0
+        if len(tail) > 1:
+            interval = (tail[-1] - tail[-2]) % TS_WRAP
+        duration = ((tail[-1] - head[0]) % TS_WRAP) + interval
+        return head[0], duration
+
+    def get_position(self):
+        """
+        @returns: position of the last chunk read, in seconds since the
+                  start of the first pass
+        """
+        return ((self._lastPCR - self._firstPCR) % TS_WRAP +
+                self._offset) / float(TS_CLOCK)
+
+    def read_chunk(self):
+        """
+        @returns: the next chunk of packets, or None at the end of the file
+        @rtype:   str
+        """
+        self.discont = False
+        if self._pos >= self._end:
+            if not self.loop:
+                return None
+            self._pos = self._start
+            self.loops += 1
+            self._offset += self._duration
+            self._lastPCR = self._firstPCR
+            self._marked = set()
+            self.discont = True
+        end = min(self._pos + self._chunkSize, self._end)
+        # rewritten in place, then made a string as gst.Buffer takes no
+        # bytearray
+        data = bytearray(buffer(self._map, self._pos, end - self._pos))
+        self._pos = end
+        self._process(data)
+        return str(data)
+
+    def _process(self, data):
+        # track the PCR, filter out unwanted PIDs and rebase the timestamps
+        # in place
+        size = mpegts.PACKET_SIZE
+        offset = self._offset % TS_WRAP
+        pcr_pid = self.pcr_pid
+        es_pids = self.es_pids
+        pids = self._pids
+        marked = self._marked
+        kept = 0
+        for p in mpegts.iter_packets(data):
+            pid = mpegts.packet_pid(data, p)
+            if pids and pid not in pids:
+                continue
+            if marked is not None and pid not in marked:
+                # the first packet of each PID after looping follows the
+                # last one of the file, flag the jump where there is an
+                # adaptation field to flag it in
+                marked.add(pid)
+                if data[p + 3] & 0x20 and data[p + 4]:
+                    data[p + 5] |= 0x80
+            if pid == pcr_pid:
+                pcr = mpegts.read_pcr(data, p)
+                if pcr is not None:
+                    self._lastPCR = pcr
+                    if offset:
+                        _write_pcr(data, p + 6, (pcr + offset) % TS_WRAP)
+            if offset and pid in es_pids and data[p + 1] & 0x40:
+                self._rebasePES(data, p, offset)
+            if pids:
+                if kept != p:
+                    data[kept:kept + size] = data[p:p + size]
+                kept += size
+        if pids:
+            del data[kept:]
+
+    def _rebasePES(self, data, p, offset):
+        start, end = mpegts.payload_bounds(data, p)
+        if end - start < 19 or data[start] != 0 or data[start + 1] != 0 or \
+               data[start + 2] != 1:
+            return
+        flags = data[start + 7] >> 6
+        if flags & 0x2:
+            pts = _read_timestamp(data, start + 9)
+            _write_timestamp(data, start + 9, (pts + offset) % TS_WRAP)
+        if flags == 0x3:
+            dts = _read_timestamp(data, start + 14)
+            _write_timestamp(data, start + 14, (dts + offset) % TS_WRAP)
+
+
+class PacedFilePusher(log.Loggable):
+    """
+    I push the chunks of a L{TSFileReader} into an appsrc at the pace
+    given by the PCR, speed times faster than real time.
+    """
+    logCategory = 'dvb'
+
+    # do not sleep for less than this, in seconds
+    MIN_DELAY = 0.005
+    # chunks pushed at most before giving the reactor a chance to run
+    MAX_CHUNKS = 32
+
+    def __init__(self, appsrc, reader, speed=1.0):
+        self._appsrc = appsrc
+        self._reader = reader
+        self._speed = speed
+        self._startTime = None
+        self._startPosition = 0.0
+        self._pushDC = None
+        self._started = False
+        self._needDataId = appsrc.connect('need-data', self._needDataCb)
+
+    def stop(self):
+        if self._needDataId:
+            self._appsrc.disconnect(self._needDataId)
+            self._needDataId = None
+        if self._pushDC:
+            self._pushDC.cancel()
+            self._pushDC = None
+        self._reader.close()
+
+    def _needDataCb(self, appsrc, length):
+        # called from the streaming thread once the source is running
+        if not self._started:
+            self._started = True
+            reactor.callFromThread(self._start)
+
+    def _start(self):
+        self.debug("Starting paced playout at %.1fx", self._speed)
+        self._startTime = time.time()
+        self._startPosition = self._reader.get_position()
+        self._push()
+
+    def _push(self):
+        self._pushDC = None
+        for i in range(self.MAX_CHUNKS):
+            data = self._reader.read_chunk()
+            if data is None:
+                self.debug("End of file reached")
+                self._appsrc.emit('end-of-stream')
+                return
+            buffer = gst.Buffer(data)
+            if self._reader.discont:
+                buffer.flag_set(gst.BUFFER_FLAG_DISCONT)
+            self._appsrc.emit('push-buffer', buffer)
+            due = self._startTime + (self._reader.get_position() -
+                                     self._startPosition) / self._speed
+            delay = due - time.time()
+            if delay >= self.MIN_DELAY:
+                self._pushDC = reactor.callLater(delay, self._push)
+                return
+        # running late, catch up without starving the reactor
+        self._pushDC = reactor.callLater(0, self._push)
+
+
+class RingFollower(log.Loggable):
+    """
+    I push what another component writes to a L{timeshift.TimeShiftBuffer}
+    into an appsrc as it arrives, starting at the live edge.
+
+    @ivar stalled: whether the writer stopped writing for longer than
+                   stall_timeout seconds
+    """
+    logCategory = 'dvb'
+
+    # maximum bytes pushed in one buffer
+    CHUNK_SIZE = 348 * mpegts.PACKET_SIZE
+
+    def __init__(self, appsrc, reader, poll_interval=0.02,
+                 stall_timeout=5.0, stalled_cb=None):
+        """
+        @type  reader:     L{timeshift.RingReader}
+        @param stalled_cb: called with True when the writer stalls and
+                           with False when it resumes
+        """
+        self._appsrc = appsrc
+        self._reader = reader
+        self._pollInterval = poll_interval
+        self._stallTimeout = stall_timeout
+        self._stalledCb = stalled_cb
+        self._offset = reader.update()
+        self._lastData = time.time()
+        self.stalled = False
+        self._pollDC = reactor.callLater(0, self._poll)
+
+    def stop(self):
+        if self._pollDC:
+            self._pollDC.cancel()
+            self._pollDC = None
+        self._reader.close()
+
+    def _poll(self):
+        self._pollDC = None
+        written = self._reader.update()
+        now = time.time()
+        if self._offset < self._reader.oldest():
+            self.warning("Fell behind the ring by %d bytes, skipping to "
+                         "the live edge", written - self._offset)
+            self._offset = written
+        while self._offset < written:
+            data = self._reader.read(self._offset, self.CHUNK_SIZE)
+            if data is None:
+                self._offset = written
+                break
+            self._appsrc.emit('push-buffer', gst.Buffer(data))
+            self._offset += len(data)
+            self._lastData = now
+        self._setStalled(now - self._lastData > self._stallTimeout)
+        self._pollDC = reactor.callLater(self._pollInterval, self._poll)
+
+    def _setStalled(self, stalled):
+        if stalled == self.stalled:
+            return
+        self.stalled = stalled
+        if stalled:
+            self.warning("Nothing written to %s for %.1f seconds",
+                         self._reader.filename, self._stallTimeout)
+        if self._stalledCb:
+            self._stalledCb(stalled)
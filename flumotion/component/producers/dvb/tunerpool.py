@@ -0,0 +1,316 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Sharing of the DVB frontends of a machine between components.
+
+The components of a worker run in separate processes, so the pool keeps
+its state in a file, under a lock, in a directory they all can reach:
+the tuners directory of L{statedir}, unless told otherwise.
+"""
+
+import errno
+import fcntl
+import glob
+import os
+import re
+import struct
+
+from flumotion.component.producers.dvb import statedir
+
+# FE_GET_INFO ioctl, reading a struct dvb_frontend_info
+_FE_GET_INFO = 0x80a86f3d
+_FRONTEND_INFO = struct.Struct('128sI9I')
+# dvb-type of each fe_type_t
+_FRONTEND_TYPES = {0: 'S', 1: 'C', 2: 'T'}
+
+
+class TunerPoolFull(Exception):
+    """
+    All the frontends are tuned to other frequencies.
+    """
+
+
+def tuning_key(dvbType, frequency, polarity=None, symbolRate=None,
+               satellite=None):
+    """
+    @returns: what tells a multiplex apart from the others frontends of
+              dvbType can tune to, as a string without spaces; the
+              polarity, symbol rate and satellite only count for DVB-S
+    """
+    if dvbType == 'S':
+        return 'S:%d:%s:%s:%d' % (frequency, (polarity or '-')[0].lower(),
+                                  str(symbolRate).strip(), satellite or 0)
+    return '%s:%d' % (dvbType, frequency)
+
+
+class Claim(object):
+    """
+    A component using a frontend.
+
+    @ivar tuning: the L{tuning_key} of the multiplex the frontend is
+                  tuned to
+    @ivar master: whether the component tunes the frontend; the others
+                  read what it writes to the ring file
+    """
+
+    def __init__(self, owner, pid, adapter, frontend, tuning, programs,
+                 master):
+        self.owner = owner
+        self.pid = pid
+        self.adapter = adapter
+        self.frontend = frontend
+        self.tuning = tuning
+        self.programs = programs
+        self.master = master
+
+    def tuner(self):
+        return self.adapter, self.frontend
+
+    def get_frequency(self):
+        return int(self.tuning.split(':')[1])
+
+    def to_line(self):
+        return '%s %d %d %d %s %s %d\n' % (
+            self.owner, self.pid, self.adapter, self.frontend,
+            self.tuning, ':'.join([str(p) for p in self.programs]) or '-',
+            self.master)
+
+    def from_line(cls, line):
+        owner, pid, adapter, frontend, tuning, programs, master = \
+            line.split()
+        programs = [int(p) for p in programs.split(':') if p != '-']
+        return cls(owner, int(pid), int(adapter), int(frontend),
+                   tuning, programs, bool(int(master)))
+    from_line = classmethod(from_line)
+
+
+def find_frontends():
+    """
+    @returns: sorted list of (adapter, frontend) present on this machine
+    """
+    frontends = []
+    for path in glob.glob('/dev/dvb/adapter*/frontend*'):
+        m = re.match(r'.*/adapter(\d+)/frontend(\d+)$', path)
+        if m:
+            frontends.append((int(m.group(1)), int(m.group(2))))
+    frontends.sort()
+    return frontends
+
+
+def probe_frontend_type(adapter, frontend):
+    """
+    Ask the driver which delivery system a frontend is for. This works
+    while another process uses the frontend.
+
+    @returns: the dvb-type of the frontend, 'S', 'C' or 'T', or None if
+              it cannot be opened or is of another kind
+    """
+    path = '/dev/dvb/adapter%d/frontend%d' % (adapter, frontend)
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        try:
+            info = fcntl.ioctl(fd, _FE_GET_INFO,
+                               '\0' * _FRONTEND_INFO.size)
+        except IOError:
+            return None
+    finally:
+        os.close(fd)
+    return _FRONTEND_TYPES.get(_FRONTEND_INFO.unpack(info)[1])
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class TunerPool(object):
+    """
+    I hand the frontends of the machine to the components asking for a
+    multiplex. Components asking for a multiplex a frontend is already
+    tuned to share it: the first one tunes it and writes the transport
+    stream to a ring file the others read.
+    """
+
+    def __init__(self, directory=None, frontends=None, types=None):
+        """
+        @param frontends: list of (adapter, frontend) to use, defaults to
+                          all the ones present
+        @param types:     dict of (adapter, frontend) -> dvb-type, the
+                          frontends missing from it are probed
+        @raises OSError: when the default directory cannot be created
+        """
+        self.directory = directory or statedir.get_directory('tuners')
+        if frontends is None:
+            frontends = find_frontends()
+        self.frontends = list(frontends)
+        self._types = dict(types or {})
+        self._stateFile = os.path.join(self.directory, 'claims')
+        self._lockFile = os.path.join(self.directory, 'lock')
+
+    def ring_filename(self, adapter, frontend):
+        """
+        @returns: the ring file the master of a frontend writes to
+        """
+        return os.path.join(self.directory,
+                            'adapter%d-frontend%d.ts' % (adapter, frontend))
+
+    def acquire(self, owner, tuning, programs):
+        """
+        Get a frontend tuned, or to tune, to a multiplex.
+
+        @param owner:    unique name of the component
+        @param tuning:   L{tuning_key} of the multiplex
+        @param programs: program numbers the component wants
+        @rtype:   L{Claim}
+        @raises TunerPoolFull: when no frontend can be had
+        """
+        return self._transaction(self._acquire, owner, tuning, programs)
+
+    def get_type(self, adapter, frontend):
+        """
+        @returns: the dvb-type of a frontend, or None if unknown
+        """
+        tuner = adapter, frontend
+        if tuner not in self._types:
+            self._types[tuner] = probe_frontend_type(adapter, frontend)
+        return self._types[tuner]
+
+    def release(self, owner):
+        self._transaction(self._release, owner)
+
+    def set_programs(self, owner, programs):
+        """
+        Change the program numbers owner wants from its frontend.
+        """
+        self._transaction(self._setPrograms, owner, programs)
+
+    def get_claims(self):
+        """
+        @returns: the live claims, as a list of L{Claim}
+        """
+        return self._transaction(lambda claims: claims)
+
+    def get_programs(self, adapter, frontend):
+        """
+        @returns: sorted program numbers wanted from a frontend
+        """
+        programs = set()
+        for claim in self.get_claims():
+            if claim.tuner() == (adapter, frontend):
+                programs.update(claim.programs)
+        return sorted(programs)
+
+    def get_usage(self):
+        """
+        @returns: dict with the number of frontends, the number in use
+                  and the number shared, and the list of claims as dicts
+        """
+        claims = self.get_claims()
+        users = {}
+        for claim in claims:
+            users.setdefault(claim.tuner(), []).append(claim)
+        return dict(
+            frontends=len(self.frontends),
+            used=len(users),
+            shared=len([u for u in users.values() if len(u) > 1]),
+            claims=[dict(owner=c.owner, adapter=c.adapter,
+                         frontend=c.frontend, frequency=c.get_frequency(),
+                         tuning=c.tuning, programs=c.programs,
+                         master=c.master)
+                    for c in claims])
+
+    def _acquire(self, claims, owner, tuning, programs):
+        claims[:] = [c for c in claims if c.owner != owner]
+        tuned = {}
+        for claim in claims:
+            tuned.setdefault(claim.tuner(), claim.tuning)
+        for tuner, tunedTuning in sorted(tuned.items()):
+            if tunedTuning == tuning:
+                claim = Claim(owner, os.getpid(), tuner[0], tuner[1],
+                              tuning, programs, False)
+                claims.append(claim)
+                return claim
+        dvbType = tuning.split(':')[0]
+        frontends = [tuner for tuner in self.frontends
+                     if self.get_type(*tuner) == dvbType]
+        for tuner in frontends:
+            if tuner not in tuned:
+                claim = Claim(owner, os.getpid(), tuner[0], tuner[1],
+                              tuning, programs, True)
+                claims.append(claim)
+                return claim
+        if not frontends:
+            raise TunerPoolFull("No DVB-%s frontends found" % dvbType)
+        raise TunerPoolFull("All %d DVB-%s frontends are in use"
+                            % (len(frontends), dvbType))
+
+    def _setPrograms(self, claims, owner, programs):
+        for claim in claims:
+            if claim.owner == owner:
+                claim.programs = list(programs)
+
+    def _release(self, claims, owner):
+        released = [c for c in claims if c.owner == owner]
+        claims[:] = [c for c in claims if c.owner != owner]
+        for claim in released:
+            if claim.master:
+                self._promote(claims, claim.tuner())
+
+    def _promote(self, claims, tuner):
+        # hand a frontend whose master went away over to another user
+        others = [c for c in claims if c.tuner() == tuner]
+        if others and not [c for c in others if c.master]:
+            others[0].master = True
+
+    def _transaction(self, function, *args):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        lock = open(self._lockFile, 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            claims = []
+            if os.path.exists(self._stateFile):
+                for line in open(self._stateFile):
+                    if line.strip():
+                        claims.append(Claim.from_line(line))
+            alive = [c for c in claims if _alive(c.pid)]
+            changed = len(alive) != len(claims)
+            for c in claims:
+                if c.master and c not in alive:
+                    self._promote(alive, c.tuner())
+            before = [c.to_line() for c in alive]
+            result = function(alive, *args)
+            if changed or [c.to_line() for c in alive] != before:
+                tmp = self._stateFile + '.tmp'
+                f = open(tmp, 'w')
+                f.writelines([c.to_line() for c in alive])
+                f.close()
+                os.rename(tmp, self._stateFile)
+            return result
+        finally:
+            lock.close()
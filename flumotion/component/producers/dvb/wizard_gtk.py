@@ -206,6 +206,7 @@ class DVBProbeChannelsStep(WorkerWizardStep):
         model.firstStep = self
         self.model = model
         self._shouldScan = False
+        self._sweepId = None
 
         self.channels.connect('selection-changed',
                               self.on_channels__selection_changed)
@@ -231,9 +232,9 @@ class DVBProbeChannelsStep(WorkerWizardStep):
         self.model.transportStreams = {}
 
         self.channels.clear()
+        self._channelRows = {}
 
-        self._frequenciesToScan = []
-        self._frequenciesAlreadyScanned = []
+        self._sweepId = None
         self._pulseCallLaterId = -1
 
         self._shouldScan = True
@@ -324,19 +325,78 @@ class DVBProbeChannelsStep(WorkerWizardStep):
         return d
 
     def _runNewScan(self):
+        self._startPulseProgressBar()
+        adapters = [a[1] for a in self._adapters
+                    if a[0] == self.model.dvbtype]
+        self.progress.set_text(_("Scanning channels"))
+
+        def scanStarted(sweepId):
+            self._sweepId = sweepId
+            if not self._shouldScan:
+                self._stopScan()
+            return self._followScan(0)
+
+        def scanError(failure):
+            failure.trap(errors.RemoteRunError)
+            self._finishedScanning()
+
+        # the worker goes through the frequencies and the NITs by itself,
+        # we only show what it finds
+        d = self.wizard.runInWorker(self.model.worker,
+                "flumotion.worker.checks.dvb", "startScan",
+                adapters, self.model.dvbtype, self.model.antenna)
+        d.addCallback(scanStarted)
+        d.addErrback(scanError)
+        return d
+
+    def _followScan(self, revision):
+
+        def progressReceived(progress):
+            self.model.transportStreams.update(progress['transport_streams'])
+            for sid, channel in progress['channels'].items():
+                if sid == 0:
+                    continue
+                chanData = self.model.channels.setdefault(sid, {})
+                chanData.update(channel)
+                row = self._channelRows.get(sid)
+                if row is None:
+                    row = self._channelRows[sid] = DVBChannel(sid, chanData)
+                    self.channels.append(row)
+                else:
+                    row.name = chanData.get('name', row.name)
+                    self.channels.update(row)
+                self.debug("Channel %r updated with data: %r", sid, chanData)
+
+            if progress['done']:
+                self._sweepId = None
+                self._finishedScanning()
+                return
+            done = progress['scanned'] + progress['reused']
+            total = done + len(progress['scanning']) + progress['remaining']
+            if progress['scanning']:
+                self.progress.set_text(_("Scanning %s Hz (%d of %d)") % (
+                    ', '.join([str(f) for f in progress['scanning']]),
+                    done + 1, total))
+            return self._followScan(progress['revision'])
+
+        def scanError(failure):
+            failure.trap(errors.RemoteRunError)
+            self._sweepId = None
+            self._finishedScanning()
 
-        def receivedInitialTuningData(initialTuning):
-            self._startPulseProgressBar()
-            self.debug("Initial tuning: %r", initialTuning)
-            # now we need to do the scanning
-            for freq in initialTuning:
-                self._frequenciesToScan.append(freq)
-            return self._scan()
+        d = self.wizard.runInWorker(self.model.worker,
+                "flumotion.worker.checks.dvb", "getScanProgress",
+                self._sweepId, revision)
+        d.addCallback(progressReceived)
+        d.addErrback(scanError)
+        return d
 
+    def _stopScan(self):
+        if self._sweepId is None:
+            return
         d = self.wizard.runInWorker(self.model.worker,
-                "flumotion.worker.checks.dvb",
-                "getInitialTuning", self.model.dvbtype, self.model.antenna)
-        d.addCallback(receivedInitialTuningData)
+                "flumotion.worker.checks.dvb", "stopScan", self._sweepId)
+        d.addErrback(lambda failure: failure.trap(errors.RemoteRunError))
         return d
 
     def _updateCountries(self):
@@ -400,78 +460,6 @@ class DVBProbeChannelsStep(WorkerWizardStep):
             self.wizard.blockNext(True)
             self.progress.set_text(_("No channels found"))
 
-    def _scan(self):
-        if not self._frequenciesToScan or not self._shouldScan:
-            self._finishedScanning()
-            return
-        f = None
-        while True:
-            if not self._frequenciesToScan:
-                break
-            f = self._frequenciesToScan.pop()
-            key = f["frequency"], f.get("polarization")
-            if not key in self._frequenciesAlreadyScanned:
-                break
-            f = None
-        if not f:
-            self._finishedScanning()
-            return
-
-        self.progress.set_text("Scanning %s Hz" % (f["frequency"], ))
-
-        def frequencyScanned((channels, moreFrequencies)):
-            # add frequency just scanned to frequencies_already_scanned
-            key = f["frequency"], f.get('polarization')
-            self._frequenciesAlreadyScanned.append(key)
-            for tsid in moreFrequencies:
-                tuningparams = moreFrequencies[tsid]
-                self.model.transportStreams[tsid] = tuningparams
-                key = tuningparams["frequency"], \
-                    tuningparams.get('polarization')
-                if key in self._frequenciesAlreadyScanned:
-                    continue
-                self._frequenciesToScan.append(tuningparams)
-
-                self.debug("Delivery: %r\nKey: %r\n"
-                           "Frequencies scanned already: %r",
-                           tuningparams, key, self._frequenciesAlreadyScanned)
-
-            for sid, channel in channels.items():
-                if sid == 0:
-                    continue
-
-                chanData = self.model.channels.setdefault(sid, {})
-                chanData.update(channel)
-                self.channels.append(DVBChannel(sid, channel))
-
-                self.debug("Channel %r added with data: %r", sid, chanData)
-                # let us fill in missing tsid tuning data for any channels
-                # that came in with this scan
-
-                # basically, if we have the tsid for the channel
-                # get the tsid of this channel
-                # see if it is already filled in self.model.transportStreams
-                # if not, fill it in
-                if "transport-stream-id" in chanData:
-                    tsid = chanData["transport-stream-id"]
-                    if not tsid in self.model.transportStreams:
-                        #self.debug("FILLING IN TSID %d with %r", tsid, f)
-                        self.model.transportStreams[tsid] = f
-
-            return self._scan()
-
-        def frequencyScanError(failure):
-            failure.trap(errors.RemoteRunError)
-            #self.error('ERROR SCANNING FREQUENCY %s', f)
-            return self._scan()
-
-        d = self.wizard.runInWorker(self.model.worker,
-                "flumotion.worker.checks.dvb", "scan",
-                self.model.adapterNumber, self.model.dvbtype, f)
-        d.addCallback(frequencyScanned)
-        d.addErrback(frequencyScanError)
-        return d
-
     # Callbacks
 
     def on_adapter__changed(self, adaptercombo):
@@ -503,6 +491,8 @@ class DVBProbeChannelsStep(WorkerWizardStep):
 
     def on_stop_scan_clicked(self, button):
         self._shouldScan = False
+        self.stop_scan.set_sensitive(False)
+        self._stopScan()
 
 
 class DVBConfig(WizardStep): #VideoProducerStep, AudioProducerStep):
@@ -0,0 +1,211 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_mpegts -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import common
+
+from twisted.trial import unittest
+
+from flumotion.component.producers.dvb import mpegts
+
+
+def makeSection(tableId, extension, body, version=0, number=0, last=0):
+    """
+    Build a long section with a valid CRC.
+    """
+    length = 5 + len(body) + 4
+    data = bytearray([tableId, 0xb0 | (length >> 8), length & 0xff,
+                      extension >> 8, extension & 0xff,
+                      0xc1 | (version << 1), number, last])
+    data.extend(body)
+    crc = mpegts.crc32(data)
+    data.extend([crc >> 24, (crc >> 16) & 0xff, (crc >> 8) & 0xff,
+                 crc & 0xff])
+    return data
+
+
+def makePAT(programs, tsid=1, version=0, number=0, last=0):
+    body = bytearray()
+    for program, pid in sorted(programs.items()):
+        body.extend([program >> 8, program & 0xff, 0xe0 | (pid >> 8),
+                     pid & 0xff])
+    return makeSection(mpegts.TABLE_PAT, tsid, body, version, number, last)
+
+
+def packetize(pid, section, cc=0):
+    """
+    Split a section in the packets of pid, the first one with a pointer
+    field, the last one stuffed.
+    """
+    payload = bytearray([0]) + section
+    packets = bytearray()
+    first = True
+    while payload:
+        chunk = payload[:184]
+        payload = payload[184:]
+        chunk.extend([0xff] * (184 - len(chunk)))
+        packets.extend([mpegts.SYNC_BYTE, (first and 0x40 or 0) | pid >> 8,
+                        pid & 0xff, 0x10 | cc])
+        packets.extend(chunk)
+        cc = (cc + 1) & 0x0f
+        first = False
+    return packets
+
+
+def nullPacket():
+    return bytearray([mpegts.SYNC_BYTE, 0x1f, 0xff, 0x10]) + \
+           bytearray([0xff] * 184)
+
+
+class TestCRC(unittest.TestCase):
+
+    def testCheckValue(self):
+        self.assertEquals(mpegts.crc32(bytearray('123456789')), 0x0376e6e7)
+
+    def testWholeSection(self):
+        section = makePAT({1: 0x100})
+        self.assertEquals(mpegts.crc32(section), 0)
+        self.failUnless(mpegts.Section(section, 0, len(section)).crc_ok())
+
+    def testCorrupted(self):
+        section = makePAT({1: 0x100})
+        section[9] ^= 0x01
+        self.failIf(mpegts.Section(section, 0, len(section)).crc_ok())
+
+
+class TestPackets(unittest.TestCase):
+
+    def testFindSync(self):
+        data = bytearray('\x00\x47\x00') + nullPacket() + nullPacket()
+        # a lone sync byte is not a packet boundary
+        self.assertEquals(mpegts.find_sync(data), 3)
+        self.assertEquals(mpegts.find_sync(bytearray(10)), -1)
+
+    def testIterPackets(self):
+        data = nullPacket() + bytearray('junk') + nullPacket() + \
+               nullPacket()[:100]
+        self.assertEquals(list(mpegts.iter_packets(data)), [0, 192])
+
+    def testReadPCR(self):
+        packet = bytearray([mpegts.SYNC_BYTE, 0x01, 0x00, 0x20, 183, 0x10])
+        pcr = 0x123456789
+        packet.extend([pcr >> 25, (pcr >> 17) & 0xff, (pcr >> 9) & 0xff,
+                       (pcr >> 1) & 0xff, (pcr & 1) << 7 | 0x7e, 0])
+        packet.extend([0xff] * (188 - len(packet)))
+        self.assertEquals(mpegts.read_pcr(packet, 0), pcr)
+        self.assertEquals(mpegts.read_pcr(nullPacket(), 0), None)
+
+
+class TestSectionAssembler(unittest.TestCase):
+
+    def setUp(self):
+        self.assembler = mpegts.SectionAssembler()
+
+    def push(self, data):
+        sections = []
+        for offset in mpegts.iter_packets(data):
+            sections.extend(self.assembler.push(data, offset))
+        return sections
+
+    def testSinglePacket(self):
+        section = makePAT({1: 0x100})
+        sections = self.push(packetize(0, section))
+        self.assertEquals(len(sections), 1)
+        self.assertEquals(sections[0].key(), (mpegts.TABLE_PAT, 1, 0, 0))
+        self.assertEquals(str(sections[0].data[sections[0].start:
+                                               sections[0].end]),
+                          str(section))
+
+    def testSpanningPackets(self):
+        programs = dict([(n, 0x100 + n) for n in range(1, 80)])
+        section = makePAT(programs)
+        data = packetize(0, section)
+        self.assertEquals(len(data), 2 * mpegts.PACKET_SIZE)
+        sections = self.push(data)
+        self.assertEquals(len(sections), 1)
+        self.failUnless(sections[0].crc_ok())
+        self.assertEquals(mpegts.parse_pat(sections[0]).programs, programs)
+
+    def testLostPacket(self):
+        programs = dict([(n, 0x100 + n) for n in range(1, 80)])
+        data = packetize(0, makePAT(programs))
+        # the continuity counter of the second packet jumps
+        data[mpegts.PACKET_SIZE + 3] = 0x10 | 5
+        self.assertEquals(self.push(data), [])
+
+
+class TestParsePAT(unittest.TestCase):
+
+    def testPrograms(self):
+        section = makePAT({0: 0x10, 1: 0x100, 2: 0x200}, tsid=7,
+                          version=3)
+        pat = mpegts.parse_pat(mpegts.Section(section, 0, len(section)))
+        self.assertEquals(pat.transport_stream_id, 7)
+        self.assertEquals(pat.version, 3)
+        self.assertEquals(pat.programs, {1: 0x100, 2: 0x200})
+        self.assertEquals(pat.network_pid, 0x10)
+
+
+class TestTSParser(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = mpegts.TSParser()
+        self.pats = []
+        self.parser.connect('pat', self.pats.append)
+
+    def testMultiSectionPAT(self):
+        self.parser.feed(packetize(0, makePAT({1: 0x100}, last=1)))
+        self.parser.feed(packetize(0, makePAT({2: 0x200}, number=1,
+                                              last=1), cc=1))
+        self.assertEquals(len(self.pats), 2)
+        self.assertEquals(self.parser.pmt_pids, {0x100: 1, 0x200: 2})
+
+    def testPATVersionChange(self):
+        self.parser.feed(packetize(0, makePAT({1: 0x100}, last=1)))
+        self.parser.feed(packetize(0, makePAT({2: 0x200}, number=1,
+                                              last=1), cc=1))
+        self.parser.feed(packetize(0, makePAT({3: 0x300}, version=1),
+                                   cc=2))
+        self.assertEquals(self.parser.pmt_pids, {0x300: 3})
+
+    def testRepeatedSection(self):
+        section = makePAT({1: 0x100})
+        for cc in range(3):
+            self.parser.feed(packetize(0, section, cc=cc))
+        self.assertEquals(len(self.pats), 1)
+        self.assertEquals(self.parser.cache.skipped, 2)
+
+    def testBadCRC(self):
+        section = makePAT({1: 0x100})
+        section[-1] ^= 0xff
+        self.parser.feed(packetize(0, section))
+        self.assertEquals(self.pats, [])
+        self.assertEquals(self.parser.crc_errors, 1)
+
+    def testSplitFeed(self):
+        data = nullPacket() + packetize(0, makePAT({1: 0x100}))
+        self.parser.feed(data[:250])
+        self.assertEquals(self.pats, [])
+        self.parser.feed(data[250:])
+        self.assertEquals(len(self.pats), 1)
+        self.assertEquals(self.parser.packets, 2)
+
+    def testResync(self):
+        data = bytearray('garbage') + nullPacket() + \
+               packetize(0, makePAT({1: 0x100}))
+        self.parser.feed(data)
+        self.assertEquals(self.parser.sync_losses, 1)
+        self.assertEquals(len(self.pats), 1)
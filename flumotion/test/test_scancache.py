@@ -0,0 +1,172 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_scancache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import os
+
+import common
+
+from twisted.trial import unittest
+
+from flumotion.component.producers.dvb import scancache
+
+TUNING_S = {"frequency": 11778000, "polarization": "vertical",
+            "symbol-rate": 27500, "inner-fec": "3/4"}
+TUNING_T = {"frequency": 514000000, "bandwidth": 8, "code-rate-hp": "2/3",
+            "code-rate-lp": "NONE", "constellation": "QAM64",
+            "transmission-mode": "8k", "guard-interval": 4,
+            "hierarchy": "NONE"}
+TUNING_C = {"frequency": 410000000, "symbol-rate": 6900,
+            "inner-fec": "NONE", "modulation": "QAM64"}
+
+
+class TestEncoding(unittest.TestCase):
+
+    def assertRoundTrip(self, value):
+        text = scancache._encode(value)
+        self.failIf(' ' in text or ',' in text or '=' in text, text)
+        decoded = scancache._decode(text)
+        self.assertEquals(decoded, value)
+        self.assertEquals(type(decoded), type(value))
+
+    def testTypes(self):
+        for value in (None, 0, 42, -1, True, False, '', 'text',
+                      '42', '-', 'a b,c=d/e:f', u'caf\xe9', u'42'):
+            self.assertRoundTrip(value)
+
+    def testUnicodeIsUTF8(self):
+        self.assertEquals(scancache._encode(u'caf\xe9'), 'ucaf%C3%A9')
+
+    def testUnknownType(self):
+        self.assertRaises(ValueError, scancache._decode, 'x1')
+        self.assertRaises(TypeError, scancache._encode, object())
+
+
+class TestScanCache(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = self.mktemp()
+
+    def makeMux(self):
+        channels = {
+            1: {'name': u'T\xe9l\xe9 1', 'transport-stream-id': 3,
+                'pmt-pid': 100, 'logical-channel-number': 1,
+                'video-streams': [101], 'audio-streams': [('spa', 102),
+                                                          (u'eng', 103)]},
+            2: {'name': '1234'}}
+        return scancache.Mux(TUNING_T, 3, 1, 7, 2, channels)
+
+    def testSaveLoad(self):
+        cache = scancache.ScanCache(self.filename)
+        cache.get_network('DVB-T', '/initial/tuning').set_mux(
+            self.makeMux())
+        cache.save()
+        self.failIf(os.path.exists(self.filename + '.tmp'))
+
+        network = scancache.ScanCache(self.filename).get_network(
+            'DVB-T', '/initial/tuning')
+        mux = network.get_mux(TUNING_T)
+        expected = self.makeMux()
+        self.assertEquals(mux.tuning, expected.tuning)
+        self.assertEquals((mux.tsid, mux.network_id, mux.nit_version,
+                           mux.sdt_version), (3, 1, 7, 2))
+        self.assertEquals(mux.channels, expected.channels)
+        self.assertEquals(type(mux.channels[2]['name']), str)
+        self.failUnless(mux.is_complete())
+
+    def testIncompleteMux(self):
+        cache = scancache.ScanCache(self.filename)
+        cache.get_network('DVB-S', 'tuning').set_mux(
+            scancache.Mux(TUNING_S))
+        cache.save()
+        mux = scancache.ScanCache(self.filename).get_network(
+            'DVB-S', 'tuning').get_mux(TUNING_S)
+        self.assertEquals(mux.tsid, None)
+        self.failIf(mux.is_complete())
+
+    def testOtherFormatIgnored(self):
+        f = open(self.filename, 'w')
+        f.write('network DVB-T tuning\nmux 3 1 7 2 frequency=514000000\n')
+        f.close()
+        cache = scancache.ScanCache(self.filename)
+        self.assertEquals(cache.get_network('DVB-T', 'tuning').muxes, {})
+
+    def testCorruptedLinesSkipped(self):
+        cache = scancache.ScanCache(self.filename)
+        cache.get_network('DVB-T', 'tuning').set_mux(self.makeMux())
+        cache.save()
+        f = open(self.filename, 'a')
+        f.write('channel\nmux x1 i2\nchannel 9 sname - - -\n')
+        f.close()
+        network = scancache.ScanCache(self.filename).get_network(
+            'DVB-T', 'tuning')
+        self.assertEquals(network.get_mux(TUNING_T).channels.keys(), [1, 2])
+
+    def testMissingFile(self):
+        cache = scancache.ScanCache(self.filename)
+        self.assertEquals(cache.get_network('DVB-C', 'tuning').muxes, {})
+
+    def testGetResult(self):
+        network = scancache.Network('DVB-T', 'tuning')
+        network.set_mux(self.makeMux())
+        network.set_mux(scancache.Mux(TUNING_C))
+        channels, transportStreams = network.get_result()
+        self.assertEquals(transportStreams, {3: TUNING_T})
+        self.assertEquals(sorted(channels.keys()), [1, 2])
+
+
+class TestChannelsConf(unittest.TestCase):
+
+    def roundTrip(self, adapterType, tuning):
+        network = scancache.Network(adapterType, 'tuning')
+        network.set_mux(scancache.Mux(tuning, 3, 1, 7, 2, {
+            5: {'name': 'Radio: One', 'video-streams': [],
+                'audio-streams': [('spa', 65)]},
+            6: {'name': u'T\xe9l\xe9', 'video-streams': [64],
+                'audio-streams': [('spa', 66)]}}))
+        lines = network.export_channels_conf()
+        self.assertEquals(len(lines), 2)
+
+        imported = scancache.Network(adapterType, 'tuning')
+        self.assertEquals(imported.import_channels_conf(lines), 2)
+        mux = imported.get_mux(tuning)
+        self.failIf(mux.is_complete())
+        self.assertEquals(mux.channels[5]['name'], 'Radio  One')
+        self.assertEquals(mux.channels[5]['audio-streams'],
+                          [('pid-65', 65)])
+        self.assertEquals(mux.channels[6]['name'], 'T\xc3\xa9l\xc3\xa9')
+        self.assertEquals(mux.channels[6]['video-streams'], [64])
+        return mux
+
+    def testSatellite(self):
+        mux = self.roundTrip('DVB-S', TUNING_S)
+        self.assertEquals(mux.tuning['frequency'], TUNING_S['frequency'])
+        self.assertEquals(mux.tuning['polarization'], 'vertical')
+        self.assertEquals(mux.tuning['symbol-rate'], 27500)
+
+    def testTerrestrial(self):
+        mux = self.roundTrip('DVB-T', TUNING_T)
+        self.assertEquals(mux.tuning, TUNING_T)
+
+    def testCable(self):
+        mux = self.roundTrip('DVB-C', TUNING_C)
+        self.assertEquals(mux.tuning, TUNING_C)
+
+    def testSkipsBadLines(self):
+        network = scancache.Network('DVB-C', 'tuning')
+        lines = ['# comment\n', '\n', 'name:only\n',
+                 'x:410000000:INVERSION_AUTO:6900000:FEC_NONE:QAM_64:a:b:c\n']
+        self.assertEquals(network.import_channels_conf(lines), 0)
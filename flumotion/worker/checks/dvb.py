@@ -16,18 +16,77 @@
 # Headers in this file shall remain intact.
 
 
+import copy
 import os
 import string
+import time
 
 import gobject
 import gst
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure
 
 from flumotion.common import log, messages, errors
+from flumotion.common.i18n import N_, gettexter
+from flumotion.component.producers.dvb import decoders, dispatch, mpegts
+from flumotion.component.producers.dvb import scancache, statedir
+from flumotion.component.producers.dvb import tunerpool
 from flumotion.worker.checks import check
 from flumotion.worker.checks.gst010 import do_element_check
 
 __version__ = "$Rev: 6883 $"
+T_ = gettexter('flumotion')
+
+
+# seconds a pipeline can take to change state before a frontend is
+# given up on as wedged
+STATE_CHANGE_TIMEOUT = 30
+
+
+def _changeState(pipeline, state, timeout):
+    # called in a thread: dvbsrc opens and tunes the frontend from within
+    # set_state, which blocks for as long as the card takes
+    ret = pipeline.set_state(state)
+    if ret == gst.STATE_CHANGE_ASYNC:
+        ret = pipeline.get_state(timeout * gst.SECOND)[0]
+    if ret == gst.STATE_CHANGE_ASYNC:
+        ret = gst.STATE_CHANGE_FAILURE
+    return ret
+
+
+def _setState(pipeline, state, timeout=STATE_CHANGE_TIMEOUT):
+    """
+    Change the state of a pipeline out of the reactor thread, so that a
+    slow or wedged DVB card does not stall the rest of the worker.
+
+    @returns: a deferred firing with the gst.StateChangeReturn, which is
+              gst.STATE_CHANGE_FAILURE when the change failed or did not
+              complete within timeout seconds
+    @rtype:   L{twisted.internet.defer.Deferred}
+    """
+    d = defer.Deferred()
+    name = gst.element_state_get_name(state)
+
+    def changed(ret):
+        if timeoutDC.active():
+            timeoutDC.cancel()
+            d.callback(ret)
+
+    def failed(failure):
+        log.warning('check', 'Could not set %s to %s: %s',
+                    pipeline.get_name(), name, failure.getErrorMessage())
+        changed(gst.STATE_CHANGE_FAILURE)
+
+    def timedOut():
+        # the thread is left blocked, its result is ignored
+        log.warning('check', '%s did not get to %s in %d seconds',
+                    pipeline.get_name(), name, timeout)
+        d.callback(gst.STATE_CHANGE_FAILURE)
+
+    timeoutDC = reactor.callLater(timeout, timedOut)
+    threads.deferToThread(_changeState, pipeline, state, timeout
+                          ).addCallbacks(changed, failed)
+    return d
 
 
 def getListOfAdaptersWithTypes():
@@ -38,37 +97,97 @@ def getListOfAdaptersWithTypes():
 
     @rtype: L{twisted.internet.defer.Deferred}
     """
-    result = messages.Result()
 
     def get_type_of_adapter(adapter):
         dvbelement = gst.element_factory_make("dvbsrc", "test_dvbsrc")
         dvbelement.set_property("adapter", adapter)
-        pipeline = gst.Pipeline("")
+        pipeline = gst.Pipeline("adapter%d" % adapter)
         pipeline.add(dvbelement)
-        pipeline.set_state(gst.STATE_READY)
-        pipeline.get_state()
-        bus = pipeline.get_bus()
-        adaptertype = None
-        while bus.have_pending():
-            msg = bus.pop()
-            if msg.type == gst.MESSAGE_ELEMENT and msg.src == dvbelement:
-                structure = msg.structure
-                if structure.get_name() == "dvb-adapter":
-                    adaptertype = structure["type"]
-                    break
-        pipeline.set_state(gst.STATE_NULL)
-        return adaptertype
-    # FIXME: use hal instead
-    adapterlist = []
-    for i in range(0, 8):
-        if os.path.exists('/dev/dvb/adapter%d/frontend0' % i):
-            adaptertype = get_type_of_adapter(i)
+
+        def ready(ret):
+            bus = pipeline.get_bus()
+            adaptertype = None
+            while bus.have_pending():
+                msg = bus.pop()
+                if msg.type == gst.MESSAGE_ELEMENT and \
+                       msg.src == dvbelement:
+                    structure = msg.structure
+                    if structure.get_name() == "dvb-adapter":
+                        adaptertype = structure["type"]
+                        break
+            d = _setState(pipeline, gst.STATE_NULL)
+            d.addCallback(lambda _: adaptertype)
+            return d
+        d = _setState(pipeline, gst.STATE_READY)
+        d.addCallback(ready)
+        return d
+
+    def probed(types, adapters):
+        adapterlist = []
+        for i, (success, adaptertype) in zip(adapters, types):
+            if not success:
+                log.warning('check', 'Could not probe adapter %d: %s', i,
+                            adaptertype.getErrorMessage())
+                adaptertype = None
             adapterlist.append((adaptertype, i, "DVB (%s) Adapter %d" % (
                     adaptertype, i)))
-    result.succeed(adapterlist)
+        result = messages.Result()
+        result.succeed(adapterlist)
+        return result
+
+    # FIXME: use hal instead
+    adapters = [i for i in range(0, 8)
+                if os.path.exists('/dev/dvb/adapter%d/frontend0' % i)]
+    # the adapters are opened at once, a wedged one only delays the answer
+    d = defer.DeferredList([get_type_of_adapter(i) for i in adapters])
+    d.addCallback(probed, adapters)
+    return d
+
+
+def getTunerPoolUsage(directory=None):
+    """
+    Find how the frontends of the worker are shared between the
+    components using its tuner pool.
+    Returns a dict with the number of frontends, used and shared ones
+    and the list of claims on them.
+
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+    result = messages.Result()
+    result.succeed(tunerpool.TunerPool(directory).get_usage())
     return result
 
 
+def benchmarkDecoders():
+    """
+    Time the decoders installed on the worker for each kind of stream a
+    DVB program can carry, and save the ranking the components use to
+    choose their decoders.
+    Returns a dict of stream kind -> list of (parser, decoder, seconds),
+    fastest first.
+
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+
+    def benchmarked(ranking):
+        result = messages.Result()
+        try:
+            decoders.save_ranking(ranking)
+        except EnvironmentError, e:
+            log.warning('check', 'Could not save the decoder ranking: %s',
+                        e)
+            result.add(messages.Warning(T_(N_(
+                "Could not save the ranking of the decoders: %s"), e),
+                mid='dvb-benchmark'))
+        result.succeed(ranking)
+        return result
+
+    # the pipelines run for minutes, keep them out of the reactor
+    d = threads.deferToThread(decoders.benchmark)
+    d.addCallback(benchmarked)
+    return d
+
+
 def getAntennaeLocations():
     """
     Find from the system to find antennae where initial tuning data is
@@ -166,10 +285,18 @@ def getInitialTuning(adapterType, initialTuningFile):
     Returns a dict with tuning parameters.
     """
     result = messages.Result()
+    result.succeed(readInitialTuning(adapterType, initialTuningFile))
+    return result
+
+
+def readInitialTuning(adapterType, initialTuningFile):
+    """
+    @returns: the list of tuning parameters of an initial tuning file
+              for adapterType adapters
+    """
     ret = []
     if not os.path.exists(initialTuningFile):
-        result.succeed(ret)
-        return result
+        return ret
 
     for line in open(initialTuningFile, "r"):
         log.debug('check', 'line in file: %s' % line)
@@ -214,14 +341,102 @@ def getInitialTuning(adapterType, initialTuningFile):
                  }
             ret.append(d)
 
-    result.succeed(ret)
-    return result
+    return ret
+
+
+# frontend status bits telling there is some energy on the frequency
+FE_HAS_SIGNAL = 0x01
+FE_HAS_CARRIER = 0x02
+
+# timings learnt from the scans of the worker, in the directory of
+# statedir, next to the scan cache
+TIMINGS_FILENAME = 'scan-timings'
+
+
+class ScanTimings(object):
+    """
+    I learn from the scans that completed how long to wait, for each
+    delivery type, for the lock and between two new tables.
+    """
+
+    # kind -> (default, shortest, longest) timeout in seconds
+    LIMITS = {'lock': (10.0, 1.0, 10.0),
+              'tables': (10.0, 2.0, 20.0)}
+    # margin over the longest wait a completed scan needed
+    FACTOR = 1.5
+    # number of scans remembered for each delivery type and kind
+    HISTORY = 20
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._history = {}
+        self.load()
+
+    def _getFilename(self):
+        return self.filename or os.path.join(statedir.get_directory(),
+                                             TIMINGS_FILENAME)
+
+    def load(self):
+        try:
+            f = open(self._getFilename())
+        except EnvironmentError:
+            return
+        for line in f:
+            try:
+                dvbType, kind, seconds = line.split()
+                seconds = float(seconds)
+            except ValueError:
+                continue
+            self._history.setdefault((dvbType, kind), []).append(seconds)
+        f.close()
+
+    def save(self):
+        filename = self._getFilename()
+        tmp = filename + '.tmp'
+        f = open(tmp, 'w')
+        for (dvbType, kind), history in self._history.items():
+            for seconds in history:
+                f.write('%s %s %.3f\n' % (dvbType, kind, seconds))
+        f.close()
+        os.rename(tmp, filename)
+
+    def record(self, dvbType, kind, seconds):
+        history = self._history.setdefault((str(dvbType), kind), [])
+        history.append(seconds)
+        del history[:-self.HISTORY]
+
+    def get_timeout(self, dvbType, kind):
+        """
+        @returns: seconds to wait for kind on a dvbType frontend
+        """
+        default, shortest, longest = self.LIMITS[kind]
+        history = self._history.get((str(dvbType), kind))
+        if not history:
+            return default
+        return min(longest, max(shortest, max(history) * self.FACTOR))
+
+
+_timings = None
+
+
+def getScanTimings():
+    global _timings
+    if _timings is None:
+        _timings = ScanTimings()
+    return _timings
 
 
 class DVBScanner:
 
+    # bus messages carrying PSI/SI tables, which the mux keeps repeating
+    PSI_MESSAGES = ('pat', 'pmt', 'nit', 'sdt', 'eit')
+    # tables a scan waits for
+    SCAN_MESSAGES = ('pat', 'pmt', 'nit', 'sdt')
+    # consecutive frontend stats without any signal before giving up
+    NO_SIGNAL_REPORTS = 3
+
     def __init__(self, adapter=0, frontend=0, scanning_complete_cb=None,
-        channel_added_cb=None):
+        channel_added_cb=None, timings=None):
         self.adapter = adapter
         self.frontend = frontend
         self.adaptertype = None
@@ -230,15 +445,41 @@ class DVBScanner:
         self.transport_streams = {} # ts id -> tuning_params
         self.pipeline = None
         self.locked = False
+        self.finished = False
         self.nit_arrived = False
         self.sdt_arrived = False
         self.pat_arrived = False
         self.pmt_arrived = False
+        self.pending_pmts = set() # program numbers announced by the PAT
+        self.pmts_seen = set()
+        self.pat_version = None
+        self.pat_sections = {} # section number -> program numbers
+        self.no_signal_reports = 0
+        self.scan_started = None
+        self.lock_time = None
+        self.last_table = None
+        self.longest_wait = 0
+        self.tsid = None
+        self.network_id = None
+        self.versions = {} # 'nit' and 'sdt' -> version of the actual one
+        self.sdt_versions = {} # ts id -> version of its SDT
+        # versions the tables had the last time, to stop as soon as they
+        # are found unchanged
+        self.expected_versions = None
+        self.unchanged = False
+        self.complete = False
         self.check_for_lock_event_id = None
         self.wait_for_tables_event_id = None
-        self.tables_arrived = False
+        # number of the current scan, to tell stale state changes apart
+        self.scan_number = 0
+        # state changes run in threads, one after the other
+        self.state_lock = defer.DeferredLock()
         self.scanning_complete_cb = scanning_complete_cb
         self.channel_added_cb = channel_added_cb
+        self.timings = timings or getScanTimings()
+        self.sections = mpegts.SectionCache()
+        self.dispatcher = dispatch.MessageDispatcher()
+        self.register_message_handlers()
 
         self.pipeline = gst.parse_launch(
             "dvbsrc name=dvbsrc adapter=%d frontend=%d "
@@ -246,164 +487,353 @@ class DVBScanner:
             "fakesink silent=true" % (self.adapter, self.frontend))
         bus = self.pipeline.get_bus()
         bus.add_signal_watch()
-        bus.connect("message", self.bus_watch_func)
-        self.pipeline.set_state(gst.STATE_READY)
-        self.pipeline.get_state()
+        self.bus_watch_id = bus.connect("message", self.bus_watch_func)
+
+    def set_state(self, state):
+        """
+        Change the state of the pipeline once the earlier changes are
+        done, without blocking.
+
+        @returns: a deferred firing with the gst.StateChangeReturn
+        """
+        return self.state_lock.run(_setState, self.pipeline, state)
+
+    def close(self):
+        """
+        Stop scanning and get rid of the pipeline, freeing the frontend.
+        The scanner cannot be used afterwards.
+
+        @returns: a deferred firing once the frontend is closed
+        """
+        if not self.pipeline:
+            return defer.succeed(None)
+        self.cancel_timeouts()
+        self.finished = True
+        bus = self.pipeline.get_bus()
+        bus.disconnect(self.bus_watch_id)
+        bus.remove_signal_watch()
+        d = self.set_state(gst.STATE_NULL)
+        self.pipeline = None
+        return d
+
+    def cancel_timeouts(self):
+        for event_id in (self.check_for_lock_event_id,
+                         self.wait_for_tables_event_id):
+            if event_id:
+                gobject.source_remove(event_id)
+        self.check_for_lock_event_id = None
+        self.wait_for_tables_event_id = None
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.cancel_timeouts()
+        self.locked = False
+        log.debug('dvbscanner', 'Setting pipeline to ready')
+        d = self.set_state(gst.STATE_READY)
+        d.addCallback(self.stopped, self.scan_number)
+
+    def stopped(self, ret, scan_number):
+        if not self.pipeline or scan_number != self.scan_number:
+            # closed, or scanning again already
+            return
+        log.debug('dvbscanner', 'Pipeline set to ready')
+        # drop the tables still queued, the next frequency is scanned
+        # with the same pipeline
+        bus = self.pipeline.get_bus()
+        bus.set_flushing(True)
+        bus.set_flushing(False)
+        if self.scanning_complete_cb:
+            self.scanning_complete_cb()
 
     def wait_for_tables(self):
-        if not self.tables_arrived:
-            self.tables_arrived = True
-            self.pipeline.set_state(gst.STATE_READY)
-            log.debug('dvbscanner', 'Setting pipeline to ready!!')
-            self.pipeline.get_state()
-            log.debug('dvbscanner', 'Pipeline SET to ready!!')
-            self.locked = False
-            self.scanned = False
-            if self.wait_for_tables_event_id:
-                gobject.source_remove(self.wait_for_tables_event_id)
-                self.wait_for_tables_event_id = None
-                if self.scanning_complete_cb:
-                    self.scanning_complete_cb()
-        else:
-            log.debug('dvbscanner', 'TABLES HAVE ARRIVED!!!')
+        # no new table came for longer than a complete scan ever waited
+        log.debug('dvbscanner', 'Gave up waiting for tables: pat %r '
+                  'sdt %r nit %r, PMTs missing: %r', self.pat_arrived,
+                  self.sdt_arrived, self.nit_arrived,
+                  sorted(self.pending_pmts))
+        self.wait_for_tables_event_id = None
+        self.finish()
+        return False
 
     def check_for_lock(self):
+        self.check_for_lock_event_id = None
         if not self.locked:
             log.debug('check', 'Don\'t have lock!')
-            self.pipeline.set_state(gst.STATE_READY)
-            # block until state change completed
-            self.pipeline.get_state()
-            log.debug('check', 'Pipeline now ready')
-            self.scanned = False
+            self.finish()
+        return False
 
-            self.scanning_complete_cb()
-            return False
+    def have_lock(self):
+        log.debug('check', 'Have locked!')
+        self.locked = True
+        self.lock_time = time.time() - self.scan_started
+        if self.check_for_lock_event_id:
+            gobject.source_remove(self.check_for_lock_event_id)
+            self.check_for_lock_event_id = None
+        self.last_table = time.time()
+        self.wait_for_tables_event_id = gobject.timeout_add(
+            int(self.timings.get_timeout(self.adaptertype, 'tables') * 1000),
+            self.wait_for_tables)
+
+    def table_arrived(self):
+        if not self.locked:
+            self.have_lock()
+        now = time.time()
+        self.longest_wait = max(self.longest_wait, now - self.last_table)
+        self.last_table = now
+        # the mux is still giving out tables, wait for the next one
+        if self.wait_for_tables_event_id:
+            gobject.source_remove(self.wait_for_tables_event_id)
+        self.wait_for_tables_event_id = gobject.timeout_add(
+            int(self.timings.get_timeout(self.adaptertype, 'tables') * 1000),
+            self.wait_for_tables)
+
+    def tables_complete(self):
+        log.debug('dvbscanner', 'All tables arrived after %.2f s',
+                  time.time() - self.scan_started)
+        if self.lock_time is not None:
+            self.timings.record(self.adaptertype, 'lock', self.lock_time)
+        self.timings.record(self.adaptertype, 'tables', self.longest_wait)
+        try:
+            self.timings.save()
+        except EnvironmentError, e:
+            log.warning('dvbscanner', 'Could not save the scan timings: %s',
+                        e)
+        self.complete = True
+        self.finish()
 
     def have_dvb_adapter_type(self, atype):
         self.adaptertype = atype
         log.debug('check', 'Adapter type is %s', atype)
 
+    def register_message_handlers(self):
+        register = self.dispatcher.register
+        register('dvb-adapter', self.on_dvb_adapter)
+        register('dvb-frontend-stats', self.on_frontend_stats)
+        register('dvb-read-failure', self.on_read_failure)
+        register('sdt', self.on_sdt)
+        register('nit', self.on_nit)
+        register('pat', self.on_pat)
+        register('pmt', self.on_pmt)
+
     def bus_watch_func(self, bus, message):
+        if self.finished:
+            # left over from a scan that is over
+            return
         t = message.type
         if t == gst.MESSAGE_ELEMENT:
-            if message.structure.get_name() == 'dvb-adapter':
-                s = message.structure
-                self.have_dvb_adapter_type(s["type"])
-            elif message.structure.get_name() == 'dvb-frontend-stats':
-                s = message.structure
-                if s["lock"] and not self.locked:
-                    log.debug('check', 'Have locked!')
-                    self.locked = True
-                    gobject.source_remove(self. check_for_lock_event_id)
-                    self.check_for_lock_event_id = None
-                    self.wait_for_tables_event_id = gobject.timeout_add(
-                        10*1000,
-                        self.wait_for_tables)
-            elif message.structure.get_name() == 'dvb-read-failure':
-                log.debug("dvbscanner",
-                          "DVB READ FAILURE! Time to stop pipeline")
-                if self.check_for_lock_event_id:
-                    gobject.source_remove(self.check_for_lock_event_id)
-                    self.check_for_lock_event_id = None
-                self.wait_for_tables()
-            elif message.structure.get_name() == 'sdt':
-                log.debug('check', 'Received SDT')
-                s = message.structure
-                services = s["services"]
-                tsid = s["transport-stream-id"]
-                actual = s["actual-transport-stream"]
-                if actual:
-                    for service in services:
-                        name = service.get_name()
-                        log.debug('check', 'Name: %s Structure: %r',
-                                  name, service)
-                        sid = int(name[8:])
-                        if service.has_field("name"):
-                            name = service["name"]
-                        if sid in self.channels:
-                            self.channels[sid]["name"] = name
-                            self.channels[sid]["transport-stream-id"] = tsid
-                        else:
-                            self.channels[sid] = {
-                                "name": name,
-                                "transport-stream-id": tsid,
-                                }
-                        if self.channel_added_cb:
-                            self.channel_added_cb(sid, self.channels[sid])
-                    self.sdt_arrived = True
-
-            elif message.structure.get_name() == 'nit':
-                log.debug('check', 'Received NIT')
-                s = message.structure
-                name = s["network-id"]
-                actual = s["actual-network"]
-                if s.has_field("network-name"):
-                    name = s["network-name"]
-                transports = s["transports"]
-                for transport in transports:
-                    tsid = transport["transport-stream-id"]
-                    if not transport.has_field("delivery"):
-                        continue
-                    delivery = transport["delivery"]
-                    self.transport_streams[tsid] = dict(delivery)
-                    if not transport.has_field("channels"):
-                        continue
-                    chans = transport["channels"]
-                    for chan in chans:
-                        serviceId = chan["service-id"]
-                        chanKey = "logical-channel-number"
-                        logicalChannel = chan[chanKey]
-                        if chan["service-id"] in self.channels:
-                            self.channels[serviceId][chanKey] = logicalChannel
-                        else:
-                            self.channels[serviceId] = {
-                                chanKey: logicalChannel}
-                self.nit_arrived = True
-            elif message.structure.get_name() == 'pat':
-                log.debug('check', 'Received PAT')
-                programs = message.structure["programs"]
-                for p in programs:
-                    sid = p["program-number"]
-                    pmt = p["pid"]
-                    if sid in self.channels:
-                        self.channels[sid]["pmt-pid"] = pmt
-                    else:
-                        self.channels[sid] = {"pmt-pid": pmt}
-                self.pat_arrived = True
-            elif message.structure.get_name() == 'pmt':
-                log.debug('check', 'Received PMT')
-                sid = message.structure['program-number']
-                streams = message.structure['streams']
-                if sid not in self.channels and streams:
-                    self.channels[sid] = {}
-                if 'audio-streams' not in self.channels[sid]:
-                    self.channels[sid]['audio-streams'] = []
-                if 'video-streams' not in self.channels[sid]:
-                    self.channels[sid]['video-streams'] = []
-
-                for s in streams:
-                    st = s['stream-type']
-                    if st in [1, 2]:
-                        self.channels[sid]['video-streams'].append(s['pid'])
-                    elif st in [3, 4]:
-                        lang = ('pid-%s' % s['pid'], s['pid'])
-                        if s.has_field('lang-code'):
-                            lang = (s['lang-code'], s['pid'])
-
-                        self.channels[sid]['audio-streams'].append(lang)
-                self.pmt_arrived = True
-
+            s = message.structure
+            name = s.get_name()
+            if name in self.PSI_MESSAGES and \
+                   self.sections.structure_seen(s):
+                # a repetition of a section we already handled
+                return
+            self.dispatcher.dispatch(s)
+            if name in self.SCAN_MESSAGES and not self.finished:
+                self.table_arrived()
 
+        if self.finished:
+            return
         if (self.sdt_arrived and self.nit_arrived and
             self.pat_arrived and self.pmt_arrived):
-            self.wait_for_tables()
+            self.tables_complete()
+        elif self.expected_versions and self.versions_unchanged():
+            log.debug('dvbscanner', 'Tables unchanged: %r', self.versions)
+            self.unchanged = True
+            self.finish()
+
+    def versions_unchanged(self):
+        for table, version in self.expected_versions.items():
+            if self.versions.get(table) != version:
+                return False
+        return True
+
+    def on_dvb_adapter(self, s):
+        self.have_dvb_adapter_type(s["type"])
+
+    def on_frontend_stats(self, s):
+        if self.finished:
+            return
+        if s["lock"]:
+            self.no_signal_reports = 0
+            if not self.locked:
+                self.have_lock()
+            return
+        if self.locked:
+            return
+        status = 0
+        if s.has_field("status"):
+            status = s["status"]
+        if s["signal"] or status & (FE_HAS_SIGNAL | FE_HAS_CARRIER):
+            self.no_signal_reports = 0
+            return
+        self.no_signal_reports += 1
+        if self.no_signal_reports >= self.NO_SIGNAL_REPORTS:
+            log.debug('check', 'No signal on %r',
+                      self.current_tuning_params.get("frequency"))
+            self.finish()
+
+    def on_read_failure(self, s):
+        log.debug("dvbscanner",
+                  "DVB READ FAILURE! Time to stop pipeline")
+        self.finish()
+
+
+    def on_sdt(self, s):
+        log.debug('check', 'Received SDT')
+        services = s["services"]
+        tsid = s["transport-stream-id"]
+        actual = s["actual-transport-stream"]
+        if s.has_field("version-number"):
+            self.sdt_versions[tsid] = s["version-number"]
+            if actual:
+                self.versions['sdt'] = s["version-number"]
+        if actual:
+            self.tsid = tsid
+            for service in services:
+                name = service.get_name()
+                log.debug('check', 'Name: %s Structure: %r',
+                          name, service)
+                sid = int(name[8:])
+                if service.has_field("name"):
+                    name = service["name"]
+                if sid in self.channels:
+                    self.channels[sid]["name"] = name
+                    self.channels[sid]["transport-stream-id"] = tsid
+                else:
+                    self.channels[sid] = {
+                        "name": name,
+                        "transport-stream-id": tsid,
+                        }
+                if self.channel_added_cb:
+                    self.channel_added_cb(sid, self.channels[sid])
+            self.sdt_arrived = True
+
+    def on_nit(self, s):
+        log.debug('check', 'Received NIT')
+        name = s["network-id"]
+        actual = s["actual-network"]
+        if s.has_field("network-name"):
+            name = s["network-name"]
+        if actual:
+            self.network_id = s["network-id"]
+            if s.has_field("version-number"):
+                self.versions['nit'] = s["version-number"]
+        transports = s["transports"]
+        for transport in transports:
+            tsid = transport["transport-stream-id"]
+            if not transport.has_field("delivery"):
+                continue
+            delivery = transport["delivery"]
+            self.transport_streams[tsid] = dict(delivery)
+            if not transport.has_field("channels"):
+                continue
+            chans = transport["channels"]
+            for chan in chans:
+                serviceId = chan["service-id"]
+                chanKey = "logical-channel-number"
+                logicalChannel = chan[chanKey]
+                if chan["service-id"] in self.channels:
+                    self.channels[serviceId][chanKey] = logicalChannel
+                else:
+                    self.channels[serviceId] = {
+                        chanKey: logicalChannel}
+        self.nit_arrived = True
+
+    def on_pat(self, s):
+        log.debug('check', 'Received PAT')
+        programs = s["programs"]
+        if self.tsid is None and s.has_field("transport-stream-id"):
+            self.tsid = s["transport-stream-id"]
+        # a PAT can span several sections, each announcing some programs
+        version = section = last = None
+        if s.has_field("version-number"):
+            version = s["version-number"]
+        if s.has_field("section-number"):
+            section = s["section-number"]
+        if s.has_field("last-section-number"):
+            last = s["last-section-number"]
+        if version != self.pat_version:
+            self.pat_version = version
+            self.pat_sections = {}
+        announced = self.pat_sections[section] = set()
+        for p in programs:
+            sid = p["program-number"]
+            pmt = p["pid"]
+            if sid in self.channels:
+                self.channels[sid]["pmt-pid"] = pmt
+            else:
+                self.channels[sid] = {"pmt-pid": pmt}
+            # program 0 points to the NIT
+            if sid != 0:
+                announced.add(sid)
+        self.pending_pmts = set()
+        for announced in self.pat_sections.values():
+            self.pending_pmts.update(announced)
+        self.pending_pmts -= self.pmts_seen
+        self.pat_arrived = last is None or \
+            not [n for n in range(last + 1) if n not in self.pat_sections]
+        self.pmt_arrived = self.pat_arrived and not self.pending_pmts
+
+    def on_pmt(self, s):
+        log.debug('check', 'Received PMT')
+        sid = s['program-number']
+        streams = s['streams']
+        self.channels.setdefault(sid, {})
+        if 'audio-streams' not in self.channels[sid]:
+            self.channels[sid]['audio-streams'] = []
+        if 'video-streams' not in self.channels[sid]:
+            self.channels[sid]['video-streams'] = []
 
-    def scan(self, tuning_params):
+        for stream in streams:
+            st = stream['stream-type']
+            if st in [1, 2]:
+                self.channels[sid]['video-streams'].append(stream['pid'])
+            elif st in [3, 4]:
+                lang = ('pid-%s' % stream['pid'], stream['pid'])
+                if stream.has_field('lang-code'):
+                    lang = (stream['lang-code'], stream['pid'])
+
+                self.channels[sid]['audio-streams'].append(lang)
+        self.pmts_seen.add(sid)
+        self.pending_pmts.discard(sid)
+        self.pmt_arrived = self.pat_arrived and not self.pending_pmts
+
+    def scan(self, tuning_params, expected_versions=None):
+        """
+        Tune to a frequency and gather its tables, calling
+        scanning_complete_cb when done. The same scanner can scan other
+        frequencies afterwards.
+
+        @param expected_versions: dict of 'nit' and 'sdt' -> versions of
+                                  the last scan of the frequency, to stop
+                                  as soon as they are found unchanged
+        """
         self.current_tuning_params = tuning_params
+        self.expected_versions = expected_versions
+        self.channels = {}
+        self.transport_streams = {}
+        self.sections.reset()
+        self.finished = False
         self.sdt_arrived = False
         self.nit_arrived = False
         self.pat_arrived = False
         self.pmt_arrived = False
+        self.pending_pmts = set()
+        self.pmts_seen = set()
+        self.pat_version = None
+        self.pat_sections = {}
+        self.no_signal_reports = 0
+        self.lock_time = None
+        self.last_table = None
+        self.longest_wait = 0
+        self.tsid = None
+        self.network_id = None
+        self.versions = {}
+        self.sdt_versions = {}
+        self.unchanged = False
+        self.complete = False
 
         if self.adaptertype == "DVB-T":
             modulation=""
@@ -461,15 +891,22 @@ class DVBScanner:
                 modulation = tuning_params["modulation"]
             dvbsrc.set_property("modulation", modulation)
 
-        self.pipeline.set_state(gst.STATE_PLAYING)
-        (statereturn, state, pending) = self.pipeline.get_state()
         self.locked = False
+        self.scan_number += 1
+        self.scan_started = time.time()
+        d = self.set_state(gst.STATE_PLAYING)
+        d.addCallback(self.playing, self.scan_number)
+
+    def playing(self, statereturn, scan_number):
+        # tuning is over, the frontend may have locked meanwhile
+        if self.finished or scan_number != self.scan_number:
+            return
         if statereturn == gst.STATE_CHANGE_FAILURE:
-            self.check_for_lock()
-        else:
-            # wait 10 seconds for lock
-            self.check_for_lock_event_id = gobject.timeout_add(10*1000,
-                self.check_for_lock)
+            self.finish()
+        elif not self.locked:
+            timeout = self.timings.get_timeout(self.adaptertype, 'lock')
+            self.check_for_lock_event_id = gobject.timeout_add(
+                int(timeout * 1000), self.check_for_lock)
 
 
 def scan(adapterNumber, dvbType, tuningInfo):
@@ -481,8 +918,13 @@ def scan(adapterNumber, dvbType, tuningInfo):
         result = messages.Result()
         log.debug('check', 'Channels: %r ts: %r',
                   scanner.channels, scanner.transport_streams)
+        log.debug('check', 'Sections processed: %d skipped: %d',
+                  scanner.sections.processed, scanner.sections.skipped)
+        log.debug('check', 'Message handling: %r',
+                  scanner.dispatcher.get_stats())
         result.succeed((scanner.channels, scanner.transport_streams))
-        d.callback(result)
+        # answer once the frontend is free for a component to use
+        scanner.close().addCallback(lambda _: d.callback(result))
 
     scanner = DVBScanner(adapter=adapterNumber,
         scanning_complete_cb=scanningComplete)
@@ -491,6 +933,555 @@ def scan(adapterNumber, dvbType, tuningInfo):
     return d
 
 
+class ParallelScan(log.Loggable):
+    """
+    I scan a list of frequencies with several frontends of the same
+    delivery type at once. Each frontend takes the next frequency of a
+    shared queue when it is done with one, and the frequencies the NITs
+    announce join the queue.
+
+    Given the network of an earlier scan, I skip the multiplexes whose
+    SDT, and the NIT of their network, kept their versions, and update it
+    with what changed.
+
+    @ivar channels:          service id -> channel data, merged from all
+                             the frequencies
+    @ivar transport_streams: ts id -> tuning parameters
+    @ivar scanned:           number of frequencies scanned
+    @ivar reused:            number of multiplexes found unchanged
+    """
+    logCategory = 'dvbscanner'
+
+    def __init__(self, tuners, dvbType, tuningList, network=None):
+        """
+        @param tuners:  list of (adapter, frontend) to scan with
+        @param network: L{scancache.Network} of an earlier scan, or None
+        """
+        self.dvbType = dvbType
+        self.channels = {}
+        self.transport_streams = {}
+        self.scanned = 0
+        self.reused = 0
+        self._network = network
+        self._idle = list(tuners)
+        self._queue = []
+        self._seen = set()
+        self._scanning = {}
+        self._scanners = {} # (adapter, frontend) -> DVBScanner
+        self._nitVersions = {} # network id -> version of its NIT
+        self._sdtVersions = {} # ts id -> version of its SDT
+        self._stopped = False
+        self._done = False
+        self._deferred = defer.Deferred()
+        # called whenever a frequency starts or ends being scanned
+        self.progress_cb = None
+        self._queueFrequencies(tuningList)
+        if network:
+            self._queueFrequencies([mux.tuning
+                                    for mux in network.muxes.values()])
+
+    def start(self):
+        """
+        @returns: a deferred firing with (channels, transport_streams)
+                  once the queue is empty
+        """
+        self._dispatch()
+        return self._deferred
+
+    def stop(self):
+        """
+        Scan no more frequencies, ending the ones being scanned with what
+        was found of them so far.
+        """
+        self._stopped = True
+        self._queue = []
+        for scanner, tuning_params in self._scanning.values():
+            scanner.finish()
+
+    def get_scanning(self):
+        """
+        @returns: the tuning parameters each busy frontend is scanning
+        """
+        return [params for scanner, params in self._scanning.values()]
+
+    def get_remaining(self):
+        return len(self._queue)
+
+    def _queueFrequencies(self, tuningList):
+        if self._stopped:
+            return
+        for tuning_params in tuningList:
+            key = scancache.tuning_key(tuning_params)
+            if key not in self._seen:
+                self._seen.add(key)
+                self._queue.append(tuning_params)
+
+    def _getKnownMux(self, tuning_params):
+        if not self._network:
+            return None
+        mux = self._network.get_mux(tuning_params)
+        if mux and mux.is_complete():
+            return mux
+        return None
+
+    def _reuse(self, tuning_params):
+        mux = self._getKnownMux(tuning_params)
+        if not mux or \
+               self._nitVersions.get(mux.network_id) != mux.nit_version or \
+               self._sdtVersions.get(mux.tsid) != mux.sdt_version:
+            return False
+        self.debug('%r did not change', tuning_params)
+        self.reused += 1
+        self._merge(mux.channels, {mux.tsid: mux.tuning}, mux.tuning)
+        return True
+
+    def _dispatch(self):
+        # called from the reactor, where an exception would only be
+        # logged and leave the scan waiting for ever
+        try:
+            self._dispatchQueue()
+        except Exception:
+            self._fail(failure.Failure())
+
+    def _dispatchQueue(self):
+        # other multiplexes may have told us the versions of these ones
+        self._queue = [tuning_params for tuning_params in self._queue
+                       if not self._reuse(tuning_params)]
+        while self._idle and self._queue:
+            self._scan(self._idle.pop(0), self._queue.pop(0))
+        if self._done:
+            return
+        if self.progress_cb:
+            self.progress_cb()
+        if not self._scanning:
+            self.debug('Scanned %d frequencies, %d unchanged',
+                       self.scanned, self.reused)
+            self._done = True
+            d = self._close()
+            d.addCallback(lambda _: self._deferred.callback(
+                (self.channels, self.transport_streams)))
+
+    def _fail(self, reason):
+        if self._done:
+            self.warning('Error after the scan ended: %s',
+                         reason.getErrorMessage())
+            return
+        self.warning('Scan failed: %s', reason.getErrorMessage())
+        self._done = True
+        self._stopped = True
+        self._queue = []
+        self._scanning = {}
+        d = self._close()
+        d.addCallback(lambda _: self._deferred.errback(reason))
+
+    def _close(self):
+        # fires once all the frontends are free
+        d = defer.DeferredList([scanner.close()
+                                for scanner in self._scanners.values()])
+        self._scanners = {}
+        return d
+
+    def _scan(self, tuner, tuning_params):
+        adapter, frontend = tuner
+        self.debug('Scanning %r with adapter %d frontend %d',
+                   tuning_params, adapter, frontend)
+        # each frontend keeps its pipeline for the whole sweep
+        scanner = self._scanners.get(tuner)
+        if scanner is None:
+            scanner = DVBScanner(adapter=adapter, frontend=frontend)
+            scanner.adaptertype = self.dvbType
+            self._scanners[tuner] = scanner
+        scanner.scanning_complete_cb = \
+            lambda: self._scanned(tuner, scanner, tuning_params)
+        expected = None
+        mux = self._getKnownMux(tuning_params)
+        if mux:
+            expected = {'sdt': mux.sdt_version}
+            if self._nitVersions.get(mux.network_id) != mux.nit_version:
+                expected['nit'] = mux.nit_version
+        self._scanning[tuner] = scanner, dict(tuning_params)
+        scanner.scan(tuning_params, expected)
+
+    def _scanned(self, tuner, scanner, tuning_params):
+        # called from the bus of the scanner
+        try:
+            self._scannedFrequency(tuner, scanner, tuning_params)
+        except Exception:
+            self._fail(failure.Failure())
+
+    def _scannedFrequency(self, tuner, scanner, tuning_params):
+        if tuner not in self._scanning:
+            return
+        del self._scanning[tuner]
+
+        self._sdtVersions.update(scanner.sdt_versions)
+        if scanner.network_id is not None and 'nit' in scanner.versions:
+            self._nitVersions[scanner.network_id] = scanner.versions['nit']
+        if scanner.unchanged:
+            self.reused += 1
+            mux = self._network.get_mux(tuning_params)
+            self._merge(mux.channels, {mux.tsid: mux.tuning}, tuning_params)
+        else:
+            self.scanned += 1
+            self._merge(scanner.channels, scanner.transport_streams,
+                        tuning_params)
+            if self._network:
+                self._update(scanner, tuning_params)
+
+        self._idle.append(tuner)
+        # not from within the scanner, which may be scanning right away
+        reactor.callLater(0, self._dispatch)
+
+    def _merge(self, channels, transport_streams, tuning_params):
+        for tsid, delivery in transport_streams.items():
+            self.transport_streams[tsid] = delivery
+        self._queueFrequencies(transport_streams.values())
+        for sid, channel in channels.items():
+            self.channels.setdefault(sid, {}).update(channel)
+            # muxes missing from the NIT are reached how we reached them
+            tsid = channel.get("transport-stream-id")
+            if tsid is not None and tsid not in self.transport_streams:
+                self.transport_streams[tsid] = tuning_params
+
+    def _update(self, scanner, tuning_params):
+        if scanner.tsid is None:
+            # nothing there any more
+            self._network.remove_mux(tuning_params)
+            return
+        # leave out the services the NIT lists on other multiplexes
+        channels = dict([(sid, channel)
+                         for sid, channel in scanner.channels.items()
+                         if 'pmt-pid' in channel or 'name' in channel])
+        mux = scancache.Mux(tuning_params, scanner.tsid, scanner.network_id,
+                            channels=channels)
+        # an incomplete scan is done again next time
+        if scanner.complete:
+            mux.nit_version = scanner.versions.get('nit')
+            mux.sdt_version = scanner.versions.get('sdt')
+        self._network.set_mux(mux)
+
+
+def _getFreeTuners(adapters, tunerPoolDirectory=None):
+    tuners = []
+    for adapter in adapters:
+        if isinstance(adapter, int):
+            adapter = adapter, 0
+        tuners.append(tuple(adapter))
+    pool = tunerpool.TunerPool(tunerPoolDirectory)
+    busy = set([claim.tuner() for claim in pool.get_claims()])
+    free = [tuner for tuner in tuners if tuner not in busy]
+    log.debug('check', 'Scanning with %r, %r are busy', free, busy)
+    # without a free one, scan with the first one as scan() would
+    return free or tuners[:1]
+
+
+def scanParallel(adapters, dvbType, tuningList, tunerPoolDirectory=None):
+    """
+    Scan the frequencies of tuningList, and those their NITs lead to,
+    with all the given adapters no component of the worker is using.
+    Returns a tuple of (channels, transport streams) like L{scan}.
+
+    @param adapters: list of adapter numbers, or of (adapter, frontend),
+                     all of type dvbType
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+
+    def scanned(found):
+        result = messages.Result()
+        result.succeed(found)
+        return result
+
+    d = ParallelScan(_getFreeTuners(adapters, tunerPoolDirectory), dvbType,
+                     tuningList).start()
+    d.addCallback(scanned)
+    return d
+
+
+def _makeIncrementalScan(adapters, dvbType, initialTuningFile, cacheFile,
+                         tunerPoolDirectory):
+    cache = scancache.ScanCache(cacheFile)
+    network = cache.get_network(dvbType, initialTuningFile)
+    sweep = ParallelScan(_getFreeTuners(adapters, tunerPoolDirectory),
+                         dvbType, readInitialTuning(dvbType,
+                                                    initialTuningFile),
+                         network)
+
+    def scanned(found):
+        log.debug('check', 'Scanned %d frequencies, %d unchanged',
+                  sweep.scanned, sweep.reused)
+        try:
+            cache.save()
+        except EnvironmentError, e:
+            log.warning('check', 'Could not save the scan cache: %s', e)
+        return found
+    return sweep, scanned
+
+
+def scanIncremental(adapters, dvbType, initialTuningFile, cacheFile=None,
+                    tunerPoolDirectory=None):
+    """
+    Scan like L{scanParallel} from the frequencies of an initial tuning
+    file, keeping the result in the scan cache of the worker. The
+    multiplexes whose SDT, and the NIT of their network, did not change
+    since the last scan from the same file are not scanned again.
+    Returns a tuple of (channels, transport streams) like L{scan}.
+
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+    sweep, scanned = _makeIncrementalScan(adapters, dvbType,
+                                          initialTuningFile, cacheFile,
+                                          tunerPoolDirectory)
+
+    def done(found):
+        result = messages.Result()
+        result.succeed(found)
+        return result
+
+    d = sweep.start()
+    d.addCallback(scanned)
+    d.addCallback(done)
+    return d
+
+
+def getCachedScan(dvbType, initialTuningFile, cacheFile=None):
+    """
+    Returns the channels and transport streams found by the last scan
+    from an initial tuning file, like L{scan}, without scanning.
+
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+    result = messages.Result()
+    network = scancache.ScanCache(cacheFile).get_network(dvbType,
+                                                         initialTuningFile)
+    result.succeed(network.get_result())
+    return result
+
+
+def exportChannelsConf(dvbType, initialTuningFile, cacheFile=None):
+    """
+    Returns the channels found by the last scan from an initial tuning
+    file as the contents of a channels.conf for the zap utilities.
+
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+    result = messages.Result()
+    network = scancache.ScanCache(cacheFile).get_network(dvbType,
+                                                         initialTuningFile)
+    result.succeed(''.join(network.export_channels_conf()))
+    return result
+
+
+def importChannelsConf(dvbType, initialTuningFile, channelsConf,
+                       cacheFile=None):
+    """
+    Add the channels of a channels.conf to the scan cache, so that the
+    next scan from the initial tuning file starts from them.
+    Returns the number of channels imported.
+
+    @param channelsConf: contents of the channels.conf
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+    result = messages.Result()
+    cache = scancache.ScanCache(cacheFile)
+    network = cache.get_network(dvbType, initialTuningFile)
+    imported = network.import_channels_conf(channelsConf.splitlines())
+    try:
+        cache.save()
+    except EnvironmentError, e:
+        log.warning('check', 'Could not save the scan cache: %s', e)
+        result.add(messages.Error(T_(N_(
+            "Could not save the imported channels: %s"), e),
+            mid='dvb-scan'))
+        return result
+    result.succeed(imported)
+    return result
+
+
+# seconds a progress request waits for a sweep to go on before
+# returning with nothing new
+SWEEP_POLL_TIMEOUT = 10
+# seconds the result of a sweep is kept after it ended
+SWEEP_EXPIRY = 600
+
+
+class Sweep(log.Loggable):
+    """
+    I run a L{ParallelScan} in the worker on behalf of admins following
+    it with L{getScanProgress}, so it carries on if they go away.
+
+    Every time a frequency starts or ends being scanned the revision
+    goes up, and the channels and transport streams that changed are
+    marked with it.
+    """
+    logCategory = 'dvbscanner'
+
+    def __init__(self, sweepId, scan, scanned_cb):
+        self.id = sweepId
+        self.revision = 0
+        self.done = False
+        self.error = None
+        self._scan = scan
+        self._channels = {} # service id -> (revision, channel data)
+        self._transportStreams = {} # ts id -> (revision, tuning)
+        self._waiting = []
+        scan.progress_cb = self._progress
+        d = scan.start()
+        d.addCallback(scanned_cb)
+        d.addCallback(self._finished)
+        d.addErrback(self._failed)
+
+    def stop(self):
+        self._scan.stop()
+
+    def get_progress(self, since=0):
+        """
+        @returns: dict with the revision, the channels and transport
+                  streams that changed after revision since, the
+                  frequencies being scanned, the numbers of frequencies
+                  scanned, found unchanged and left, whether the
+                  sweep is done and why it failed, if it did
+        """
+        return dict(
+            revision=self.revision,
+            channels=dict([(sid, channel) for sid, (revision, channel)
+                           in self._channels.items() if revision > since]),
+            transport_streams=dict([
+                (tsid, tuning) for tsid, (revision, tuning)
+                in self._transportStreams.items() if revision > since]),
+            scanning=[tuning["frequency"]
+                      for tuning in self._scan.get_scanning()],
+            scanned=self._scan.scanned,
+            reused=self._scan.reused,
+            remaining=self._scan.get_remaining(),
+            done=self.done,
+            error=self.error)
+
+    def wait_progress(self, since=0, timeout=SWEEP_POLL_TIMEOUT):
+        """
+        @returns: a deferred firing with L{get_progress} as soon as there
+                  is something after revision since, or after timeout
+                  seconds
+        """
+        if self.revision > since or self.done:
+            return defer.succeed(self.get_progress(since))
+        d = defer.Deferred()
+        timeoutDC = reactor.callLater(timeout, self._timeout, d, since)
+        self._waiting.append((d, since, timeoutDC))
+        return d
+
+    def _timeout(self, d, since):
+        self._waiting = [w for w in self._waiting if w[0] is not d]
+        d.callback(self.get_progress(since))
+
+    def _wakeUp(self):
+        waiting = self._waiting
+        self._waiting = []
+        for d, since, timeoutDC in waiting:
+            timeoutDC.cancel()
+            d.callback(self.get_progress(since))
+
+    def _progress(self):
+        self.revision += 1
+        for sid, channel in self._scan.channels.items():
+            if self._channels.get(sid, (0, None))[1] != channel:
+                self._channels[sid] = (self.revision, copy.deepcopy(channel))
+        for tsid, tuning in self._scan.transport_streams.items():
+            if self._transportStreams.get(tsid, (0, None))[1] != tuning:
+                self._transportStreams[tsid] = (self.revision, dict(tuning))
+        self._wakeUp()
+
+    def _finished(self, found):
+        self.debug('Sweep %d done', self.id)
+        self._end()
+
+    def _failed(self, failure):
+        self.error = failure.getErrorMessage()
+        self.warning('Sweep %d failed: %s', self.id, self.error)
+        self._end()
+
+    def _end(self):
+        self._progress()
+        self.done = True
+        self._wakeUp()
+        reactor.callLater(SWEEP_EXPIRY, _sweeps.pop, self.id, None)
+
+
+_sweeps = {}
+_lastSweepId = 0
+
+
+def startScan(adapters, dvbType, initialTuningFile, cacheFile=None,
+              tunerPoolDirectory=None):
+    """
+    Start scanning like L{scanIncremental}, in the background of the
+    worker, following the NITs without the admin.
+    Returns the id of the sweep, to follow it with L{getScanProgress}.
+
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+    global _lastSweepId
+    _lastSweepId += 1
+    sweep, scanned = _makeIncrementalScan(adapters, dvbType,
+                                          initialTuningFile, cacheFile,
+                                          tunerPoolDirectory)
+    _sweeps[_lastSweepId] = Sweep(_lastSweepId, sweep, scanned)
+    result = messages.Result()
+    result.succeed(_lastSweepId)
+    return result
+
+
+def _getSweep(sweepId, result):
+    sweep = _sweeps.get(sweepId)
+    if sweep is None:
+        result.add(messages.Error(T_(N_(
+            "The channel scan is over and its result was dropped.")),
+            mid='dvb-scan'))
+    return sweep
+
+
+def getScanProgress(sweepId, since=0):
+    """
+    Wait up to SWEEP_POLL_TIMEOUT seconds for a sweep started with
+    L{startScan} to make progress after revision since.
+    Returns a dict with the revision to ask from next time, the channels
+    and transport streams that changed, the frequencies being scanned,
+    how many were scanned, found unchanged and are left, whether the
+    sweep is done and why it failed, if it did.
+
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+    result = messages.Result()
+    sweep = _getSweep(sweepId, result)
+    if sweep is None:
+        return result
+
+    def progress(progress):
+        if progress['error']:
+            result.add(messages.Error(T_(N_(
+                "The channel scan failed: %s"), progress['error']),
+                mid='dvb-scan'))
+        result.succeed(progress)
+        return result
+
+    d = sweep.wait_progress(since)
+    d.addCallback(progress)
+    return d
+
+
+def stopScan(sweepId):
+    """
+    Stop a sweep started with L{startScan}, keeping what it found.
+
+    @rtype: L{twisted.internet.defer.Deferred}
+    """
+    result = messages.Result()
+    sweep = _getSweep(sweepId, result)
+    if sweep is not None:
+        sweep.stop()
+        result.succeed(True)
+    return result
+
+
 def checkDVBVideo(p, mid='check-dvb-video'):
     """
     @rtype: L{twisted.internet.defer.Deferred}
@@ -0,0 +1,88 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Measure the throughput of the transport stream parser on recorded files.
+
+Usage: python misc/tsbench.py [-b blocksize] [--no-crc] file.ts [...]
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flumotion.component.producers.dvb import mpegts
+
+
+def bench(filename, blocksize, check_crc):
+    parser = mpegts.TSParser(check_crc=check_crc)
+    tables = {}
+
+    def count(name):
+
+        def handler(record):
+            tables[name] = tables.get(name, 0) + 1
+        return handler
+    for name in ('pat', 'pmt', 'nit', 'sdt', 'eit'):
+        parser.connect(name, count(name))
+
+    f = open(filename, 'rb')
+    elapsed = 0.0
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        # do not account for the copy out of the file object
+        block = bytearray(block)
+        start = time.time()
+        parser.feed(block)
+        elapsed += time.time() - start
+    f.close()
+    return parser, tables, elapsed
+
+
+def main(args):
+    usage = "usage: %prog [-b blocksize] [--no-crc] file.ts [...]"
+    p = optparse.OptionParser(usage=usage)
+    p.add_option('-b', '--blocksize', type='int',
+                 default=mpegts.PACKET_SIZE * 348,
+                 help='bytes fed to the parser per call')
+    p.add_option('', '--no-crc', action='store_false', dest='check_crc',
+                 default=True, help='do not verify section CRCs')
+    options, filenames = p.parse_args(args[1:])
+    if not filenames:
+        p.error('no transport stream files given')
+
+    for filename in filenames:
+        parser, tables, elapsed = bench(filename, options.blocksize,
+                                        options.check_crc)
+        rate = elapsed and parser.packets / elapsed or 0
+        print '%s: %d packets in %.3fs, %.0f packets/s (%.1f Mbit/s)' % (
+            filename, parser.packets, elapsed, rate,
+            rate * mpegts.PACKET_SIZE * 8 / 1e6)
+        print '  sections: %d, repeated: %d, crc errors: %d, ' \
+            'sync losses: %d' % (parser.sections, parser.cache.skipped,
+                                 parser.crc_errors, parser.sync_losses)
+        print '  tables: %s' % ', '.join(
+            ['%s=%d' % item for item in sorted(tables.items())])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))